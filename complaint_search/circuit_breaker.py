@@ -0,0 +1,113 @@
+import time
+import logging
+import threading
+from elasticsearch import ConnectionError, TransportError
+from complaint_search import metrics
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(TransportError):
+    """Raised instead of calling Elasticsearch while the circuit is open"""
+
+    def __init__(self):
+        super(CircuitOpen, self).__init__(
+            503, 'Elasticsearch is unavailable, try again later')
+
+
+def is_failure(error):
+    """Whether an error means Elasticsearch, not the request, is failing"""
+    if isinstance(error, CircuitOpen):
+        return False
+    if isinstance(error, ConnectionError):
+        return True
+    return isinstance(error, TransportError) and \
+        isinstance(error.status_code, int) and error.status_code >= 500
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling Elasticsearch after max_failures failed or slow calls in
+    a row, so requests fail at once instead of each waiting for a timeout.
+    After reset_seconds up to half_open_calls requests at a time are let
+    through to probe it: a success closes the circuit, a failure opens it
+    for another reset_seconds.
+    """
+
+    def __init__(self, max_failures, slow_seconds, reset_seconds,
+                 half_open_calls):
+        self.max_failures = max_failures
+        self.slow_seconds = slow_seconds
+        self.reset_seconds = reset_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._probes = 0
+
+    def after_fork(self):
+        """Closes the circuit in a forked process, whose lock may be held"""
+        self._lock = threading.Lock()
+        self.reset()
+
+    def is_open(self):
+        return self.state != CLOSED
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self._opened_at < self.reset_seconds:
+                    raise CircuitOpen()
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    raise CircuitOpen()
+                self._probes += 1
+                return True
+            return False
+
+    def _after_call(self, is_probe, is_failed):
+        with self._lock:
+            if is_probe:
+                self._probes -= 1
+            if not is_failed:
+                if self.state != CLOSED:
+                    log.info('Elasticsearch recovered, closing the circuit')
+                self.state = CLOSED
+                self._failures = 0
+                return
+
+            self._failures += 1
+            if is_probe or self._failures >= self.max_failures:
+                if self.state != OPEN:
+                    log.warning('Opening the circuit after %d failures',
+                                self._failures)
+                    metrics.incr('circuit_opened')
+                self.state = OPEN
+                self._opened_at = time.time()
+
+    def call(self, function, *args, **kwargs):
+        try:
+            is_probe = self._before_call()
+        except CircuitOpen:
+            metrics.incr('circuit_rejected')
+            raise
+
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self._after_call(is_probe, is_failure(e))
+            raise
+        self._after_call(is_probe,
+                         time.time() - start >= self.slow_seconds)
+        return result
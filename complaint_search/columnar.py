@@ -0,0 +1,134 @@
+import os
+from datetime import datetime
+from complaint_search.defaults import CSV_ORDERED_HEADERS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+    pq = None
+
+# Rows buffered into one Parquet row group before it is written out
+_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '50000'))
+
+# The CSV columns, with real dates instead of the formatted ones
+_DATE_FIELDS = {
+    "date_received_formatted": "date_received",
+    "date_sent_to_company_formatted": "date_sent_to_company",
+}
+COLUMNS = [_DATE_FIELDS.get(field, field)
+           for field in CSV_ORDERED_HEADERS] + ["has_narrative"]
+
+_BOOLEAN_FIELDS = ("timely", "has_narrative")
+
+
+def is_available():
+    return pa is not None
+
+
+def _to_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def _to_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        return value.lower() in ("yes", "true", "1")
+    return bool(value)
+
+
+def _to_string(value):
+    if isinstance(value, list):
+        return ", ".join(value)
+    if value is None or isinstance(value, unicode):
+        return value
+    return unicode(value)
+
+
+def _to_array(field, values):
+    if field in _DATE_FIELDS.values():
+        return pa.array([_to_date(value) for value in values],
+                        type=pa.date32())
+    if field in _BOOLEAN_FIELDS:
+        return pa.array([_to_bool(value) for value in values],
+                        type=pa.bool_())
+    # Plain strings: the Parquet writer dictionary encodes each column chunk
+    # itself, so repeated values like product and company stay small
+    return pa.array([_to_string(value) for value in values],
+                    type=pa.string())
+
+
+def _to_table(columns):
+    return pa.Table.from_arrays(
+        [_to_array(field, columns[field]) for field in COLUMNS],
+        names=COLUMNS)
+
+
+class _Sink(object):
+    """File object the Parquet writer writes to, emptied after each group"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = "".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_stream(pages):
+    """
+    Writes pages of hits as a Parquet file, sending out each row group as
+    soon as it is written. Only the footer is held back until the end.
+    """
+    sink = _Sink()
+    writer = None
+    columns = {field: [] for field in COLUMNS}
+    rows = 0
+
+    for hits in pages:
+        for hit in hits:
+            source = hit["_source"]
+            for field in COLUMNS:
+                columns[field].append(source.get(field))
+        rows += len(hits)
+
+        if rows >= _ROW_GROUP_SIZE:
+            table = _to_table(columns)
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema,
+                                          compression="snappy")
+            writer.write_table(table)
+            columns = {field: [] for field in COLUMNS}
+            rows = 0
+            data = sink.take()
+            if data:
+                yield data
+
+    if rows or writer is None:
+        table = _to_table(columns)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema,
+                                      compression="snappy")
+        writer.write_table(table)
+    writer.close()
+    yield sink.take()
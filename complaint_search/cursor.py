@@ -0,0 +1,15 @@
+import json
+import base64
+
+
+def encode_cursor(scroll_id):
+    """The search_after cursor handed to clients for a scroll"""
+    return base64.urlsafe_b64encode(json.dumps({"scroll_id": scroll_id}))
+
+
+def decode_cursor(token):
+    """The scroll id of a search_after cursor, None if it isn't one"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(token)))["scroll_id"]
+    except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+        return None
@@ -1,6 +1,23 @@
+import os
+import re
+import zlib
+from django.utils.cache import patch_vary_headers
 from rest_framework import status
 from rest_framework.response import Response
-from elasticsearch import TransportError
+from elasticsearch import ConnectionTimeout, TransportError
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# gzip level (1-9) and brotli quality (0-11) of compressed responses
+_GZIP_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '6'))
+_BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '4'))
+# Responses smaller than this many bytes are sent uncompressed
+_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+# Content that is compressed already
+_COMPRESSED_TYPES = ('application/vnd.apache.parquet',)
 
 def catch_es_error(function):
     def wrap(request, *args, **kwargs):
@@ -9,10 +26,101 @@ def catch_es_error(function):
         except TransportError as e:
             status_code = e.status_code if isinstance(e.status_code, int) \
                 else status.HTTP_400_BAD_REQUEST
+            # Out of time, waiting on Elasticsearch or for its deadline
+            if isinstance(e, ConnectionTimeout):
+                status_code = status.HTTP_504_GATEWAY_TIMEOUT
             res = {
                 "error": 'Elasticsearch error: ' + e.error
             }
             return Response(res, status=status_code)
     wrap.__doc__ = function.__doc__
     wrap.__name__ = function.__name__
-    return wrap
\ No newline at end of file
+    return wrap
+
+
+def _accept_encoding(request):
+    """Encodings of the Accept-Encoding header with their q-values"""
+    accepted = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        match = re.match(r'^\s*([\w*-]+)\s*(?:;\s*q=([\d.]+))?', item)
+        if match:
+            try:
+                accepted[match.group(1).lower()] = float(match.group(2) or 1)
+            except ValueError:
+                pass
+    return accepted
+
+
+def accepts_encoding(request, encoding):
+    accepted = _accept_encoding(request)
+    return accepted.get(encoding, accepted.get('*', 0)) > 0
+
+
+def _accepted_encoding(request):
+    """The best encoding allowed by Accept-Encoding, or None"""
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepts_encoding(request, encoding):
+            return encoding
+    return None
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(_GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def _compress_stream(content, encoding):
+    compress, finish = _compressor(encoding)
+    for chunk in content:
+        data = compress(chunk)
+        # Compressors hold on to small inputs until they have a block
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(function):
+    """
+    Compresses the response with brotli or gzip when the client accepts it.
+    Streaming responses are compressed chunk by chunk as they are sent, other
+    responses only if they are at least COMPRESSION_MIN_SIZE bytes long.
+    """
+    def wrap(request, *args, **kwargs):
+        response = function(request, *args, **kwargs)
+        if response.has_header('Content-Encoding') or \
+            response.get('Content-Type', '').startswith(_COMPRESSED_TYPES):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = _accepted_encoding(request)
+        if not encoding:
+            return response
+
+        if response.streaming:
+            response.streaming_content = _compress_stream(
+                response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            if len(response.content) < _MIN_SIZE:
+                return response
+            compress, finish = _compressor(encoding)
+            content = compress(response.content) + finish()
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+
+        response['Content-Encoding'] = encoding
+        return response
+    wrap.__doc__ = function.__doc__
+    wrap.__name__ = function.__name__
+    wrap.__dict__.update(function.__dict__)
+    return wrap
@@ -38,6 +38,14 @@ SOURCE_FIELDS = (
 EXPORT_FORMATS = (
     'csv',
     'json',
+    'ndjson',
+    'parquet',
+)
+
+# Export formats whose records can be appended to an interrupted download
+RESUMABLE_FORMATS = (
+    'csv',
+    'ndjson',
 )
 
 CSV_ORDERED_HEADERS = OrderedDict([
@@ -63,9 +71,9 @@ CSV_ORDERED_HEADERS = OrderedDict([
 
 AGG_EXCLUDE_FIELDS = ['company', 'zip_code']
 
-CHUNK_SIZE = 512
-
 FORMAT_CONTENT_TYPE_MAP = {
     "json": "application/json",
     "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
 }
\ No newline at end of file
@@ -9,6 +9,7 @@ from complaint_search.defaults import (
     PARAMS,
     SOURCE_FIELDS
 )
+from complaint_search.query_analyzer import QUERY_STRING_OPTIONS
 
 
 class BaseBuilder(object):
@@ -180,7 +181,9 @@ class SearchBuilder(BaseBuilder):
 
     def _build_source(self):
         source = list(SOURCE_FIELDS)
-        if self.params.get("format") in EXPORT_FORMATS:
+        # Parquet has a has_narrative column and uses the unformatted dates
+        if self.params.get("format") in EXPORT_FORMATS and \
+            self.params.get("format") != 'parquet':
             source.remove('has_narrative')
         if self.params.get("format") == 'csv':
             source.remove('date_received')
@@ -189,20 +192,64 @@ class SearchBuilder(BaseBuilder):
             source.append('date_sent_to_company_formatted')
         return source
 
-    def build(self):
-        search = {
-            "from": self.params.get("frm"),
-            "size": self.params.get("size"),
-            "_source": self._build_source(),
-            "query": {
+    def _build_query(self):
+        search_term = self.params.get("search_term")
+        field = self.params.get("field")
+
+        if not search_term:
+            # query_string "*" is executed as an existence check on the
+            # field (or match all for _all), so ask for that directly
+            # instead of having every browse request parse a wildcard
+            if field == "_all":
+                return {"match_all": {}}
+            return {
+                "constant_score": {
+                    "filter": {
+                        "exists": {"field": field}
+                    }
+                }
+            }
+
+        if re.match("^[A-Za-z\d\s]+$", search_term) and \
+        not any(keyword in search_term
+            for keyword in ("AND", "OR", "NOT", "TO")):
+
+            # Match Query
+            query = {
+                "match": {
+                    field: {
+                        "query": search_term,
+                        "operator": "and"
+                    }
+                }
+            }
+
+        else:
+
+            # QueryString Query, analyzed by the serializer
+            query = {
                 "query_string": {
-                    "query": "*",
+                    "query": search_term,
                     "fields": [
-                        self.params.get("field")
+                        field
                     ],
                     "default_operator": "AND"
                 }
             }
+            query["query_string"].update(QUERY_STRING_OPTIONS)
+
+        # Scores are not used when sorting by date, so don't compute them
+        if self._build_sort()[0].keys() != ["_score"]:
+            query = {"constant_score": {"filter": query}}
+
+        return query
+
+    def build(self):
+        search = {
+            "from": self.params.get("frm"),
+            "size": self.params.get("size"),
+            "_source": self._build_source(),
+            "query": self._build_query()
         }
 
         # Highlight
@@ -212,45 +259,29 @@ class SearchBuilder(BaseBuilder):
         # sort
         search["sort"] = self._build_sort()
 
-        # query
-        search_term = self.params.get("search_term")
-        if search_term:
-            if re.match("^[A-Za-z\d\s]+$", search_term) and \
-            not any(keyword in search_term
-                for keyword in ("AND", "OR", "NOT", "TO")):
-
-                # Match Query
-                search["query"] = {
-                    "match": {
-                        self.params.get("field"): {
-                            "query": search_term,
-                            "operator": "and"
-                        }
-                    }
-                }
-
-            else:
-
-                # QueryString Query
-                search["query"] = {
-                    "query_string": {
-                        "query": search_term,
-                        "fields": [
-                            self.params.get("field")
-                        ],
-                        "default_operator": "AND"
-                    }
-                }
-
         return search
 
 
 class PostFilterBuilder(BaseBuilder):
+    """
+    Only the filters of fields that have a facet ignoring its own filter
+    need to be applied after the aggregations, as a post_filter. Everything
+    else (date ranges, filters of excluded facets, or all filters when no
+    facets are returned) goes in the query's filter context instead, where
+    Elasticsearch can cache it and skip non-matching documents early.
+    """
 
-    def build(self):
+    def __init__(self):
+        BaseBuilder.__init__(self)
+        self.faceted = []
+
+    def add_faceted(self, field_name_list):
+        self.faceted += field_name_list
+
+    def _build_clauses(self):
         filter_clauses = self._build_filter_clauses()
 
-        post_filter = {"bool": {"should": [], "must": [], "filter": []}}
+        clauses = []
 
         ## date_received
         date_received = self._build_date_range_filter(
@@ -259,7 +290,7 @@ class PostFilterBuilder(BaseBuilder):
             "date_received")
 
         if date_received:
-            post_filter["bool"]["filter"].append(date_received)
+            clauses.append((None, date_received))
 
         ## company_received
         company_received = self._build_date_range_filter(
@@ -268,7 +299,7 @@ class PostFilterBuilder(BaseBuilder):
             "date_sent_to_company")
 
         if company_received:
-            post_filter["bool"]["filter"].append(company_received)
+            clauses.append((None, company_received))
 
         ## Create filter clauses for all other filters
         for item in self.params:
@@ -276,9 +307,23 @@ class PostFilterBuilder(BaseBuilder):
                 # for filters selected, we are creating the field level OR query that must match
                 # e.g (this OR that) AND (y or z) AND servicemember
                 field_level_should = {"bool": {"should":filter_clauses[item]}}
-                post_filter["bool"]["filter"].append( field_level_should )
+                clauses.append((item, field_level_should))
             if item in self._OPTIONAL_FILTERS_MUST:
-                post_filter["bool"]["filter"].append(filter_clauses[item])
+                clauses.append((item, filter_clauses[item]))
+
+        return clauses
+
+    def build_query_filter(self):
+        """Filter clauses that can be applied in the query itself"""
+        return [ clause for item, clause in self._build_clauses()
+            if item not in self.faceted ]
+
+    def build(self):
+        post_filter = {"bool": {"should": [], "must": [], "filter": []}}
+
+        post_filter["bool"]["filter"] = [ clause
+            for item, clause in self._build_clauses()
+            if item is not None and item in self.faceted ]
 
         return post_filter
 
@@ -391,18 +436,76 @@ class AggregationBuilder(BaseBuilder):
 
         return field_aggs
 
+    def agg_fields(self):
+        if not self.exclude:
+            return list(self._AGG_FIELDS)
+        return [ field_name for field_name in self._AGG_FIELDS
+            if field_name not in self.exclude or field_name in self.params ]
+
+    def dependencies(self, field_name):
+        """
+        The params that decide the buckets of one facet: the date ranges and
+        every selected filter except the facet's own one (unless it is in the
+        exclude list). Values are sorted so the result can be used as a key.
+        """
+        deps = {}
+        for item in ("date_received_min", "date_received_max",
+                     "company_received_min", "company_received_max"):
+            if self.params.get(item):
+                deps[item] = str(self.params[item])
+
+        for item in self.params:
+            include_filter = item != field_name or (item == field_name and item in self.exclude)
+            if include_filter and self.params[item] and \
+                item in self._OPTIONAL_FILTERS + self._OPTIONAL_FILTERS_STRING_TO_BOOL + self._OPTIONAL_FILTERS_MUST:
+                deps[item] = sorted(self.params[item])
+
+        return deps
+
     def build(self):
         aggs = {}
 
-        agg_fields = self._AGG_FIELDS
-        if self.exclude:
-            agg_fields = [ field_name for field_name in self._AGG_FIELDS
-                if field_name not in self.exclude or field_name in self.params ]
-        for field_name in agg_fields:
+        for field_name in self.agg_fields():
             aggs[field_name] = self.build_one(field_name)
 
         return aggs
 
+    def build_grouped(self, field_names=None):
+        """
+        Same facets as build(), but facets with identical filters share one
+        filter aggregation that holds all of their terms aggregations. With
+        no facet field selected every facet has the same filter, so the
+        date ranges and filters are sent and evaluated once instead of 13
+        times. split_grouped() turns the response back into build()'s shape.
+        """
+        if field_names is None:
+            field_names = self.agg_fields()
+
+        groups = {}
+        for field_name in field_names:
+            field_aggs = self.build_one(field_name)
+            key = json.dumps(field_aggs["filter"], sort_keys=True)
+            if key not in groups:
+                groups[key] = {"filter": field_aggs["filter"], "aggs": {}}
+            groups[key]["aggs"].update(field_aggs["aggs"])
+
+        # A facet with its own filter keeps its own name and exact shape
+        return {",".join(sorted(group["aggs"])): group
+                for group in groups.values()}
+
+    @staticmethod
+    def split_grouped(aggregations):
+        """Per-facet aggregation results from a build_grouped() response"""
+        split = {}
+        for group in aggregations.values():
+            for field_name, field_res in group.items():
+                if field_name != "doc_count":
+                    split[field_name] = {
+                        "doc_count": group["doc_count"],
+                        field_name: field_res
+                    }
+        return split
+
 if __name__ == "__main__":
     searchbuilder = SearchBuilder()
     print searchbuilder.build()
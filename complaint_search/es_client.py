@@ -0,0 +1,102 @@
+import os
+import time
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
+from complaint_search import metrics
+
+# Comma separated host:port of the nodes to send requests to
+_ES_HOSTS = os.environ.get('ES_HOSTS', '{}:{}'.format(
+    os.environ.get('ES_HOST', 'localhost'), os.environ.get('ES_PORT', '9200')))
+# Connections kept open to each node
+_ES_MAXSIZE = int(os.environ.get('ES_MAXSIZE', '10'))
+# Seconds a request may take
+_ES_TIMEOUT = float(os.environ.get('ES_TIMEOUT', '100'))
+# Times a request is retried on another node
+_ES_MAX_RETRIES = int(os.environ.get('ES_MAX_RETRIES', '3'))
+# Whether a request that timed out is retried, not only failed connections
+_ES_RETRY_ON_TIMEOUT = os.environ.get('ES_RETRY_ON_TIMEOUT', 'false') == 'true'
+# Whether the nodes of the cluster are discovered from the ones in ES_HOSTS
+_ES_SNIFF = os.environ.get('ES_SNIFF', 'false') == 'true'
+# Seconds between two discoveries, when sniffing
+_ES_SNIFF_INTERVAL = float(os.environ.get('ES_SNIFF_INTERVAL', '60'))
+# Whether responses are asked for gzipped (needs http.compression on ES)
+_ES_HTTP_COMPRESS = os.environ.get('ES_HTTP_COMPRESS', 'false') == 'true'
+
+
+def parse_hosts(value):
+    hosts = []
+    for host in value.split(','):
+        host = host.strip()
+        if not host:
+            continue
+        name, _, port = host.partition(':')
+        hosts.append({"host": name, "port": int(port or 9200)})
+    return hosts
+
+
+HOSTS = parse_hosts(_ES_HOSTS)
+
+
+def _node_name(connection):
+    # http://host:port without the scheme, as a metric name suffix
+    return connection.host.split('://', 1)[-1]
+
+
+class MeteredConnection(Urllib3HttpConnection):
+    """
+    A connection to one node that reports its requests, errors, latency and
+    how often all its pooled connections were in use
+    """
+
+    def __init__(self, http_compress=False, **kwargs):
+        super(MeteredConnection, self).__init__(**kwargs)
+        if http_compress:
+            # urllib3 decodes the gzipped body before the client reads it
+            self.headers['accept-encoding'] = 'gzip,deflate'
+
+    def in_use(self):
+        # The pool's queue holds idle connections and None for unopened ones
+        return self.pool.pool.maxsize - self.pool.pool.qsize()
+
+    def perform_request(self, *args, **kwargs):
+        node = _node_name(self)
+        if self.pool.pool.empty():
+            metrics.incr('es_pool_saturated.' + node)
+
+        start = time.time()
+        try:
+            return super(MeteredConnection, self).perform_request(
+                *args, **kwargs)
+        except Exception:
+            metrics.incr('es_request_errors.' + node)
+            raise
+        finally:
+            metrics.incr('es_requests.' + node)
+            metrics.incr('es_request_seconds.' + node, time.time() - start)
+
+
+def create_client(http_auth=None):
+    return Elasticsearch(
+        HOSTS,
+        connection_class=MeteredConnection,
+        http_auth=http_auth,
+        timeout=_ES_TIMEOUT,
+        maxsize=_ES_MAXSIZE,
+        http_compress=_ES_HTTP_COMPRESS,
+        max_retries=_ES_MAX_RETRIES,
+        retry_on_timeout=_ES_RETRY_ON_TIMEOUT,
+        sniff_on_start=_ES_SNIFF,
+        sniff_on_connection_fail=_ES_SNIFF,
+        sniffer_timeout=_ES_SNIFF_INTERVAL if _ES_SNIFF else None,
+    )
+
+
+def pool_stats(client):
+    """Connections in use and the most that can be, over all the nodes"""
+    stats = {"in_use": 0, "size": 0}
+    if client is None:
+        return stats
+    for connection in client.transport.connection_pool.connections:
+        stats["in_use"] += connection.in_use()
+        stats["size"] += connection.pool.pool.maxsize
+    return stats
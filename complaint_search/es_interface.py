@@ -1,13 +1,27 @@
 import os
+import csv
 import urllib
 import json
+import heapq
+import Queue
+from cStringIO import StringIO
+import hashlib
 import copy
 import time
+import socket
 from datetime import datetime, date, timedelta
 from collections import defaultdict, namedtuple
+import functools
+import itertools
+from functools import wraps
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
 import logging
-from elasticsearch import Elasticsearch
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from elasticsearch import ConnectionTimeout, TransportError
 from flags.state import flag_enabled
 from complaint_search.es_builders import (
     SearchBuilder,
@@ -15,18 +29,26 @@ from complaint_search.es_builders import (
     AggregationBuilder,
 )
 from complaint_search.defaults import (
-    CHUNK_SIZE,
     CSV_ORDERED_HEADERS,
     EXPORT_FORMATS,
+    RESUMABLE_FORMATS,
     PARAMS,
 )
+from complaint_search.snapshot import Snapshot
+from complaint_search.circuit_breaker import CircuitBreaker
+from complaint_search.cursor import decode_cursor, encode_cursor
+from complaint_search import columnar, es_client, export_checkpoints, metrics
+from complaint_search.response_cache import create_cache
 from stream_content import (
     StreamCSVContent,
     StreamJSONContent,
+    StreamNDJSONContent,
+    StreamRawContent,
 )
 
-_ES_URL = "{}://{}:{}".format("http", os.environ.get('ES_HOST', 'localhost'),
-                              os.environ.get('ES_PORT', '9200'))
+# Data format plugin exports go to the first node
+_ES_URL = "{}://{}:{}".format("http", es_client.HOSTS[0]["host"],
+                              es_client.HOSTS[0]["port"])
 _ES_USER = os.environ.get('ES_USER', '')
 _ES_PASSWORD = os.environ.get('ES_PASSWORD', '')
 
@@ -35,15 +57,238 @@ _ES_INSTANCE = None
 _COMPLAINT_ES_INDEX = os.environ.get('COMPLAINT_ES_INDEX', 'complaint-index')
 _COMPLAINT_DOC_TYPE = os.environ.get('COMPLAINT_DOC_TYPE', 'complaint-doctype')
 
+# Deepest from + size a plain search can reach (index.max_result_window)
+_MAX_RESULT_WINDOW = int(os.environ.get('ES_MAX_RESULT_WINDOW', '10000'))
+# How long an idle search_after cursor keeps its scroll context alive
+_CURSOR_KEEPALIVE = os.environ.get('ES_CURSOR_KEEPALIVE', '1m')
+# Seconds before the cached _meta section is refreshed in the background
+_META_REFRESH_INTERVAL = int(os.environ.get('META_REFRESH_INTERVAL', '300'))
+# Most requests that may be in flight at once for a single search
+_SEARCH_THREADS = int(os.environ.get('ES_SEARCH_THREADS', '10'))
+
+# Facet results kept by the facet cache (13 facets per distinct search)
+_FACET_CACHE_SIZE = int(os.environ.get('FACET_CACHE_SIZE', '5000'))
+
+# Export engine: 'plugin' uses the _data format plugin, 'native' scrolls
+# the shards in parallel and formats the rows here, in complaint_id order
+_EXPORT_ENGINE = os.environ.get('EXPORT_ENGINE', 'plugin')
+# Documents fetched per scroll request by a native export
+_EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+# Pages each scroll may fetch ahead of the one being streamed out
+_EXPORT_PREFETCH = 2
+# Threads scrolling shards for native exports, shared by all of them
+_EXPORT_THREADS = int(os.environ.get('EXPORT_THREADS', '16'))
+# Most scrolls a native export runs at once. With more shards than that,
+# each scroll reads several of them.
+_EXPORT_SLICES = int(os.environ.get('EXPORT_SLICES', '4'))
+# Seconds an export waits for threads held by other exports
+_EXPORT_THREADS_WAIT = 1
+# Connections to Elasticsearch kept open for data format plugin exports
+_EXPORT_POOL_SIZE = int(os.environ.get('EXPORT_POOL_SIZE', '10'))
+# Seconds to connect for an export
+_EXPORT_CONNECT_TIMEOUT = float(os.environ.get('EXPORT_CONNECT_TIMEOUT', '5'))
+# Whether export connections send TCP keep-alive probes while idle
+_EXPORT_KEEPALIVE = os.environ.get('EXPORT_KEEPALIVE', 'true') == 'true'
+
+# Seconds each endpoint may wait on Elasticsearch. An export's deadline is
+# for each request it sends (or the next bytes of the plugin's response),
+# not for the whole download.
+_DEADLINES = {
+    "search": float(os.environ.get('DEADLINE_SEARCH', '10')),
+    "suggest": float(os.environ.get('DEADLINE_SUGGEST', '2')),
+    "suggest_company": float(os.environ.get('DEADLINE_SUGGEST_COMPANY', '5')),
+    "suggest_zip": float(os.environ.get('DEADLINE_SUGGEST_ZIP', '5')),
+    "document": float(os.environ.get('DEADLINE_DOCUMENT', '5')),
+    "export": float(os.environ.get('DEADLINE_EXPORT', '300')),
+}
+# Share of the time left that Elasticsearch is told it has, so a search it
+# cuts short still comes back before the client stops waiting for it
+_ES_TIMEOUT_SHARE = 0.8
+# Seconds the aggregations may take past the deadline to return what they
+# have, before the search is sent without them
+_AGGS_GRACE = 1
+
+# Failed or slow (CIRCUIT_SLOW_SECONDS) calls in a row that open the
+# circuit, and seconds before it lets CIRCUIT_HALF_OPEN_CALLS calls through
+# to check whether Elasticsearch is back
+_CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', '5'))
+_CIRCUIT_SLOW_SECONDS = float(os.environ.get('CIRCUIT_SLOW_SECONDS', '5'))
+_CIRCUIT_RESET_SECONDS = float(os.environ.get('CIRCUIT_RESET_SECONDS', '30'))
+_CIRCUIT_HALF_OPEN_CALLS = int(os.environ.get('CIRCUIT_HALF_OPEN_CALLS', '1'))
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Native exports take the _EXPORT_THREADS they scroll with before starting,
+# so none waits on a scroll queued behind another export's
+_EXPORT_POOL = None
+_EXPORT_THREADS_BUSY = 0
+_EXPORT_THREADS_FREED = threading.Condition()
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+_FACET_CACHE = create_cache(_FACET_CACHE_SIZE, 'ccdb5_facet:')
+
 
 def _get_es():
     global _ES_INSTANCE
     if _ES_INSTANCE is None:
-        _ES_INSTANCE = Elasticsearch([_ES_URL], http_auth=(_ES_USER, _ES_PASSWORD),
-                                     timeout=100)
+        _ES_INSTANCE = es_client.create_client(
+            http_auth=(_ES_USER, _ES_PASSWORD))
     return _ES_INSTANCE
 
 
+def after_fork():
+    """
+    Drops what a forked process inherited but can't use: the clients whose
+    connections the parent goes on using, the pool whose threads did not
+    survive the fork, and locks a thread of the parent may have held
+    """
+    global _ES_INSTANCE, _POOL, _POOL_LOCK, _SESSION, _SESSION_LOCK
+    global _EXPORT_POOL, _EXPORT_THREADS_BUSY, _EXPORT_THREADS_FREED
+    _ES_INSTANCE = None
+    _POOL = None
+    _POOL_LOCK = threading.Lock()
+    _EXPORT_POOL = None
+    _EXPORT_THREADS_BUSY = 0
+    _EXPORT_THREADS_FREED = threading.Condition()
+    _SESSION = None
+    _SESSION_LOCK = threading.Lock()
+    _BREAKER.after_fork()
+    _META_SNAPSHOT.after_fork()
+
+
+def _get_pool():
+    # Created on first use so no threads exist before the server forks
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPool(_SEARCH_THREADS)
+    return _POOL
+
+
+def _take_export_threads(count):
+    """
+    The export pool, once count of its threads are free for the caller. Each
+    is given back with _free_export_thread. Other exports holding them for
+    longer than _EXPORT_THREADS_WAIT is a 429: the client is told to come
+    back later, and the circuit breaker doesn't take it for Elasticsearch
+    failing.
+    """
+    global _EXPORT_POOL, _EXPORT_THREADS_BUSY
+    deadline = time.time() + _EXPORT_THREADS_WAIT
+    with _EXPORT_THREADS_FREED:
+        while _EXPORT_THREADS_BUSY + count > _EXPORT_THREADS:
+            left = deadline - time.time()
+            if left <= 0:
+                metrics.incr('export_threads_exhausted')
+                raise TransportError(
+                    429, 'Too many exports are running, try again later')
+            _EXPORT_THREADS_FREED.wait(left)
+        _EXPORT_THREADS_BUSY += count
+        if _EXPORT_POOL is None:
+            _EXPORT_POOL = ThreadPool(_EXPORT_THREADS)
+        return _EXPORT_POOL
+
+
+def _free_export_thread():
+    global _EXPORT_THREADS_BUSY
+    with _EXPORT_THREADS_FREED:
+        _EXPORT_THREADS_BUSY -= 1
+        _EXPORT_THREADS_FREED.notify_all()
+
+
+class _ExportAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        if _EXPORT_KEEPALIVE:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super(_ExportAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def _get_session():
+    # Shared by every export so connections are reused instead of opened
+    # for each one. Created on first use, like the thread pool.
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            # requests.get does not seem to respect an IP address in
+            # NO_PROXY. This is a workaround based on:
+            # https://stackoverflow.com/questions/28521535/requests-how-to-disable-bypass-proxy/28521696#28521696  # noqa
+            session.trust_env = False
+            session.auth = (_ES_USER, _ES_PASSWORD)
+            adapter = _ExportAdapter(pool_connections=1,
+                                     pool_maxsize=_EXPORT_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+    return _SESSION
+
+
+def _export_pool_stats():
+    """Connections of the export pool that are in use, idle and ever opened"""
+    stats = {"in_use": 0, "idle": 0, "opened": 0}
+    if _SESSION is None:
+        return stats
+    pools = _SESSION.get_adapter(_ES_URL).poolmanager.pools
+    for key in pools.keys():
+        pool = pools[key]
+        # The queue holds idle connections and None for ones not opened yet
+        stats["in_use"] += pool.pool.maxsize - pool.pool.qsize()
+        stats["idle"] += sum(1 for conn in list(pool.pool.queue) if conn)
+        stats["opened"] += pool.num_connections
+    return stats
+
+
+for stat in ("in_use", "idle", "opened"):
+    metrics.register_gauge('export_pool_' + stat,
+                           lambda stat=stat: _export_pool_stats()[stat])
+for stat in ("in_use", "size"):
+    metrics.register_gauge(
+        'es_pool_' + stat,
+        lambda stat=stat: es_client.pool_stats(_ES_INSTANCE)[stat])
+
+
+class Deadline(object):
+    """The time left of an endpoint's budget, shared by all its requests"""
+
+    def __init__(self, endpoint):
+        self.expires = time.time() + _DEADLINES[endpoint]
+
+    def remaining(self):
+        return max(0, self.expires - time.time())
+
+    def kwargs(self, search=True):
+        """
+        The client's request_timeout for the next request, and for a search
+        the timeout after which Elasticsearch returns what it found so far
+        """
+        remaining = self.remaining()
+        if not remaining:
+            raise ConnectionTimeout('TIMEOUT', 'Deadline exceeded', None)
+        kwargs = {"request_timeout": remaining}
+        if search:
+            kwargs["timeout"] = "{}ms".format(
+                int(remaining * _ES_TIMEOUT_SHARE * 1000))
+        return kwargs
+
+
+_BREAKER = CircuitBreaker(_CIRCUIT_FAILURES, _CIRCUIT_SLOW_SECONDS,
+                          _CIRCUIT_RESET_SECONDS, _CIRCUIT_HALF_OPEN_CALLS)
+metrics.register_gauge('circuit_open', lambda: int(_BREAKER.is_open()))
+
+
+def _guarded(function):
+    # Raises CircuitOpen at once while Elasticsearch keeps failing
+    @wraps(function)
+    def wrap(*args, **kwargs):
+        return _BREAKER.call(function, *args, **kwargs)
+    return wrap
+
+
 def _get_now():
     return datetime.now()
 
@@ -73,45 +318,44 @@ def from_timestamp(seconds):
     return fromtimestamp.strftime('%Y-%m-%d')
 
 
-def _get_meta():
-    # Hard code noon Eastern Time zone since that is where it is built
-    body = {
-        # size: 0 here to prevent taking too long since we only needed max_date
-        "size": 0,
-        "aggs": {
-            "max_date": {
-                "max": {
-                    "field": "date_received",
-                    "format": "yyyy-MM-dd'T'12:00:00-05:00"
-                }
-            },
-            "max_indexed_date": {
-                "max": {
-                    "field": "date_indexed",
-                    "format": "yyyy-MM-dd'T'12:00:00-05:00"
-                }
-            },
-            "max_narratives": {
-                "filter": {"term": {"has_narrative": "true"}},
-                "aggs": {
-                    "max_date": {
-                        "max": {
-                            "field": ":updated_at",
-                        }
+# Hard code noon Eastern Time zone since that is where it is built
+_META_BODY = {
+    # size: 0 here to prevent taking too long since we only needed max_date,
+    # hits.total doubles as the total record count
+    "size": 0,
+    "aggs": {
+        "max_date": {
+            "max": {
+                "field": "date_received",
+                "format": "yyyy-MM-dd'T'12:00:00-05:00"
+            }
+        },
+        "max_indexed_date": {
+            "max": {
+                "field": "date_indexed",
+                "format": "yyyy-MM-dd'T'12:00:00-05:00"
+            }
+        },
+        "max_narratives": {
+            "filter": {"term": {"has_narrative": "true"}},
+            "aggs": {
+                "max_date": {
+                    "max": {
+                        "field": ":updated_at",
                     }
                 }
             }
         }
     }
-    max_date_res = _get_es().search(index=_COMPLAINT_ES_INDEX, body=body)
-    count_res = _get_es().count(index=_COMPLAINT_ES_INDEX, 
-        doc_type=_COMPLAINT_DOC_TYPE)
+}
 
+
+def _parse_meta(max_date_res):
     result = {
         "license": "CC0",
         "last_updated": max_date_res["aggregations"]["max_date"]["value_as_string"],
         "last_indexed": max_date_res["aggregations"]["max_indexed_date"]["value_as_string"],
-        "total_record_count": count_res["count"],
+        "total_record_count": max_date_res["hits"]["total"],
         "is_data_stale": _is_data_stale(max_date_res["aggregations"]["max_date"]["value_as_string"]),
         "is_narrative_stale": _is_data_stale(from_timestamp(max_date_res["aggregations"]["max_narratives"]["max_date"]["value"])),
         "has_data_issue": flag_enabled('CCDB_TECHNICAL_ISSUES')
@@ -119,11 +363,156 @@ def _get_meta():
 
     return result
 
+
+def _get_meta():
+    max_date_res = _get_es().search(index=_COMPLAINT_ES_INDEX,
+                                    doc_type=_COMPLAINT_DOC_TYPE,
+                                    body=_META_BODY)
+    return _parse_meta(max_date_res)
+
+
+def _msearch(searches, deadline=None):
+    # Runs independent (header, body) searches in a single round trip and
+    # returns their responses in the same order. A failed search raises the
+    # same TransportError a plain search() call would have.
+    body = []
+    for header, search_body in searches:
+        body.append(header)
+        body.append(search_body)
+
+    kwargs = deadline.kwargs(search=False) if deadline else {}
+    responses = _get_es().msearch(body=body, **kwargs)["responses"]
+    for response in responses:
+        if "error" in response:
+            error = response["error"]
+            if isinstance(error, dict):
+                error = error.get("type", json.dumps(error))
+            raise TransportError(response.get("status", "N/A"), error, response)
+    return responses
+
+
+# The metadata only changes when the index is rebuilt, so searches are served
+# from memory instead of running _get_meta (and the flag lookup) every time
+_META_SNAPSHOT = Snapshot(lambda: _get_meta(), _META_REFRESH_INTERVAL)
+metrics.register_gauge('meta_snapshot_age_seconds', _META_SNAPSHOT.age)
+
+
+def last_indexed():
+    """
+    When the index was last loaded, from the _meta snapshot, or None before
+    it is. Cached results are keyed by it, so they are not served from
+    before a reindex.
+    """
+    if not _META_SNAPSHOT.is_loaded():
+        return None
+    return _META_SNAPSHOT.get()["last_indexed"]
+
+
+def exports_are_resumable():
+    # Only the native engine exports in a stable order, and the checkpoints
+    # to resume from need a cache shared by the workers
+    return _EXPORT_ENGINE == "native" and export_checkpoints.is_enabled()
+
+
+def get_meta():
+    """The _meta section, read from Elasticsearch now"""
+    return _META_SNAPSHOT.refresh()
+
+
+def _search_aggs(query, aggs, deadline=None):
+    # The aggregations do not depend on paging, sort or highlighting, so they
+    # run on their own as a size 0 search the shard request cache can serve
+    body = {"size": 0, "query": query, "aggs": aggs}
+    kwargs = deadline.kwargs() if deadline else {}
+    return _get_es().search(index=_COMPLAINT_ES_INDEX,
+                            doc_type=_COMPLAINT_DOC_TYPE,
+                            body=body,
+                            request_cache=True,
+                            **kwargs)
+
+
+def _facet_key(query, field_name, dependencies):
+    return hashlib.sha1(json.dumps(
+        [query, field_name, dependencies, last_indexed()],
+        sort_keys=True)).hexdigest()
+
+
+def _cached_aggs(query, aggregation_builder, deadline=None):
+    # A facet's buckets only depend on the query and on the filters other
+    # than its own, so toggling a company checkbox leaves the company facet
+    # cached. Only the facets whose inputs changed are sent to Elasticsearch.
+    # Facets that ran out of time are missing, or incomplete and not cached,
+    # and listed as "partial".
+    aggregations = {}
+    keys = {}
+    for field_name in aggregation_builder.agg_fields():
+        key = _facet_key(query, field_name,
+                         aggregation_builder.dependencies(field_name))
+        cached = _FACET_CACHE.get(key)
+        if cached is None:
+            keys[field_name] = key
+        else:
+            aggregations[field_name] = cached
+
+    metrics.incr('facet_cache_hits', len(aggregations))
+    metrics.incr('facet_cache_misses', len(keys))
+    if not keys:
+        return {"aggregations": aggregations}
+
+    try:
+        res = _search_aggs(
+            query, aggregation_builder.build_grouped(sorted(keys)), deadline)
+    except ConnectionTimeout:
+        return {"aggregations": aggregations, "partial": sorted(keys)}
+
+    split = AggregationBuilder.split_grouped(res["aggregations"])
+    for field_name, agg in split.items():
+        if not res.get("timed_out"):
+            _FACET_CACHE.set(keys[field_name], agg)
+        aggregations[field_name] = agg
+    if res.get("timed_out"):
+        return {"aggregations": aggregations, "partial": sorted(keys)}
+    return {"aggregations": aggregations}
+
+
+def _scroll_to_page(body, frm, size, deadline):
+    # A plain search cannot page past index.max_result_window, so walk to the
+    # requested page once with a short-lived scroll. The caller gets a cursor
+    # back so the pages after this one only cost a single request each.
+    body = copy.deepcopy(body)
+    del body["from"]
+    res = _get_es().search(index=_COMPLAINT_ES_INDEX,
+                           doc_type=_COMPLAINT_DOC_TYPE,
+                           body=body,
+                           scroll=_CURSOR_KEEPALIVE,
+                           **deadline.kwargs())
+    for _ in range(frm / size):
+        page = _get_es().scroll(scroll_id=res["_scroll_id"],
+                                scroll=_CURSOR_KEEPALIVE,
+                                **deadline.kwargs(search=False))
+        res["_scroll_id"] = page["_scroll_id"]
+        res["hits"]["hits"] = page["hits"]["hits"]
+    return res
+
+
+def _set_cursor(res, size):
+    # Swap the raw scroll id for an opaque search_after cursor, or release the
+    # scroll context right away when there is no next page to fetch
+    scroll_id = res.pop("_scroll_id", None)
+    if not scroll_id:
+        return
+    if len(res["hits"]["hits"]) == size:
+        res["_search_after"] = encode_cursor(scroll_id)
+    else:
+        _get_es().clear_scroll(scroll_id=scroll_id)
+
+
 # List of possible arguments:
-# - format: format to be returned: "json", "csv"
+# - format: format to be returned: "json", "csv", "ndjson", "parquet"
 # - field: field you want to search in: "complaint_what_happened", "company_public_response", "_all"
 # - size: number of complaints to return
 # - frm: from which index to start returning
+# - search_after: cursor from a previous page's "_search_after" to fetch the next page
 # - sort: sort by: "relevance_desc", "relevance_asc", "created_date_desc", "created_date_asc"
 # - search_term: the term to be searched
 # - date_received_min: return only date received including and later than this date i.e. 2017-03-02
@@ -145,15 +534,239 @@ def _get_meta():
 # - tags - filters a list of tags
 
 
+def _put_page(out, item, stop):
+    # Blocks while the consumer is behind, gives up once it went away
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=1)
+            return
+        except Queue.Full:
+            pass
+
+
+def _scroll_slice(body, shards, out, stop):
+    """Scrolls some shards, putting each page of hits on out, then None (or
+    the error that stopped it). Frees its export thread when done."""
+    try:
+        _scroll_shards(body, shards, out, stop)
+    finally:
+        _free_export_thread()
+
+
+def _scroll_shards(body, shards, out, stop):
+    if stop.is_set():
+        # The export ended before this slice got a thread
+        return
+    scroll_id = None
+    result = None
+    try:
+        res = _get_es().search(index=_COMPLAINT_ES_INDEX,
+                               doc_type=_COMPLAINT_DOC_TYPE,
+                               body=body,
+                               preference="_shards:" + ",".join(
+                                   str(shard) for shard in shards),
+                               scroll=_CURSOR_KEEPALIVE,
+                               request_timeout=_DEADLINES["export"])
+        while not stop.is_set():
+            scroll_id = res.get("_scroll_id")
+            hits = res["hits"]["hits"]
+            if not hits:
+                break
+            _put_page(out, hits, stop)
+            res = _get_es().scroll(scroll_id=scroll_id,
+                                   scroll=_CURSOR_KEEPALIVE,
+                                   request_timeout=_DEADLINES["export"])
+    except Exception as e:
+        result = e
+    finally:
+        if scroll_id:
+            try:
+                _get_es().clear_scroll(scroll_id=scroll_id)
+            except Exception:
+                pass
+    # Errors are raised by the export itself, in the request's thread
+    _put_page(out, result, stop)
+
+
+def _shard_hits(out):
+    # (sort values, hit) of each hit a _scroll_slice puts on out
+    while True:
+        hits = out.get()
+        if hits is None:
+            return
+        if isinstance(hits, Exception):
+            raise hits
+        for hit in hits:
+            yield hit["sort"], hit
+
+
+def _export_pages(body):
+    """
+    Pages of hits for the whole export, in the order of the body's sort.
+    Elasticsearch 2.x has neither sliced scroll nor point in time, so the
+    shards are split in up to _EXPORT_SLICES slices, each with its own
+    sorted scroll (by preference). All slices are fetched at the same time
+    in the shared export pool and their hits are merged.
+
+    The first page is fetched before returning, so an export that can't
+    start raises here, before its response is sent, rather than ending
+    its download early.
+    """
+    pages = _merged_pages(body)
+    first = next(pages, None)
+    return itertools.chain([first] if first else [], pages)
+
+
+def _merged_pages(body):
+    shards = len(_get_es().search_shards(
+        index=_COMPLAINT_ES_INDEX, doc_type=_COMPLAINT_DOC_TYPE,
+        request_timeout=_DEADLINES["export"])["shards"])
+    count = min(shards, max(1, min(_EXPORT_SLICES, _EXPORT_THREADS)))
+    slices = [range(shards)[i::count] for i in range(count)]
+    stop = threading.Event()
+    queues = [Queue.Queue(_EXPORT_PREFETCH) for shard_slice in slices]
+    pool = _take_export_threads(count)
+    for shard_slice, out in zip(slices, queues):
+        pool.apply_async(_scroll_slice, (body, shard_slice, out, stop))
+
+    try:
+        page = []
+        for sort, hit in heapq.merge(*[_shard_hits(out) for out in queues]):
+            page.append(hit)
+            if len(page) == _EXPORT_BATCH_SIZE:
+                metrics.incr('export_documents', len(page))
+                yield page
+                page = []
+        if page:
+            metrics.incr('export_documents', len(page))
+            yield page
+    finally:
+        stop.set()
+
+
+def _csv_value(value):
+    if isinstance(value, list):
+        value = ", ".join(value)
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _export_csv(pages, header=True):
+    if header:
+        yield ",".join('"' + rfield + '"'
+                       for rfield in CSV_ORDERED_HEADERS.values()) + "\n"
+    for hits in pages:
+        out = StringIO()
+        writer = csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        for hit in hits:
+            source = hit["_source"]
+            writer.writerow([_csv_value(source.get(field))
+                             for field in CSV_ORDERED_HEADERS])
+        yield out.getvalue()
+
+
+def _export_ndjson(pages):
+    for hits in pages:
+        yield "".join(json.dumps(hit["_source"]) + "\n" for hit in hits)
+
+
+def _export_json(pages):
+    separator = "["
+    for hits in pages:
+        yield separator + ",".join(json.dumps(hit["_source"])
+                                   for hit in hits)
+        separator = ","
+    yield "]" if separator == "," else "[]"
+
+
+def _checkpointed(export, pages, export_id):
+    """
+    The content export(pages) makes of pages, recording a checkpoint after
+    each page: how many bytes were sent and the complaint_id of the page's
+    last record
+    """
+    last = [None]
+
+    def noted(pages):
+        for hits in pages:
+            last[0] = str(hits[-1]["sort"][0])
+            yield hits
+
+    offset = 0
+    for content in export(noted(pages)):
+        offset += len(content)
+        yield content
+        if last[0] is not None:
+            export_checkpoints.record(export_id, offset, last[0])
+
+
+def _native_export(body, format, resume_from=None, export_id=None):
+    """
+    Exports are in complaint_id order, so the complaint_id of the last
+    complete record received is where an interrupted download can continue:
+    with resume_from only the complaints after it are exported (and no CSV
+    header). For csv and ndjson they can be appended to what was received,
+    and with export_id the checkpoints to resume from are recorded.
+    """
+    body = copy.deepcopy(body)
+    body.pop("highlight", None)
+    body["size"] = _EXPORT_BATCH_SIZE
+    body["sort"] = [{"complaint_id": {"order": "asc"}}]
+    if resume_from:
+        body["query"] = {"bool": {
+            "must": body["query"],
+            "filter": [{"range": {"complaint_id": {"gt": resume_from}}}]
+        }}
+
+    pages = _export_pages(body)
+    if format == "csv":
+        export = functools.partial(_export_csv, header=not resume_from)
+    elif format == "ndjson":
+        export = _export_ndjson
+    if format in RESUMABLE_FORMATS:
+        if export_id:
+            return _checkpointed(export, pages, export_id)
+        return export(pages)
+    elif format == "parquet":
+        return columnar.parquet_stream(pages)
+    return _export_json(pages)
+
+
+@_guarded
 def search(agg_exclude=None, **kwargs):
     params = copy.deepcopy(PARAMS)
     params.update(**kwargs)
     search_builder = SearchBuilder()
     search_builder.add(**params)
     body = search_builder.build()
+
+    # Aggregations are unchanged while paging, so cursor pages skip them.
+    # Otherwise they are fetched alongside the hits below.
+    aggregation_builder = None
+    if params.get("format") == "default" and not params.get("no_aggs") \
+            and not params.get("search_after"):
+        aggregation_builder = AggregationBuilder()
+        aggregation_builder.add(**params)
+        if agg_exclude:
+            aggregation_builder.add_exclude(agg_exclude)
+
     post_filter_builder = PostFilterBuilder()
     post_filter_builder.add(**params)
-    body["post_filter"] = post_filter_builder.build()
+    if aggregation_builder:
+        post_filter_builder.add_faceted([
+            field_name for field_name in aggregation_builder.agg_fields()
+            if field_name not in aggregation_builder.exclude])
+
+    query_filter = post_filter_builder.build_query_filter()
+    if query_filter:
+        body["query"] = {"bool": {"must": body["query"],
+                                  "filter": query_filter}}
+    post_filter = post_filter_builder.build()
+    if post_filter["bool"]["filter"]:
+        body["post_filter"] = post_filter
 
     log = logging.getLogger(__name__)
     log.info(
@@ -165,26 +778,47 @@ def search(agg_exclude=None, **kwargs):
     res = None
     format = params.get("format")
     if format == "default":
-        if not params.get("no_aggs"):
-            aggregation_builder = AggregationBuilder()
-            aggregation_builder.add(**params)
-            if agg_exclude:
-                aggregation_builder.add_exclude(agg_exclude)
-            body["aggs"] = aggregation_builder.build()
-
-        res = _get_es().search(index=_COMPLAINT_ES_INDEX,
-                               doc_type=_COMPLAINT_DOC_TYPE,
-                               body=body,
-                               scroll="10m")
-
-        num_of_scroll = params.get("frm") / params.get("size")
-        scroll_id = res['_scroll_id']
-        if num_of_scroll > 0:
-            while num_of_scroll > 0:
-                res['hits']['hits'] = _get_es().scroll(scroll_id=scroll_id,
-                                                       scroll="10m")['hits']['hits']
-                num_of_scroll -= 1
-        res["_meta"] = _get_meta()
+        deadline = Deadline("search")
+        aggs_res = None
+        if aggregation_builder:
+            aggs_res = _get_pool().apply_async(
+                _cached_aggs, (body["query"], aggregation_builder, deadline))
+
+        frm = params.get("frm")
+        size = params.get("size")
+        if params.get("search_after"):
+            res = _get_es().scroll(
+                scroll_id=decode_cursor(params.get("search_after")),
+                scroll=_CURSOR_KEEPALIVE,
+                **deadline.kwargs(search=False))
+            _set_cursor(res, size)
+        elif size and frm + size > _MAX_RESULT_WINDOW:
+            res = _scroll_to_page(body, frm, size, deadline)
+            _set_cursor(res, size)
+        elif _META_SNAPSHOT.is_loaded():
+            res = _get_es().search(index=_COMPLAINT_ES_INDEX,
+                                   doc_type=_COMPLAINT_DOC_TYPE,
+                                   body=body,
+                                   **deadline.kwargs())
+        else:
+            # The metadata has to be fetched as well, so send both searches
+            # in one round trip instead of one after the other
+            header = {"index": _COMPLAINT_ES_INDEX, "type": _COMPLAINT_DOC_TYPE}
+            res, meta_res = _msearch([(header, body), (header, _META_BODY)],
+                                     deadline)
+            _META_SNAPSHOT.set(_parse_meta(meta_res))
+        if aggs_res:
+            # Out of time, the hits are returned with the facets there are
+            try:
+                aggs = aggs_res.get(deadline.remaining() + _AGGS_GRACE)
+            except TimeoutError:
+                aggs = {"aggregations": {},
+                        "partial": aggregation_builder.agg_fields()}
+            res["aggregations"] = aggs["aggregations"]
+            if aggs.get("partial"):
+                res["_partial_aggregations"] = sorted(aggs["partial"])
+                metrics.incr('search_partial_aggregations')
+        res["_meta"] = _META_SNAPSHOT.get()
 
     elif format in EXPORT_FORMATS:
         # Deleting from field and this will force data format plugin to use
@@ -192,8 +826,15 @@ def search(agg_exclude=None, **kwargs):
         # Size also doesn't seem to be relevant anymore
         del(body["from"])
 
+        # The plugin can't write Parquet or resume an export
+        if _EXPORT_ENGINE == "native" or format == "parquet" or \
+            params.get("resume_from"):
+            return _native_export(body, format, params.get("resume_from"),
+                                  params.get("export_id"))
+
         p = {
-            "format": format,
+            # The plugin's json is already one document per line
+            "format": "json" if format == "ndjson" else format,
             "source": json.dumps(body),
             "fl": ",".join(field for field in CSV_ORDERED_HEADERS.keys()),
             "append.header": "false"
@@ -203,17 +844,19 @@ def search(agg_exclude=None, **kwargs):
         url = "{}/{}/{}/_data?{}".format(_ES_URL, _COMPLAINT_ES_INDEX,
                                          _COMPLAINT_DOC_TYPE, p)
 
-        # requests.get does not seem to respect an IP address in NO_PROXY.
-        # This is a workaround based on:
-        # https://stackoverflow.com/questions/28521535/requests-how-to-disable-bypass-proxy/28521696#28521696  # noqa
-        session = requests.Session()
-        session.trust_env = False
-        response = session.get(url, auth=(
-            _ES_USER, _ES_PASSWORD), stream=True)
-        if response.ok:
-            res = response.iter_content(chunk_size=CHUNK_SIZE)
+        response = _get_session().get(
+            url, stream=True,
+            timeout=(_EXPORT_CONNECT_TIMEOUT, _DEADLINES["export"]))
+        if not response.ok:
+            # Hands the connection back to the pool
+            response.close()
+        else:
+            response.raw.decode_content = True
+            res = StreamRawContent(response.raw)
             if format == "json":
                 res = StreamJSONContent(res)
+            elif format == "ndjson":
+                res = StreamNDJSONContent(res)
             elif format == "csv":
                 readable_header = ",".join('"' + rfield + '"'
                                            for rfield in CSV_ORDERED_HEADERS.values()) + "\n"
@@ -221,16 +864,26 @@ def search(agg_exclude=None, **kwargs):
     return res
 
 
+@_guarded
 def suggest(text=None, size=6):
     if text is None:
         return []
     body = {"sgg": {"text": text, "completion": {
         "field": "suggest", "size": size}}}
-    res = _get_es().suggest(index=_COMPLAINT_ES_INDEX, body=body)
+    res = _get_es().suggest(index=_COMPLAINT_ES_INDEX, body=body,
+                            **Deadline("suggest").kwargs(search=False))
     candidates = [e['text'] for e in res['sgg'][0]['options']]
     return candidates
 
 
+# The endpoint of filter_suggest's field, for its deadline
+_SUGGEST_ENDPOINTS = {
+    "company.suggest": "suggest_company",
+    "zip_code": "suggest_zip",
+}
+
+
+@_guarded
 def filter_suggest(filterField, display_field=None, **kwargs):
     params = dict(**kwargs)
     params.update({
@@ -263,7 +916,8 @@ def filter_suggest(filterField, display_field=None, **kwargs):
     res = _get_es().search(
         index=_COMPLAINT_ES_INDEX,
         doc_type=_COMPLAINT_DOC_TYPE,
-        body=body
+        body=body,
+        **Deadline(_SUGGEST_ENDPOINTS.get(filterField, "suggest")).kwargs()
     )
     # reformat the return
     candidates = [
@@ -274,8 +928,10 @@ def filter_suggest(filterField, display_field=None, **kwargs):
     return candidates
 
 
+@_guarded
 def document(complaint_id):
     doc_query = {"query": {"term": {"_id": complaint_id}}}
     res = _get_es().search(index=_COMPLAINT_ES_INDEX,
-                           doc_type=_COMPLAINT_DOC_TYPE, body=doc_query)
+                           doc_type=_COMPLAINT_DOC_TYPE, body=doc_query,
+                           **Deadline("document").kwargs())
     return res
@@ -0,0 +1,42 @@
+import os
+import uuid
+from complaint_search import response_cache
+
+# Seconds the checkpoints of an export are kept after its last one
+_TTL = int(os.environ.get('EXPORT_CHECKPOINT_TTL', '86400'))
+# Checkpoints kept per export, the latest ones: a download can be resumed
+# unless more than this many pages were sent but never received
+_KEEP = int(os.environ.get('EXPORT_CHECKPOINT_KEEP', '32'))
+
+# The checkpoint of a download can be asked for by any worker, so they are
+# only kept in a cache the workers share
+_CACHE = response_cache.create_shared_cache('ccdb5_checkpoint:', _TTL)
+
+
+def is_enabled():
+    return response_cache.is_shared()
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+def record(export_id, offset, resume_from):
+    """
+    Records that the first offset bytes of the export end with a complete
+    record, after which it continues from resume_from
+    """
+    checkpoints = _CACHE.get(export_id) or []
+    checkpoints = (checkpoints + [(offset, resume_from)])[-_KEEP:]
+    _CACHE.set(export_id, checkpoints)
+
+
+def find(export_id, received):
+    """
+    The latest checkpoint of the export within the first received bytes, as
+    {"offset": ..., "resume_from": ...}, or None
+    """
+    for offset, resume_from in reversed(_CACHE.get(export_id) or []):
+        if offset <= received:
+            return {"offset": offset, "resume_from": resume_from}
+    return None
@@ -0,0 +1,319 @@
+import os
+import errno
+import json
+import gzip
+import time
+import logging
+import tempfile
+import threading
+from multiprocessing import Pool
+import es_interface
+from complaint_search import metrics
+from complaint_search.export_snapshots import sha256_file
+from complaint_search.serializer import fingerprint
+
+# Directory holding the job status files and the finished exports
+_JOB_DIR = os.environ.get(
+    'EXPORT_JOB_DIR', os.path.join(tempfile.gettempdir(), 'ccdb5-export-jobs'))
+# Worker processes running export jobs, per server process
+_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', '2'))
+# Most jobs a server process queues or runs before refusing new ones
+_QUEUE_SIZE = int(os.environ.get('EXPORT_JOB_QUEUE_SIZE', '10'))
+# Seconds a finished export can be downloaded, and an unfinished job can go
+# without progress before it is considered lost
+_JOB_TTL = int(os.environ.get('EXPORT_JOB_TTL', '3600'))
+# Bytes written between two progress updates of the status file
+_PROGRESS_INTERVAL = 1024 * 1024
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_POOL = None
+_LOCK = threading.Lock()
+# Ids of the jobs queued or running in this process's pool
+_PENDING = set()
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _reset_logging_locks():
+    """
+    Replaces the logging locks a forked worker inherited. Python 2 has no
+    hook to run after a fork (Python 3.7 added os.register_at_fork, which
+    logging itself uses to do this), so a lock another thread of the server
+    held at the fork stays held forever in the worker. Reaching into
+    logging._lock is safe here because the worker has a single thread when
+    the pool's initializer runs, so nothing else can hold or wait on the
+    locks being replaced. Handler.createLock() is logging's own API for
+    giving a handler a new lock.
+    """
+    logging._lock = threading.RLock()
+    for handler in logging._handlerList:
+        handler = handler()
+        if handler:
+            handler.createLock()
+
+
+def _init_worker():
+    # The pool forks from a server process whose threads may be in the
+    # middle of a request: an export uses es_interface, metrics and logging,
+    # so each drops the clients and locks it inherited
+    es_interface.after_fork()
+    metrics.after_fork()
+    _reset_logging_locks()
+
+
+def _get_pool():
+    # Created on first use so no processes exist before the server forks.
+    # It can still fork after the server started threads, which
+    # _init_worker makes safe.
+    global _POOL
+    if _POOL is None:
+        _POOL = Pool(_WORKERS, initializer=_init_worker)
+    return _POOL
+
+
+def _status_path(job_id):
+    return os.path.join(_JOB_DIR, job_id + '.json')
+
+
+def data_path(job_id):
+    return os.path.join(_JOB_DIR, job_id + '.gz')
+
+
+def get_job(job_id):
+    """The status of a job, None if there is no such job"""
+    try:
+        with open(_status_path(job_id)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_status(job):
+    # Written next to the status file and renamed, so readers in other
+    # processes never see a partial file
+    job["updated"] = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=_JOB_DIR, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(job, f)
+    os.rename(tmp_path, _status_path(job["id"]))
+
+
+def _create_status(job):
+    """
+    Writes the status file of a new job unless it exists: of all the server
+    processes submitting the same job at once, only one creates it. False
+    if another one did.
+    """
+    job["updated"] = time.time()
+    try:
+        fd = os.open(_status_path(job["id"]),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    with os.fdopen(fd, 'w') as f:
+        json.dump(job, f)
+    return True
+
+
+def _retire_status(old):
+    """
+    Moves the status file of a failed or expired job out of the way, so a
+    new job can be created in its place. False if another process already
+    replaced it with a new job, which is put back.
+    """
+    path = os.path.join(_JOB_DIR, '.old-{}-{}'.format(old["id"], os.getpid()))
+    try:
+        os.rename(_status_path(old["id"]), path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return True
+        raise
+    try:
+        with open(path) as f:
+            moved = json.load(f)
+    except ValueError:
+        # A new job whose status is still being written
+        moved = None
+    if moved is not None and moved["created"] == old["created"]:
+        os.remove(path)
+        return True
+    try:
+        os.link(path, _status_path(old["id"]))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    os.remove(path)
+    return False
+
+
+def _get_created_job(job_id):
+    # The job another process just created, once its status is written
+    for _ in range(100):
+        job = get_job(job_id)
+        if job:
+            return job
+        time.sleep(0.01)
+    raise IOError("Export job {} has no status".format(job_id))
+
+
+def _is_expired(job, now):
+    if job["finished"]:
+        return now - job["finished"] >= _JOB_TTL
+    return now - job["updated"] >= _JOB_TTL
+
+
+def _remove_expired(now):
+    for name in os.listdir(_JOB_DIR):
+        if name.endswith('.json'):
+            job_id = name[:-len('.json')]
+            job = get_job(job_id)
+            if job and _is_expired(job, now):
+                for path in (_status_path(job_id), data_path(job_id)):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+
+def _job_finished(job_id):
+    with _LOCK:
+        _PENDING.discard(job_id)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _reconcile_pending(now):
+    """
+    Forgets the pending jobs that ended without _job_finished being called:
+    their status file is gone, they are finished or expired, or the worker
+    running them was killed, which also fails the job
+    """
+    for job_id in list(_PENDING):
+        job = get_job(job_id)
+        if job and job["status"] == RUNNING and job.get("pid") and \
+            not _is_alive(job["pid"]):
+            log.error('Export job %s lost its worker', job_id)
+            job["status"] = FAILED
+            job["error"] = "The export worker died"
+            job["finished"] = now
+            _write_status(job)
+        if job is None or job["status"] in (DONE, FAILED) or \
+            _is_expired(job, now):
+            metrics.incr('export_jobs_lost')
+            _PENDING.discard(job_id)
+
+
+def submit(params):
+    """
+    Starts an export job for the validated search params and returns its
+    status. The job id is the params' fingerprint, so identical exports
+    that are queued, running or finished and not expired share one job,
+    also when they are submitted to several server processes at once.
+    Raises QueueFull when this process already has _QUEUE_SIZE jobs.
+    """
+    job_id = fingerprint(params)
+    now = time.time()
+
+    with _LOCK:
+        if not os.path.isdir(_JOB_DIR):
+            os.makedirs(_JOB_DIR)
+        job = get_job(job_id)
+        # A failed job is retried
+        if job and job["status"] != FAILED and not _is_expired(job, now):
+            metrics.incr('export_jobs_attached')
+            return job
+        if len(_PENDING) >= _QUEUE_SIZE:
+            _reconcile_pending(now)
+        if len(_PENDING) >= _QUEUE_SIZE:
+            metrics.incr('export_jobs_rejected')
+            raise QueueFull()
+
+        _remove_expired(now)
+        if job and not _retire_status(job):
+            metrics.incr('export_jobs_attached')
+            return _get_created_job(job_id)
+        job = {
+            "id": job_id,
+            "status": QUEUED,
+            "format": params["format"],
+            "bytes": 0,
+            "created": now,
+            "finished": None,
+            "error": None,
+        }
+        if not _create_status(job):
+            metrics.incr('export_jobs_attached')
+            return _get_created_job(job_id)
+        _PENDING.add(job_id)
+        pool = _get_pool()
+
+    metrics.incr('export_jobs_submitted')
+    pool.apply_async(_run_job, (job_id, params), callback=_job_finished)
+    return job
+
+
+def _run_job(job_id, params):
+    """
+    Runs in a worker process, writes the gzipped export of the job. Never
+    raises, so the pool always calls _job_finished.
+    """
+    try:
+        _export(job_id, params)
+    except Exception:
+        log.exception('Export job %s could not report its status', job_id)
+    return job_id
+
+
+def _export(job_id, params):
+    job = get_job(job_id) or {
+        "id": job_id,
+        "format": params["format"],
+        "created": time.time(),
+        "error": None,
+    }
+    job.update(status=RUNNING, pid=os.getpid(), bytes=0, finished=None)
+
+    tmp_path = None
+    try:
+        _write_status(job)
+        content = es_interface.search(**params)
+        if content is None:
+            raise IOError("Elasticsearch could not export")
+
+        fd, tmp_path = tempfile.mkstemp(dir=_JOB_DIR, prefix='.tmp-')
+        reported = 0
+        with os.fdopen(fd, 'wb') as f:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f) as gz:
+                for chunk in content:
+                    gz.write(chunk)
+                    job["bytes"] += len(chunk)
+                    if job["bytes"] - reported >= _PROGRESS_INTERVAL:
+                        reported = job["bytes"]
+                        _write_status(job)
+
+        os.rename(tmp_path, data_path(job_id))
+        job["sha256"] = sha256_file(data_path(job_id))
+        job["status"] = DONE
+    except Exception as e:
+        log.exception('Export job %s failed', job_id)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        job["status"] = FAILED
+        job["error"] = str(e)
+
+    job["finished"] = time.time()
+    _write_status(job)
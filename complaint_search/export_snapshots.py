@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import gzip
+import time
+import base64
+import hashlib
+import logging
+import tempfile
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+import es_interface
+from complaint_search.defaults import PARAMS
+
+# Directory holding the full-dataset export files, snapshots are off if unset
+_SNAPSHOT_DIR = os.environ.get('EXPORT_SNAPSHOT_DIR', '')
+_SNAPSHOT_FORMATS = [format for format in os.environ.get(
+    'EXPORT_SNAPSHOT_FORMATS', 'csv,json').split(',') if format]
+
+_MANIFEST = 'manifest.json'
+_READ_SIZE = 65536
+
+log = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return bool(_SNAPSHOT_DIR)
+
+
+def _read_manifest():
+    try:
+        with open(os.path.join(_SNAPSHOT_DIR, _MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {"last_indexed": None, "files": {}}
+
+
+def _write_atomic(name, write):
+    """Writes a file next to its final name, then renames it in place"""
+    fd, tmp_path = tempfile.mkstemp(dir=_SNAPSHOT_DIR, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, os.path.join(_SNAPSHOT_DIR, name))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def sha256_file(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def is_unfiltered(params):
+    """
+    Whether an export of these validated search params is the snapshot: the
+    export of the default search params, which the snapshots are built with
+    """
+    return all(key == 'format' or PARAMS.get(key, object()) == value
+               for key, value in params.items())
+
+
+def _build_snapshot(format):
+    content = es_interface.search(format=format)
+    if content is None:
+        raise IOError("Elasticsearch could not export {}".format(format))
+
+    def write(f):
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=6,
+                           fileobj=f) as gz:
+            for chunk in content:
+                gz.write(chunk)
+
+    name = 'complaints-{}.{}.gz'.format(int(time.time()), format)
+    _write_atomic(name, write)
+    path = os.path.join(_SNAPSHOT_DIR, name)
+    return {
+        "name": name,
+        "size": os.path.getsize(path),
+        "sha256": sha256_file(path),
+    }
+
+
+def build_snapshots(formats=None, force=False):
+    """
+    Writes a gzipped export of the whole index for each format, unless the
+    existing one is still of the current index (the same last_indexed).
+    Returns the formats that were built.
+    """
+    if not is_enabled():
+        raise ValueError("EXPORT_SNAPSHOT_DIR is not set")
+    formats = formats or _SNAPSHOT_FORMATS
+
+    last_indexed = es_interface.get_meta()["last_indexed"]
+    manifest = _read_manifest()
+    if manifest["last_indexed"] != last_indexed:
+        manifest = {"last_indexed": last_indexed, "files": {}}
+
+    built = [format for format in formats
+             if force or format not in manifest["files"]]
+    for format in built:
+        log.info('Building the %s export snapshot of %s', format,
+                 last_indexed)
+        manifest["files"][format] = _build_snapshot(format)
+
+    if built:
+        _write_atomic(_MANIFEST, lambda f: json.dump(manifest, f))
+
+    # Downloads in progress keep reading from their open file
+    current = set(entry["name"] for entry in manifest["files"].values())
+    for name in os.listdir(_SNAPSHOT_DIR):
+        if name.startswith('complaints-') and name not in current:
+            os.remove(os.path.join(_SNAPSHOT_DIR, name))
+
+    return built
+
+
+def get_snapshot(format):
+    """The manifest entry of the format's snapshot file, or None"""
+    if not is_enabled():
+        return None
+    entry = _read_manifest()["files"].get(format)
+    if entry and os.path.exists(os.path.join(_SNAPSHOT_DIR, entry["name"])):
+        return entry
+    return None
+
+
+def _parse_range(header, size):
+    """
+    (start, end) of a single bytes range, None to send the whole file or
+    False when the range can't be satisfied
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # The last N bytes
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    remaining = end - start + 1
+    try:
+        while remaining > 0:
+            block = f.read(min(_READ_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
+def snapshot_response(request, entry, content_type):
+    return file_response(request, os.path.join(_SNAPSHOT_DIR, entry["name"]),
+                         entry["sha256"], content_type)
+
+
+def file_response(request, path, sha256, content_type):
+    """
+    Serves a gzipped file gzip encoded, with Content-Length, a sha256 ETag
+    and Digest, and support for single byte ranges
+    """
+    size = os.path.getsize(path)
+    etag = '"{}"'.format(sha256)
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if 'HTTP_RANGE' in request.META and (not if_range or if_range == etag):
+        byte_range = _parse_range(request.META['HTTP_RANGE'], size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    f = open(path, 'rb')
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(f, start, end),
+                                         status=206,
+                                         content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        # Sent with the server's wsgi.file_wrapper (sendfile) if it has one
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = str(size)
+
+    response['Content-Encoding'] = 'gzip'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Digest'] = 'SHA-256={}'.format(
+        base64.b64encode(sha256.decode('hex')))
+    return response
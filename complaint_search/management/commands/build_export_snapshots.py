@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from complaint_search import export_snapshots
+
+
+class Command(BaseCommand):
+    help = ("Builds the full-dataset export files served to unfiltered "
+            "exports, when the index has changed since the last build. "
+            "Meant to be run every few minutes by a scheduler such as cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', action='append', dest='formats',
+            help='Export format to build (default: EXPORT_SNAPSHOT_FORMATS)')
+        parser.add_argument(
+            '--force', action='store_true', dest='force', default=False,
+            help='Build even if the index has not changed')
+
+    def handle(self, *args, **options):
+        try:
+            built = export_snapshots.build_snapshots(
+                options['formats'], options['force'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if built:
+            self.stdout.write('Built export snapshots: {}'.format(
+                ', '.join(built)))
+        else:
+            self.stdout.write('Export snapshots are up to date')
@@ -0,0 +1,35 @@
+import threading
+from collections import defaultdict
+
+_LOCK = threading.Lock()
+_COUNTERS = defaultdict(int)
+_GAUGES = {}
+
+
+def incr(name, value=1):
+    with _LOCK:
+        _COUNTERS[name] += value
+
+
+def register_gauge(name, func):
+    # func is called with no arguments every time the metrics are read
+    _GAUGES[name] = func
+
+
+def get_metrics():
+    with _LOCK:
+        metrics = dict(_COUNTERS)
+    for name, func in _GAUGES.items():
+        metrics[name] = func()
+    return metrics
+
+
+def after_fork():
+    # The lock may have been held by a thread of the parent process
+    global _LOCK
+    _LOCK = threading.Lock()
+
+
+def reset():
+    with _LOCK:
+        _COUNTERS.clear()
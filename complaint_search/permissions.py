@@ -0,0 +1,16 @@
+import os
+from rest_framework.permissions import BasePermission
+
+# Addresses allowed to read the internal metrics of _status, comma separated
+_STATUS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get(
+    'STATUS_ALLOWED_IPS', '127.0.0.1').split(',') if ip.strip()]
+
+
+class IsStatusClient(BasePermission):
+    """
+    The _status metrics show the inner workings of the API (pools, caches,
+    latency per node), so only monitoring from STATUS_ALLOWED_IPS reads them
+    """
+
+    def has_permission(self, request, view):
+        return request.META.get('REMOTE_ADDR') in _STATUS_ALLOWED_IPS
@@ -0,0 +1,180 @@
+import os
+import re
+from collections import namedtuple
+
+# Most a search term may cost, in plain terms
+_MAX_COST = int(os.environ.get('QUERY_MAX_COST', '100'))
+# Deepest nesting of parentheses in a search term
+_MAX_DEPTH = 5
+# Edit distance fuzzy terms are capped to
+_MAX_FUZZINESS = 1
+
+# What each clause costs, in plain terms. Wildcard and fuzzy terms are
+# expanded to every matching term of the index, phrases read positions and
+# ranges read every term between their bounds
+_COST_TERM = 1
+_COST_PHRASE = 2
+_COST_RANGE = 5
+_COST_FUZZY = 5
+_COST_WILDCARD = 10
+# The _all field holds the text of every field, so its terms match more
+_COST_ALL_FIELDS = 2
+
+# Options of query_string queries capping what their wildcard, regex and
+# fuzzy terms may expand to
+QUERY_STRING_OPTIONS = {
+    "allow_leading_wildcard": False,
+    "fuzzy_max_expansions": 10,
+    "max_determinized_states": 1000,
+}
+
+_OPERATORS = ('AND', 'OR', 'NOT', 'TO')
+# Characters ending a term, unless escaped
+_TERM_END = '()[]{}"^~:'
+# Characters the query parser reads as operators inside a term, but that
+# people mean literally ("and/or", "help!")
+_LITERAL = '/!'
+_WILDCARD = re.compile(r'(?<!\\)[*?]')
+_MODIFIER = re.compile(r'[~^](\d+(\.\d+)?)?')
+
+Analysis = namedtuple('Analysis', 'term cost rewrites')
+
+
+class QueryRejected(ValueError):
+    """A search term too expensive or malformed to send to Elasticsearch"""
+
+    def __init__(self, reason, message):
+        super(QueryRejected, self).__init__(message)
+        self.reason = reason
+
+
+def _find_closing(text, start, closing):
+    # Index of the first unescaped closing character from start
+    i = start
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] in closing:
+            return i
+        i += 1
+    return None
+
+
+def analyze(search_term, field):
+    """
+    Parses a query_string search term, rewriting what makes it expensive
+    without changing what it means to people: leading wildcards are dropped,
+    fuzzy terms allow one edit and "/" and "!" inside terms are escaped.
+    Raises QueryRejected for regular expressions, unbalanced quotes,
+    brackets or parentheses, deep nesting and terms costing more than
+    _MAX_COST.
+    """
+    output = []
+    rewrites = set()
+    cost = 0
+    depth = 0
+    i = 0
+
+    while i < len(search_term):
+        char = search_term[i]
+        if char.isspace() or char in '+-!':
+            output.append(char)
+            i += 1
+        elif search_term.startswith(('&&', '||'), i):
+            output.append(search_term[i:i + 2])
+            i += 2
+        elif char == '(':
+            depth += 1
+            if depth > _MAX_DEPTH:
+                raise QueryRejected(
+                    'too_deep', 'search_term is nested too deeply')
+            output.append(char)
+            i += 1
+        elif char == ')':
+            depth -= 1
+            if depth < 0:
+                raise QueryRejected(
+                    'syntax', 'search_term has an unbalanced ")"')
+            output.append(char)
+            i += 1
+        elif char in '"[{':
+            end = _find_closing(search_term, i + 1,
+                                '"' if char == '"' else ']}')
+            if end is None:
+                raise QueryRejected(
+                    'syntax', 'search_term has an unbalanced {}'.format(char))
+            cost += _COST_PHRASE if char == '"' else _COST_RANGE
+            output.append(search_term[i:end + 1])
+            i = end + 1
+        elif char in ']}:':
+            raise QueryRejected(
+                'syntax', 'search_term has an unexpected {}'.format(char))
+        elif char == '/':
+            raise QueryRejected(
+                'regex', 'search_term can not be a regular expression')
+        elif char in '^~':
+            # The slop of a phrase or the boost of a clause
+            modifier = _MODIFIER.match(search_term, i).group()
+            output.append(modifier)
+            i += len(modifier)
+        else:
+            term = []
+            while i < len(search_term):
+                char = search_term[i]
+                if char == '\\':
+                    term.append(search_term[i:i + 2])
+                    i += 2
+                elif char in _LITERAL:
+                    rewrites.add('escaped')
+                    term.append('\\' + char)
+                    i += 1
+                elif char.isspace() or char in _TERM_END:
+                    break
+                else:
+                    term.append(char)
+                    i += 1
+            term = ''.join(term)
+
+            if i < len(search_term) and search_term[i] == ':':
+                # A field name
+                output.append(term + ':')
+                i += 1
+                continue
+            if term in _OPERATORS:
+                output.append(term)
+                continue
+
+            if term[:1] in ('*', '?'):
+                rewrites.add('leading_wildcard')
+                term = term.lstrip('*?')
+                if not term:
+                    continue
+
+            fuzzy = _MODIFIER.match(search_term, i) \
+                if search_term[i:i + 1] == '~' else None
+            if fuzzy:
+                i += len(fuzzy.group())
+                distance = fuzzy.group(1)
+                if distance is None or float(distance) > _MAX_FUZZINESS:
+                    rewrites.add('fuzziness')
+                    distance = str(_MAX_FUZZINESS)
+                term += '~' + distance
+
+            if _WILDCARD.search(term):
+                cost += _COST_WILDCARD
+            elif fuzzy:
+                cost += _COST_FUZZY
+            else:
+                cost += _COST_TERM
+            output.append(term)
+
+    if depth:
+        raise QueryRejected('syntax', 'search_term has an unbalanced "("')
+    if field == '_all':
+        cost *= _COST_ALL_FIELDS
+    if cost > _MAX_COST:
+        raise QueryRejected('too_expensive', 'search_term is too expensive, '
+                            'use fewer terms, wildcards or fuzzy terms')
+
+    return Analysis(''.join(output).strip(), cost, sorted(rewrites))
@@ -8,4 +8,20 @@ class CSVRenderer(BaseRenderer):
     format = 'csv'
 
     def render(self, data, media_type=None, renderer_context=None):
-        return data
\ No newline at end of file
+        return data
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        return data
+
+class ParquetRenderer(BaseRenderer):
+    media_type = 'application/vnd.apache.parquet'
+    format = 'parquet'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        return data
@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from django.core.cache import caches
+from complaint_search import metrics
+from complaint_search.circuit_breaker import is_failure, CircuitOpen
+
+# "locmem" keeps responses in each process, "django" shares them through the
+# Django cache named by SEARCH_CACHE_ALIAS, "none" turns caching off
+_BACKEND = os.environ.get('SEARCH_CACHE_BACKEND', 'locmem')
+_ALIAS = os.environ.get('SEARCH_CACHE_ALIAS', 'default')
+_MAX_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '500'))
+_TTL = int(os.environ.get('SEARCH_CACHE_TTL', '300'))
+# How long the last good response of a search is kept to be served, flagged
+# as stale, while Elasticsearch is failing
+_STALE_TTL = int(os.environ.get('SEARCH_STALE_TTL', '86400'))
+
+
+class LRUCache(object):
+    """In-process cache bounded by entry count and age"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCache(object):
+    """Cache shared between workers through a Django cache backend"""
+
+    def __init__(self, alias, ttl, prefix='ccdb5_search:'):
+        self.alias = alias
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return caches[self.alias].get(self.prefix + key)
+
+    def set(self, key, value):
+        caches[self.alias].set(self.prefix + key, value, self.ttl)
+
+
+class NoCache(object):
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+def create_cache(max_size, prefix, ttl=_TTL):
+    """A cache on the configured backend, max_size only bounds locmem"""
+    if _BACKEND == 'django':
+        return DjangoCache(_ALIAS, ttl, prefix)
+    if _BACKEND == 'none':
+        return NoCache()
+    return LRUCache(max_size, ttl)
+
+
+def is_shared():
+    """Whether the configured backend is one cache for all the workers"""
+    return _BACKEND == 'django'
+
+
+def create_shared_cache(prefix, ttl=_TTL):
+    """A cache all the workers share, or NoCache if the backend isn't one"""
+    if is_shared():
+        return DjangoCache(_ALIAS, ttl, prefix)
+    return NoCache()
+
+
+_CACHE = create_cache(_MAX_SIZE, 'ccdb5_search:')
+_STALE_CACHE = create_cache(_MAX_SIZE, 'ccdb5_stale:', _STALE_TTL)
+
+
+def _stale(key, error):
+    # The last good response, flagged, when Elasticsearch itself is failing
+    if not is_failure(error) and not isinstance(error, CircuitOpen):
+        return None
+    results = _STALE_CACHE.get(key)
+    if results is None:
+        return None
+    metrics.incr('search_stale_served')
+    return dict(results, _stale=True)
+
+
+def cached(key, search):
+    """
+    Return the response cached under key, or call search() and cache what it
+    returns. Cached responses are shared, so callers must not modify them.
+    When search() fails because Elasticsearch does, the last response it
+    returned for key is served instead, with "_stale" set.
+    """
+    results = _CACHE.get(key)
+    if results is not None:
+        metrics.incr('search_cache_hits')
+        return results
+
+    metrics.incr('search_cache_misses')
+    try:
+        results = search()
+    except Exception as e:
+        results = _stale(key, e)
+        if results is None:
+            raise
+        return results
+
+    # A cursor points at server-side scroll state and must not be handed to
+    # more than one client, and facets that ran out of time are incomplete
+    if not (isinstance(results, dict) and ('_search_after' in results or
+                                           '_partial_aggregations' in results)):
+        _CACHE.set(key, results)
+        _STALE_CACHE.set(key, results)
+    return results
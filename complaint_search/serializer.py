@@ -1,19 +1,86 @@
+import json
+import hashlib
+import datetime
 from rest_framework import serializers
 from localflavor.us.us_states import STATE_CHOICES
-from complaint_search.defaults import PARAMS
+from complaint_search import columnar, metrics, query_analyzer
+from complaint_search.defaults import EXPORT_FORMATS, PARAMS, RESUMABLE_FORMATS
+from complaint_search.cursor import decode_cursor
+from complaint_search.es_interface import exports_are_resumable
 
 
+# -----------------------------------------------------------------------------
+# Query Parameters
+#
+# When you add a query parameter, make sure you add it to one of the
+# constant tuples below so it will be parse correctly
+
+QPARAMS_VARS = (
+    'company_received_max',
+    'company_received_min',
+    'date_received_max',
+    'date_received_min',
+    'field',
+    'frm',
+    'no_aggs',
+    'no_highlight',
+    'resume_from',
+    'search_after',
+    'search_term',
+    'size',
+    'sort'
+)
+
+
+QPARAMS_LISTS = (
+    'company',
+    'company_public_response',
+    'company_response',
+    'consumer_consent_provided',
+    'consumer_disputed',
+    'has_narrative',
+    'issue',
+    'product',
+    'state',
+    'submitted_via',
+    'tags',
+    'timely',
+    'zip_code'
+)
+
+
+def parse_query_params(query_params, validVars=None):
+    """
+    The search parameters of query_params, the list filters as lists. Other
+    parameters are ignored.
+    """
+    if not validVars:
+        validVars = list(QPARAMS_VARS)
+
+    data = {}
+    for param in query_params:
+        if param in validVars:
+            data[param] = query_params.get(param)
+        elif param in QPARAMS_LISTS:
+            data[param] = query_params.getlist(param)
+
+    return data
+
 class SearchInputSerializer(serializers.Serializer):
 
     ### Format Choices
     FORMAT_DEFAULT = 'default'
     FORMAT_JSON = 'json'
     FORMAT_CSV = 'csv'
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_PARQUET = 'parquet'
 
     FORMAT_CHOICES = (
         (FORMAT_DEFAULT, 'DEFAULT'),
         (FORMAT_JSON, 'JSON'),
         (FORMAT_CSV, 'CSV'),
+        (FORMAT_NDJSON, 'NDJSON'),
+        (FORMAT_PARQUET, 'PARQUET'),
     )
 
     ### Field Choices
@@ -48,7 +115,10 @@ class SearchInputSerializer(serializers.Serializer):
     size = serializers.IntegerField(min_value=0, max_value=10000000, default=PARAMS['size'])
     frm = serializers.IntegerField(min_value=0, max_value=10000000, default=PARAMS['frm'])
     sort = serializers.ChoiceField(SORT_CHOICES, default=PARAMS['sort'])
+    search_after = serializers.CharField(max_length=1000, required=False)
     search_term = serializers.CharField(max_length=200, required=False)
+    resume_from = serializers.RegexField(r'^\d+$', max_length=100,
+                                         required=False)
     date_received_min = serializers.DateField(required=False)
     date_received_max = serializers.DateField(required=False)
     company_received_min = serializers.DateField(required=False)
@@ -114,14 +184,65 @@ class SearchInputSerializer(serializers.Serializer):
 
         return value
 
+    def validate_format(self, value):
+        """
+        Parquet can only be exported when pyarrow is installed
+        """
+        if value == self.FORMAT_PARQUET and not columnar.is_available():
+            raise serializers.ValidationError("parquet export is not available")
+
+        return value
+
+    def validate_search_after(self, value):
+        """
+        Valid cursor is one handed out as "_search_after" by a previous page
+        """
+        if value and decode_cursor(value) is None:
+            raise serializers.ValidationError("search_after is not a valid cursor")
+
+        return value
+
+    def validate_resume_from(self, value):
+        """
+        Exports can only be resumed when they are in a stable order
+        """
+        if not exports_are_resumable():
+            raise serializers.ValidationError("exports can not be resumed")
+
+        return value
+
     def validate(self, data):
         """
-        Check that from is a multiple of size
+        Check that from is a multiple of size, and resume_from is only used
+        with an export format whose records can be appended. The search term is rewritten or rejected by
+        the query analyzer, which depends on the field searched.
         """
         if data['size'] != 0 and data['frm'] % data['size'] != 0:
             raise serializers.ValidationError("frm is not zero or a multiple of size")
+        if 'resume_from' in data and data['format'] not in RESUMABLE_FORMATS:
+            raise serializers.ValidationError(
+                "resume_from is only valid for csv and ndjson exports")
+        if data.get('search_term'):
+            self._analyze_search_term(data)
         return data
 
+    def _analyze_search_term(self, data):
+        try:
+            analysis = query_analyzer.analyze(data['search_term'],
+                                              data['field'])
+        except query_analyzer.QueryRejected as e:
+            metrics.incr('query_rejected.' + e.reason)
+            raise serializers.ValidationError({'search_term': str(e)})
+
+        metrics.incr('query_accepted')
+        for rewrite in analysis.rewrites:
+            metrics.incr('query_rewritten.' + rewrite)
+        if analysis.term:
+            data['search_term'] = analysis.term
+        else:
+            # Only wildcards, which match everything
+            del data['search_term']
+
 
 class SuggestInputSerializer(serializers.Serializer):
     text = serializers.CharField(max_length=200, required=False)
@@ -130,3 +251,83 @@ class SuggestInputSerializer(serializers.Serializer):
 
 class SuggestFilterInputSerializer(SearchInputSerializer):
     text = serializers.CharField(max_length=100, required=True)
+
+
+def search_input(request, format):
+    """
+    The SearchInputSerializer of a search request in the given format,
+    validated. It is kept on the request, so the throttles, which run before
+    the format is negotiated, and the view share one validation.
+    """
+    if not format or format not in EXPORT_FORMATS:
+        format = 'default'
+    if not hasattr(request, '_search_inputs'):
+        request._search_inputs = {}
+    if format not in request._search_inputs:
+        data = parse_query_params(request.query_params)
+        data['format'] = format
+        serializer = SearchInputSerializer(data=data)
+        serializer.is_valid()
+        request._search_inputs[format] = serializer
+    return request._search_inputs[format]
+
+
+def fingerprint(validated_data):
+    """
+    Canonical key for validated SearchInputSerializer data. Defaults are
+    filled in and list filters sorted, so searches that only differ in
+    parameter order or in spelling out a default share the same key.
+    """
+    params = dict(PARAMS)
+    params.update(validated_data)
+
+    canonical = {}
+    for name, value in params.items():
+        if value is None or value == []:
+            continue
+        if isinstance(value, list):
+            value = sorted(value)
+        elif isinstance(value, datetime.date):
+            value = value.isoformat()
+        canonical[name] = value
+
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True)).hexdigest()
+
+
+# What a search costs Elasticsearch, in default searches (a page of 10 hits
+# with aggregations): the query itself, the aggregations, each hit past the
+# first page, each hit highlighted on every field, each hit skipped to reach
+# the page, and each plain term the search term costs the query analyzer
+_COST_QUERY = 0.5
+_COST_AGGS = 0.5
+_COST_PER_HIT = 0.01
+_COST_PER_ALL_FIELDS_HIGHLIGHT = 0.02
+_COST_PER_SKIPPED_HIT = 0.001
+_COST_PER_TERM = 0.02
+
+
+def search_cost(validated_data):
+    """
+    The estimated cost of a search from its validated SearchInputSerializer
+    data, at least 1 so no search lowers the rate limit. Exports are counted
+    by their own throttles and cost 1.
+    """
+    params = dict(PARAMS)
+    params.update(validated_data)
+    if params['format'] != SearchInputSerializer.FORMAT_DEFAULT:
+        return 1.0
+
+    cost = _COST_QUERY
+    # A cursor page runs no aggregations and skips nothing
+    is_cursor = bool(params.get('search_after'))
+    if not params['no_aggs'] and not is_cursor:
+        cost += _COST_AGGS
+    cost += _COST_PER_HIT * max(0, params['size'] - PARAMS['size'])
+    if not params['no_highlight'] and params['field'] == '_all':
+        cost += _COST_PER_ALL_FIELDS_HIGHLIGHT * params['size']
+    if not is_cursor:
+        cost += _COST_PER_SKIPPED_HIT * params['frm']
+    if params.get('search_term'):
+        cost += _COST_PER_TERM * query_analyzer.analyze(
+            params['search_term'], params['field']).cost
+    return max(1.0, cost)
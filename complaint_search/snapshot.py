@@ -0,0 +1,83 @@
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    """
+    Keeps the dictionary returned by an expensive loader in memory. Once the value is
+    older than max_age it is refreshed on a background thread while callers
+    keep getting the previous value (stale-while-revalidate). Only the very
+    first call waits on the loader.
+    """
+
+    def __init__(self, loader, max_age):
+        self.loader = loader
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded_at = None
+        self._is_refreshing = False
+
+    def age(self):
+        """Seconds since the value was loaded, None if it never was"""
+        if self._loaded_at is None:
+            return None
+        return time.time() - self._loaded_at
+
+    def is_loaded(self):
+        return self._loaded_at is not None
+
+    def get(self):
+        if self._loaded_at is None:
+            self.refresh()
+        elif self.age() > self.max_age:
+            self._refresh_in_background()
+        return dict(self._value)
+
+    def refresh(self):
+        value = self.loader()
+        self.set(value)
+        return value
+
+    def set(self, value):
+        """Store a value that was loaded elsewhere, e.g. in a batched request"""
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self._loaded_at = None
+
+    def after_fork(self):
+        """
+        Empties the snapshot in a forked process, where the thread that was
+        refreshing it, and maybe holding its lock, no longer exists
+        """
+        self._lock = threading.Lock()
+        self._is_refreshing = False
+        self.reset()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._is_refreshing:
+                return
+            self._is_refreshing = True
+
+        thread = threading.Thread(target=self._background_refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            # Keep serving the previous value, the growing age shows up in
+            # the metrics
+            log.exception('Background refresh failed')
+        finally:
+            self._is_refreshing = False
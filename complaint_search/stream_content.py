@@ -1,3 +1,96 @@
+import os
+import time
+import logging
+from complaint_search import metrics
+
+# Size of the blocks read from Elasticsearch and written to the client
+_BLOCK_SIZE = int(os.environ.get('EXPORT_BLOCK_SIZE', '65536'))
+
+
+def _close(content):
+    # Passes Django's close() on to the content being wrapped
+    if hasattr(content, 'close'):
+        content.close()
+
+
+class StreamRawContent(object):
+    """
+    Reads a raw urllib3 response in blocks of block_size bytes instead of
+    one small chunk at a time, decoded when Elasticsearch compressed it
+    """
+
+    def __init__(self, raw, block_size=_BLOCK_SIZE):
+        self.raw = raw
+        self.blocks = raw.stream(block_size, decode_content=True)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.raw is None:
+            raise StopIteration
+        return next(self.blocks)
+
+    def close(self):
+        # A download that stopped early closes the connection, which the
+        # pool then replaces, rather than leaving it half read
+        if self.raw is not None:
+            self.raw.close()
+            if hasattr(self.raw, 'release_conn'):
+                self.raw.release_conn()
+            self.raw = None
+
+
+class StreamBlockContent(object):
+    """
+    Joins small pieces of content into blocks of at least block_size bytes,
+    so each WSGI write sends a block, and reports the export's throughput
+    """
+
+    def __init__(self, content, block_size=_BLOCK_SIZE):
+        self.content = iter(content)
+        self.block_size = block_size
+        self.bytes_sent = 0
+        self.started = None
+        self.is_reported = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.started is None:
+            self.started = time.time()
+
+        pieces = []
+        size = 0
+        while size < self.block_size:
+            try:
+                piece = next(self.content)
+            except StopIteration:
+                break
+            pieces.append(piece)
+            size += len(piece)
+
+        if not pieces:
+            self.close()
+            raise StopIteration
+        self.bytes_sent += size
+        return pieces[0] if len(pieces) == 1 else "".join(pieces)
+
+    def close(self):
+        # Called by Django once the response is done, finished or not
+        _close(self.content)
+        if self.is_reported or self.started is None:
+            return
+        self.is_reported = True
+        seconds = time.time() - self.started
+        metrics.incr('export_bytes', self.bytes_sent)
+        metrics.incr('export_seconds', seconds)
+        logging.getLogger(__name__).info(
+            'Export sent %d bytes in %.1fs (%d bytes/s)', self.bytes_sent,
+            seconds, self.bytes_sent / seconds if seconds else 0)
+
+
 class StreamCSVContent(object):
 
     def __init__(self, header, content):
@@ -15,67 +108,110 @@ class StreamCSVContent(object):
         else:
             return next(self.content)
 
+    def close(self):
+        _close(self.content)
+
 
 class StreamJSONContent(object):
+    """
+    Turns the bulk format of the data format plugin (an action line followed
+    by the document on the next line) into a JSON array of the documents.
+
+    Chunks are appended to one bytearray and only the bytes that have not
+    been searched for a newline yet are scanned, so a record split over many
+    chunks costs O(length) instead of being copied on every chunk. Records
+    are returned in batches of at least batch_size bytes.
+    """
 
-    def __init__(self, content):
+    def __init__(self, content, batch_size=_BLOCK_SIZE):
         self.content = content
-        self.complaint_in_progress = ""
+        self.batch_size = batch_size
+        self.buffer = bytearray()
+        # Start of the line in progress and where the newline search resumes
+        self.line_start = 0
+        self.scan_start = 0
+        self.is_action_line = True
         self.is_streaming_started = False
         self.is_streaming_stopped = False
 
-    def get_next_complaint(self):
-        self.complaint_in_progress = self.complaint_in_progress.lstrip()
-        # see if first line is reached
-        try:
-            first_eol_index = self.complaint_in_progress.index('\n')
-
-            # see if we have 2nd completed line, and that's the complaint we want to return
-            # assuming at the EOF there's also a '\n' as seen from data format
-            # plugin so far
-            second_eol_index = self.complaint_in_progress.index(
-                '\n', first_eol_index + 1)
-
-            complaint = self.complaint_in_progress[
-                first_eol_index + 1:second_eol_index + 1].strip()
-            # save the rest for next iteration
-            self.complaint_in_progress = self.complaint_in_progress[
-                second_eol_index + 1:]
-            return complaint
-        except ValueError:
-            # This means cannot find two \n, complaint is not ready, need more
-            # data
-            return None
+    def _read_records(self, records):
+        """Moves every complete document line of the buffer to records"""
+        size = 0
+        while True:
+            eol = self.buffer.find(b'\n', self.scan_start)
+            if eol < 0:
+                self.scan_start = len(self.buffer)
+                break
+
+            line = bytes(self.buffer[self.line_start:eol]).strip()
+            self.line_start = self.scan_start = eol + 1
+            if not line:
+                continue
+            if not self.is_action_line:
+                records.append(line)
+                size += len(line)
+            self.is_action_line = not self.is_action_line
+
+        # Drop consumed bytes once they are the larger part of the buffer,
+        # which keeps both memory and the copying linear
+        if self.line_start > len(self.buffer) // 2:
+            del self.buffer[:self.line_start]
+            self.scan_start -= self.line_start
+            self.line_start = 0
+
+        return size
 
     def __iter__(self):
         return self
 
-    def next(self):
-        while True:
-            if not self.is_streaming_started:
-                # This is the beginning
-                self.is_streaming_started = True
-                return "["
+    def _next_records(self):
+        """The next batch of records, and whether the content is done"""
+        if self.is_streaming_stopped:
+            raise StopIteration
+
+        records = []
+        size = 0
+        while size < self.batch_size:
             try:
-                next_chunk = next(self.content)
-                self.complaint_in_progress += next_chunk
-                # peek ahead, it will raise StopIteration if no more chunk
-                next2_chunk = next(self.content)
-                complaint = self.get_next_complaint()
-                self.complaint_in_progress += next2_chunk
-                if complaint and self.complaint_in_progress.strip():
-                    return complaint + ","
-                elif complaint and not self.complaint_in_progress.strip():
-                    return complaint
+                self.buffer.extend(next(self.content))
             except StopIteration:
-                complaint = self.get_next_complaint()
-                if complaint and not self.complaint_in_progress.strip():
-                    return complaint
-                elif complaint and self.complaint_in_progress.strip():
-                    return complaint + ","
-                elif not self.is_streaming_stopped:
-                    # This is the end
-                    self.is_streaming_stopped = True
-                    return "]"
-                else:
-                    raise StopIteration
+                # the last line may not end with a newline
+                self.buffer.extend(b'\n')
+                self._read_records(records)
+                self.is_streaming_stopped = True
+                return records, True
+            size += self._read_records(records)
+        return records, False
+
+    def next(self):
+        records, is_content_done = self._next_records()
+
+        batch = ",".join(records)
+        if not self.is_streaming_started:
+            # This is the beginning
+            self.is_streaming_started = True
+            batch = "[" + batch
+        elif records:
+            batch = "," + batch
+
+        if is_content_done:
+            # This is the end
+            batch += "]"
+
+        return batch
+
+    def close(self):
+        _close(self.content)
+
+
+class StreamNDJSONContent(StreamJSONContent):
+    """
+    The documents of the data format plugin's bulk format, one per line.
+    Lines are passed through as they are, only the action lines are dropped.
+    """
+
+    def next(self):
+        records, is_content_done = self._next_records()
+        if not records and is_content_done:
+            raise StopIteration
+        return "\n".join(records) + "\n"
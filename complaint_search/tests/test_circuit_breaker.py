@@ -0,0 +1,104 @@
+from django.test import TestCase
+from elasticsearch import ConnectionError, TransportError
+from complaint_search import metrics
+from complaint_search.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpen,
+    is_failure,
+)
+import mock
+
+
+def fail():
+    raise ConnectionError('N/A', 'refused', None)
+
+
+class IsFailureTests(TestCase):
+
+    def test_is_failure(self):
+        self.assertTrue(is_failure(ConnectionError('N/A', 'refused', None)))
+        self.assertTrue(is_failure(TransportError(503, 'unavailable')))
+        self.assertFalse(is_failure(TransportError(400, 'parse')))
+        self.assertFalse(is_failure(TransportError('N/A', 'error')))
+        self.assertFalse(is_failure(CircuitOpen()))
+        self.assertFalse(is_failure(ValueError()))
+
+
+@mock.patch('complaint_search.circuit_breaker.time')
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.breaker = CircuitBreaker(max_failures=2, slow_seconds=5,
+                                      reset_seconds=30, half_open_calls=1)
+
+    def trip(self):
+        for _ in range(2):
+            self.assertRaises(ConnectionError, self.breaker.call, fail)
+
+    def test_opens_after_failures(self, mock_time):
+        mock_time.time.return_value = 100
+        self.assertEqual(1, self.breaker.call(lambda: 1))
+        self.assertRaises(ConnectionError, self.breaker.call, fail)
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.assertRaises(ConnectionError, self.breaker.call, fail)
+        self.assertEqual(OPEN, self.breaker.state)
+
+        function = mock.MagicMock()
+        self.assertRaises(CircuitOpen, self.breaker.call, function)
+        function.assert_not_called()
+        self.assertEqual(1, metrics.get_metrics()['circuit_opened'])
+        self.assertEqual(1, metrics.get_metrics()['circuit_rejected'])
+
+    def test_success_resets_failures(self, mock_time):
+        mock_time.time.return_value = 100
+        self.assertRaises(ConnectionError, self.breaker.call, fail)
+        self.breaker.call(lambda: 1)
+        self.assertRaises(ConnectionError, self.breaker.call, fail)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_request_errors_do_not_count(self, mock_time):
+        mock_time.time.return_value = 100
+
+        def bad_request():
+            raise TransportError(400, 'parse')
+        for _ in range(3):
+            self.assertRaises(TransportError, self.breaker.call, bad_request)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_slow_calls_count(self, mock_time):
+        mock_time.time.side_effect = [100, 106, 200, 206, 206]
+        self.breaker.call(lambda: 1)
+        self.breaker.call(lambda: 1)
+        self.assertEqual(OPEN, self.breaker.state)
+
+    def test_half_open_probe_closes(self, mock_time):
+        mock_time.time.return_value = 100
+        self.trip()
+        mock_time.time.return_value = 131
+        self.assertEqual(1, self.breaker.call(lambda: 1))
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_half_open_probe_reopens(self, mock_time):
+        mock_time.time.return_value = 100
+        self.trip()
+        mock_time.time.return_value = 131
+        self.assertRaises(ConnectionError, self.breaker.call, fail)
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertRaises(CircuitOpen, self.breaker.call, lambda: 1)
+
+    def test_half_open_limits_probes(self, mock_time):
+        mock_time.time.return_value = 100
+        self.trip()
+        mock_time.time.return_value = 131
+
+        def probe():
+            self.assertEqual(HALF_OPEN, self.breaker.state)
+            # A second request while the probe is running is turned away
+            self.assertRaises(CircuitOpen, self.breaker.call, lambda: 1)
+            return 1
+        self.assertEqual(1, self.breaker.call(probe))
+        self.assertEqual(CLOSED, self.breaker.state)
@@ -0,0 +1,79 @@
+from django.test import TestCase
+from unittest import skipUnless
+from datetime import date
+from io import BytesIO
+import mock
+from complaint_search import columnar
+from complaint_search.defaults import CSV_ORDERED_HEADERS
+
+
+def hit(**source):
+    return {"_source": source}
+
+
+class ColumnarTests(TestCase):
+
+    def test_columns(self):
+        self.assertEqual(len(CSV_ORDERED_HEADERS) + 1, len(columnar.COLUMNS))
+        self.assertEqual("date_received", columnar.COLUMNS[0])
+        self.assertIn("date_sent_to_company", columnar.COLUMNS)
+        self.assertEqual("has_narrative", columnar.COLUMNS[-1])
+
+    def test_to_date(self):
+        self.assertEqual(date(2017, 4, 14),
+                         columnar._to_date("2017-04-14T12:00:00"))
+        self.assertIsNone(columnar._to_date(None))
+
+    def test_to_bool(self):
+        self.assertTrue(columnar._to_bool("Yes"))
+        self.assertFalse(columnar._to_bool("No"))
+        self.assertTrue(columnar._to_bool(True))
+        self.assertTrue(columnar._to_bool(1))
+        self.assertIsNone(columnar._to_bool(None))
+
+    def test_to_string(self):
+        self.assertEqual(u"Older American, Servicemember",
+                         columnar._to_string(["Older American",
+                                              "Servicemember"]))
+        self.assertEqual(u"12345", columnar._to_string(12345))
+        self.assertIsNone(columnar._to_string(None))
+
+    @skipUnless(columnar.is_available(), "pyarrow is not installed")
+    def test_parquet_stream(self):
+        import pyarrow.parquet as pq
+        pages = [
+            [hit(complaint_id="1", product="Mortgage", timely="Yes",
+                 date_received="2017-04-14T12:00:00", has_narrative=True)],
+            [hit(complaint_id="2", product="Mortgage", timely="No")],
+        ]
+        data = "".join(columnar.parquet_stream(iter(pages)))
+        table = pq.read_table(BytesIO(data))
+        self.assertEqual(2, table.num_rows)
+        self.assertEqual(columnar.COLUMNS, table.schema.names)
+        self.assertEqual([True, False], table.column("timely").to_pylist())
+        self.assertEqual(["1", "2"], table.column("complaint_id").to_pylist())
+
+    @skipUnless(columnar.is_available(), "pyarrow is not installed")
+    def test_parquet_stream__empty(self):
+        import pyarrow.parquet as pq
+        data = "".join(columnar.parquet_stream(iter([])))
+        self.assertEqual(0, pq.read_table(BytesIO(data)).num_rows)
+
+    @skipUnless(columnar.is_available(), "pyarrow is not installed")
+    def test_parquet_stream__row_groups(self):
+        import pyarrow.parquet as pq
+        # Each row group has its own companies and products
+        pages = [[hit(complaint_id=str(i), product="Product {}".format(i),
+                      company="Company {}".format(i % 2))]
+                 for i in range(5)]
+        with mock.patch("complaint_search.columnar._ROW_GROUP_SIZE", 2):
+            data = "".join(columnar.parquet_stream(iter(pages)))
+        parquet = pq.ParquetFile(BytesIO(data))
+        self.assertEqual(3, parquet.num_row_groups)
+        table = parquet.read()
+        self.assertEqual(["Product {}".format(i) for i in range(5)],
+                         table.column("product").to_pylist())
+        self.assertEqual("Company 0", table.column("company").to_pylist()[4])
+        product = columnar.COLUMNS.index("product")
+        self.assertIn("PLAIN_DICTIONARY", parquet.metadata.row_group(0)
+                      .column(product).encodings)
@@ -0,0 +1,155 @@
+from django.test import TestCase
+from complaint_search.es_builders import (
+    AggregationBuilder,
+    PostFilterBuilder,
+    SearchBuilder
+)
+
+
+class AggregationBuilderTests(TestCase):
+
+    def test_agg_fields__exclude(self):
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1"])
+        builder.add_exclude(["company", "zip_code"])
+        fields = builder.agg_fields()
+        self.assertIn("company", fields)
+        self.assertNotIn("zip_code", fields)
+        self.assertEqual(len(AggregationBuilder._AGG_FIELDS) - 1, len(fields))
+
+    def test_dependencies__own_filter_ignored(self):
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 2", "Bank 1"], state=["VA"],
+                    date_received_min="2017-01-01", size=10)
+        self.assertEqual({
+            "date_received_min": "2017-01-01",
+            "state": ["VA"]
+        }, builder.dependencies("company"))
+        self.assertEqual({
+            "date_received_min": "2017-01-01",
+            "company": ["Bank 1", "Bank 2"]
+        }, builder.dependencies("state"))
+
+    def test_dependencies__exclude(self):
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1"])
+        builder.add_exclude(["company"])
+        self.assertEqual({"company": ["Bank 1"]},
+                         builder.dependencies("company"))
+
+    def test_dependencies__empty_filter(self):
+        builder = AggregationBuilder()
+        builder.add(company=[])
+        self.assertEqual({}, builder.dependencies("state"))
+
+    def test_build_grouped__no_filter_selected(self):
+        builder = AggregationBuilder()
+        builder.add(date_received_min="2017-01-01", search_term="test")
+        grouped = builder.build_grouped()
+        self.assertEqual(1, len(grouped))
+        group = grouped.values()[0]
+        self.assertEqual(set(AggregationBuilder._AGG_FIELDS),
+                         set(group["aggs"]))
+
+    def test_build_grouped__same_filters_as_build(self):
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1"], state=["VA"],
+                    date_received_min="2017-01-01")
+        builder.add_exclude(["zip_code"])
+        ungrouped = builder.build()
+        grouped = builder.build_grouped()
+        # company and state each drop their own filter, the rest share one
+        self.assertEqual(3, len(grouped))
+        self.assertIn("company", grouped)
+        self.assertIn("state", grouped)
+
+        placed = {}
+        for group in grouped.values():
+            for field_name, field_agg in group["aggs"].items():
+                placed[field_name] = {
+                    "filter": group["filter"],
+                    "aggs": {field_name: field_agg}
+                }
+        self.assertEqual(ungrouped, placed)
+
+    def test_split_grouped__buckets_unchanged(self):
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1"])
+        ungrouped_res = {}
+        for field_name in builder.agg_fields():
+            doc_count = 10 if field_name == "company" else 4
+            ungrouped_res[field_name] = {
+                "doc_count": doc_count,
+                field_name: {
+                    "doc_count_error_upper_bound": 0,
+                    "sum_other_doc_count": 0,
+                    "buckets": [{"key": field_name + " 1",
+                                 "doc_count": doc_count}]
+                }
+            }
+
+        # What Elasticsearch returns for the grouped request, every facet in
+        # a group matches the same documents
+        grouped_res = {}
+        for name, group in builder.build_grouped().items():
+            grouped_res[name] = {"doc_count": None}
+            for field_name in group["aggs"]:
+                grouped_res[name]["doc_count"] = \
+                    ungrouped_res[field_name]["doc_count"]
+                grouped_res[name][field_name] = \
+                    ungrouped_res[field_name][field_name]
+
+        self.assertEqual(ungrouped_res,
+                         AggregationBuilder.split_grouped(grouped_res))
+
+
+class PostFilterBuilderTests(TestCase):
+
+    def test_build__nothing_faceted(self):
+        builder = PostFilterBuilder()
+        builder.add(company=["Bank 1"], date_received_min="2017-01-01")
+        self.assertEqual([], builder.build()["bool"]["filter"])
+        self.assertEqual(2, len(builder.build_query_filter()))
+
+    def test_build__faceted_field_kept_in_post_filter(self):
+        builder = PostFilterBuilder()
+        builder.add(company=["Bank 1"], state=["VA"],
+                    date_received_min="2017-01-01")
+        builder.add_faceted(["company"])
+        self.assertEqual([
+            {"bool": {"should": {"terms": {"company.raw": ["Bank 1"]}}}}
+        ], builder.build()["bool"]["filter"])
+        query_filter = builder.build_query_filter()
+        self.assertEqual(2, len(query_filter))
+        self.assertIn("range", query_filter[0])
+        self.assertIn({"bool": {"should": {"terms": {"state": ["VA"]}}}},
+                      query_filter)
+
+
+class SearchBuilderTests(TestCase):
+
+    def test_build__no_search_term_all_fields(self):
+        builder = SearchBuilder()
+        builder.add(field="_all")
+        self.assertEqual({"match_all": {}}, builder.build()["query"])
+
+    def test_build__search_term_relevance_scored(self):
+        builder = SearchBuilder()
+        builder.add(search_term="bank", sort="relevance_desc")
+        self.assertIn("match", builder.build()["query"])
+
+    def test_build__search_term_date_sort_not_scored(self):
+        builder = SearchBuilder()
+        builder.add(search_term="bank OR loan", sort="created_date_asc")
+        query = builder.build()["query"]
+        self.assertEqual(["constant_score"], query.keys())
+        self.assertEqual("bank OR loan", query["constant_score"]["filter"][
+            "query_string"]["query"])
+
+    def test_build__search_term_expansions_capped(self):
+        builder = SearchBuilder()
+        builder.add(search_term="mortga*")
+        query = builder.build()["query"]["query_string"]
+        self.assertFalse(query["allow_leading_wildcard"])
+        self.assertEqual(10, query["fuzzy_max_expansions"])
+        self.assertEqual(1000, query["max_determinized_states"])
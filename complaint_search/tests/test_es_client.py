@@ -0,0 +1,87 @@
+from django.test import TestCase
+from elasticsearch import ConnectionError
+from elasticsearch.connection import Urllib3HttpConnection
+from complaint_search import metrics
+from complaint_search.es_client import (
+    MeteredConnection,
+    create_client,
+    parse_hosts,
+    pool_stats,
+)
+import mock
+
+
+class ParseHostsTests(TestCase):
+
+    def test_parse_hosts(self):
+        self.assertEqual([{"host": "es1", "port": 9200},
+                          {"host": "es2", "port": 9201}],
+                         parse_hosts("es1, es2:9201,"))
+
+
+@mock.patch("complaint_search.es_client.HOSTS",
+            [{"host": "es1", "port": 9200}, {"host": "es2", "port": 9200}])
+@mock.patch("complaint_search.es_client._ES_MAXSIZE", 3)
+class CreateClientTests(TestCase):
+
+    def test_create_client(self):
+        client = create_client(http_auth=("user", "password"))
+        connections = client.transport.connection_pool.connections
+        # The connection pool shuffles the nodes
+        self.assertEqual(["http://es1:9200", "http://es2:9200"],
+                         sorted(connection.host for connection in connections))
+        for connection in connections:
+            self.assertTrue(isinstance(connection, MeteredConnection))
+            self.assertEqual(3, connection.pool.pool.maxsize)
+            self.assertIn("authorization", connection.headers)
+            self.assertNotIn("accept-encoding", connection.headers)
+
+    @mock.patch("complaint_search.es_client._ES_HTTP_COMPRESS", True)
+    @mock.patch("complaint_search.es_client._ES_RETRY_ON_TIMEOUT", True)
+    def test_create_client_options(self):
+        client = create_client()
+        self.assertTrue(client.transport.retry_on_timeout)
+        self.assertIsNone(client.transport.sniffer_timeout)
+        for connection in client.transport.connection_pool.connections:
+            self.assertEqual("gzip,deflate",
+                             connection.headers["accept-encoding"])
+
+    def test_pool_stats(self):
+        self.assertEqual({"in_use": 0, "size": 0}, pool_stats(None))
+        client = create_client()
+        connection = client.transport.connection_pool.connections[0]
+        connection.pool._get_conn()
+        self.assertEqual({"in_use": 1, "size": 6}, pool_stats(client))
+
+
+@mock.patch.object(Urllib3HttpConnection, 'perform_request')
+class MeteredConnectionTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.connection = MeteredConnection(host="es1", maxsize=1)
+
+    def test_perform_request(self, mock_request):
+        mock_request.return_value = (200, {}, "{}")
+        self.assertEqual((200, {}, "{}"),
+                         self.connection.perform_request("GET", "/"))
+        stats = metrics.get_metrics()
+        self.assertEqual(1, stats["es_requests.es1:9200"])
+        self.assertIn("es_request_seconds.es1:9200", stats)
+        self.assertNotIn("es_request_errors.es1:9200", stats)
+        self.assertNotIn("es_pool_saturated.es1:9200", stats)
+
+    def test_perform_request_error(self, mock_request):
+        mock_request.side_effect = ConnectionError("N/A", "refused", None)
+        self.assertRaises(ConnectionError, self.connection.perform_request,
+                          "GET", "/")
+        stats = metrics.get_metrics()
+        self.assertEqual(1, stats["es_requests.es1:9200"])
+        self.assertEqual(1, stats["es_request_errors.es1:9200"])
+
+    def test_perform_request_saturated(self, mock_request):
+        mock_request.return_value = (200, {}, "{}")
+        self.connection.pool._get_conn()
+        self.assertEqual(1, self.connection.in_use())
+        self.connection.perform_request("GET", "/")
+        self.assertEqual(1, metrics.get_metrics()["es_pool_saturated.es1:9200"])
@@ -5,7 +5,17 @@ from complaint_search.es_interface import (
     _COMPLAINT_DOC_TYPE,
     _ES_USER,
     _ES_PASSWORD,
+    _FACET_CACHE,
+    _META_BODY,
+    _META_SNAPSHOT,
+    _cached_aggs,
     _get_meta,
+    _get_pool,
+    _BREAKER,
+    Deadline,
+    _get_session,
+    _export_pages,
+    encode_cursor,
     search,
     suggest,
     filter_suggest,
@@ -19,18 +29,30 @@ from complaint_search.defaults import (
     CSV_ORDERED_HEADERS,
     EXPORT_FORMATS
 )
+from complaint_search import (
+    es_interface, export_checkpoints, metrics, response_cache
+)
+from complaint_search.circuit_breaker import CircuitOpen
 from complaint_search.stream_content import (
     StreamCSVContent,
     StreamJSONContent,
+    StreamNDJSONContent,
+    StreamRawContent,
 )
 from datetime import datetime
-from elasticsearch import Elasticsearch
+from elasticsearch import ConnectionTimeout, Elasticsearch, TransportError
 from collections import namedtuple
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import requests
+import socket
 import os
 import copy
 import urllib
 import json
+import time
+import Queue
+import threading
 import deep
 import mock
 
@@ -53,7 +75,70 @@ def load(shortName):
         return json.load(f)
 
 
+def group_aggs(aggs):
+    # Facets with the same filter share one filter aggregation
+    groups = []
+    for field_name in sorted(aggs):
+        for group in groups:
+            if group["filter"] == aggs[field_name]["filter"]:
+                group["aggs"].update(aggs[field_name]["aggs"])
+                break
+        else:
+            groups.append({
+                "filter": aggs[field_name]["filter"],
+                "aggs": dict(aggs[field_name]["aggs"])
+            })
+    return {",".join(sorted(group["aggs"])): group for group in groups}
+
+
+def split_aggs(body):
+    # search() sends the aggregations as their own size 0 request, while the
+    # expected results hold the combined body
+    hits_body = copy.deepcopy(body)
+    aggs = group_aggs(hits_body.pop("aggs"))
+    return hits_body, {"size": 0, "query": hits_body["query"], "aggs": aggs}
+
+
+def mock_aggs_response(**kwargs):
+    return {"aggregations": {
+        name: dict({"doc_count": 1},
+                   **{field: {"buckets": []} for field in group["aggs"]})
+        for name, group in kwargs["body"]["aggs"].items()
+    }}
+
+
+# The timeouts of a search sent within its deadline
+DEADLINE = {"request_timeout": mock.ANY, "timeout": mock.ANY}
+
+
+class DeferredResult(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def get(self, timeout=None):
+        return self.func(*self.args)
+
+
+class DeferredPool(object):
+    # Runs the work when its result is asked for, which keeps the order of
+    # the Elasticsearch calls in these tests deterministic
+
+    def apply_async(self, func, args=()):
+        return DeferredResult(func, args)
+
+
 class EsInterfaceTest_Search(TestCase):
+
+    def setUp(self):
+        _META_SNAPSHOT.set(copy.deepcopy(self.MOCK_SEARCH_RESULT["_meta"]))
+        _FACET_CACHE.clear()
+        patcher = mock.patch("complaint_search.es_interface._get_pool",
+                             return_value=DeferredPool())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     # -------------------------------------------------------------------------
     # Helper Attributes
     # -------------------------------------------------------------------------
@@ -67,22 +152,34 @@ class EsInterfaceTest_Search(TestCase):
         },
         {
             "aggregations": {
-                "max_date": {
-                    "value_as_string": "2017-01-01"
-                },
-                "max_indexed_date": {
-                    "value_as_string": "2017-01-02"
-                },
-                "max_narratives": {
-                    "max_date": {
-                        "value": 1483400000.0
-                        # 150970000.0 for November 3rd 2017
-                    }
+                "product,state": {
+                    "doc_count": 4,
+                    "product": {"buckets": []}
                 }
             }
         }
     ]
 
+    MOCK_META_RETURN_VALUE = {
+        "hits": {
+            "total": 100
+        },
+        "aggregations": {
+            "max_date": {
+                "value_as_string": "2017-01-01"
+            },
+            "max_indexed_date": {
+                "value_as_string": "2017-01-02"
+            },
+            "max_narratives": {
+                "max_date": {
+                    "value": 1483400000.0
+                    # 150970000.0 for November 3rd 2017
+                }
+            }
+        }
+    }
+
     MOCK_COUNT_RETURN_VALUE = {"count": 100}
 
     MOCK_SEARCH_RESULT = {
@@ -91,6 +188,12 @@ class EsInterfaceTest_Search(TestCase):
         "hits": {
             "hits": [0, 1, 2, 3]
         },
+        "aggregations": {
+            "product": {
+                "doc_count": 4,
+                "product": {"buckets": []}
+            }
+        },
         '_meta': {
             'total_record_count': 100,
             'last_indexed': '2017-01-02',
@@ -119,7 +222,7 @@ class EsInterfaceTest_Search(TestCase):
     @mock.patch.object(Elasticsearch, 'search')
     @mock.patch.object(Elasticsearch, 'count')
     def test_get_meta(self, mock_count, mock_search, mock_now):
-        mock_search.return_value = self.MOCK_SEARCH_SIDE_EFFECT[1]
+        mock_search.return_value = self.MOCK_META_RETURN_VALUE
         mock_count.return_value = self.MOCK_COUNT_RETURN_VALUE
         mock_now.return_value = datetime(2017, 1, 3)
 
@@ -130,7 +233,7 @@ class EsInterfaceTest_Search(TestCase):
     @mock.patch.object(Elasticsearch, 'search')
     @mock.patch.object(Elasticsearch, 'count')
     def test_get_meta_data_stale(self, mock_count, mock_search, mock_now):
-        mock_search.return_value = self.MOCK_SEARCH_SIDE_EFFECT[1]
+        mock_search.return_value = self.MOCK_META_RETURN_VALUE
         mock_count.return_value = self.MOCK_COUNT_RETURN_VALUE
         mock_now.return_value = datetime(2017, 11, 1)
 
@@ -145,7 +248,7 @@ class EsInterfaceTest_Search(TestCase):
     @mock.patch.object(Elasticsearch, 'search')
     @mock.patch.object(Elasticsearch, 'count')
     def test_get_meta_data_issue(self, mock_count, mock_search, mock_flag_enabled, mock_now):
-        mock_search.return_value = self.MOCK_SEARCH_SIDE_EFFECT[1]
+        mock_search.return_value = self.MOCK_META_RETURN_VALUE
         mock_count.return_value = self.MOCK_COUNT_RETURN_VALUE
         mock_now.return_value = datetime(2017, 1, 1)
         mock_flag_enabled.return_value = True
@@ -168,11 +271,12 @@ class EsInterfaceTest_Search(TestCase):
             self.MOCK_SEARCH_RESULT["_meta"])
         mock_scroll.return_value = self.MOCK_SEARCH_SIDE_EFFECT[0]
         body = load("search_no_param__valid")
+        body, aggs_body = split_aggs(body)
         res = search()
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -180,6 +284,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         mock_rget.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
@@ -197,11 +302,12 @@ class EsInterfaceTest_Search(TestCase):
             self.MOCK_SEARCH_RESULT["_meta"])
         mock_scroll.return_value = self.MOCK_SEARCH_SIDE_EFFECT[0]
         body = load("search_agg_exclude__valid")
+        body, aggs_body = split_aggs(body)
         res = search(agg_exclude=['zip_code'])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -209,10 +315,24 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         mock_rget.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
+    @mock.patch.object(Elasticsearch, 'search')
+    @mock.patch('requests.Session.get')
+    @mock.patch('urllib.urlencode')
+    def test_search_with_format_ndjson__valid(self, mock_urlencode,
+                                              mock_rget, mock_search):
+        RGet = namedtuple('RGet', 'ok, raw')
+        mock_rget.return_value = RGet(ok=True, raw=mock.MagicMock())
+        res = search(format="ndjson")
+        self.assertTrue(isinstance(res, StreamNDJSONContent))
+        self.assertTrue(isinstance(res.content, StreamRawContent))
+        self.assertEqual("json", mock_urlencode.call_args[0][0]["format"])
+        mock_search.assert_not_called()
+
     @mock.patch("complaint_search.es_interface._ES_URL", "ES_URL")
     @mock.patch("complaint_search.es_interface._ES_USER", "ES_USER")
     @mock.patch("complaint_search.es_interface._ES_PASSWORD", "ES_PASSWORD")
@@ -226,15 +346,16 @@ class EsInterfaceTest_Search(TestCase):
                                             mock_jdump, mock_rget, mock_search):
         mock_search.return_value = 'OK'
         mock_jdump.return_value = 'JDUMPS_OK'
-        RGet = namedtuple('RGet', 'ok, iter_content')
-        mock_rget.return_value = RGet(
-            ok=True, iter_content=mock.MagicMock(return_value='RGET_OK'))
+        RGet = namedtuple('RGet', 'ok, raw')
+        mock_rget.return_value = RGet(ok=True, raw=mock.MagicMock())
         body = load("search_with_format_json__valid")
         format = 'json'
         res = search(format=format)
         expected_res = 'RGET_OK'
         self.assertTrue(isinstance(res, StreamJSONContent))
-        self.assertEqual(res.content, 'RGET_OK')
+        self.assertTrue(isinstance(res.content, StreamRawContent))
+        self.assertIs(res.content.raw, mock_rget.return_value.raw)
+        self.assertTrue(res.content.raw.decode_content)
 
         self.assertEqual(len(mock_jdump.call_args), 2)
         self.assertEqual(1, len(mock_jdump.call_args[0]))
@@ -260,6 +381,7 @@ class EsInterfaceTest_Search(TestCase):
 
         mock_search.assert_not_called()
         self.assertEqual(1, mock_rget.call_count)
+        self.assertEqual((5, 300), mock_rget.call_args[1]["timeout"])
 
     @mock.patch("complaint_search.es_interface._ES_URL", "ES_URL")
     @mock.patch("complaint_search.es_interface._ES_USER", "ES_USER")
@@ -273,9 +395,8 @@ class EsInterfaceTest_Search(TestCase):
     def test_search_with_format_csv__valid(self, mock_urlencode, mock_jdump, mock_rget, mock_search):
         mock_search.return_value = 'OK'
         mock_jdump.return_value = 'JDUMPS_OK'
-        RGet = namedtuple('RGet', 'ok, iter_content')
-        mock_rget.return_value = RGet(
-            ok=True, iter_content=mock.MagicMock(return_value='RGET_OK'))
+        RGet = namedtuple('RGet', 'ok, raw')
+        mock_rget.return_value = RGet(ok=True, raw=mock.MagicMock())
         body = load("search_with_format_csv__valid")
         format = 'csv'
         res = search(format=format)
@@ -285,7 +406,8 @@ class EsInterfaceTest_Search(TestCase):
                                    for header in CSV_ORDERED_HEADERS.values()) + "\n"
         self.assertTrue(isinstance(res, StreamCSVContent))
         self.assertEqual(res.header, expected_header)
-        self.assertEqual(res.content, 'RGET_OK')
+        self.assertTrue(isinstance(res.content, StreamRawContent))
+        self.assertIs(res.content.raw, mock_rget.return_value.raw)
 
         self.assertEqual(len(mock_jdump.call_args), 2)
         self.assertEqual(1, len(mock_jdump.call_args[0]))
@@ -324,13 +446,14 @@ class EsInterfaceTest_Search(TestCase):
             self.MOCK_SEARCH_RESULT["_meta"])
         mock_scroll.return_value = self.MOCK_SEARCH_SIDE_EFFECT[0]
         body = load("search_with_field__valid")
+        body, aggs_body = split_aggs(body)
         res = search(field="test_field")
         # print "MOCK CALL ARGS LIST: "
         # print json.dumps(mock_search.call_args_list)
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -339,6 +462,7 @@ class EsInterfaceTest_Search(TestCase):
             print "body"
         self.assertIsNone(deep.diff(act_body, body))
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -354,11 +478,12 @@ class EsInterfaceTest_Search(TestCase):
             self.MOCK_SEARCH_RESULT["_meta"])
         mock_scroll.return_value = self.MOCK_SEARCH_SIDE_EFFECT[0]
         body = load("search_with_field_all__valid")
+        body, aggs_body = split_aggs(body)
         res = search(field="_all")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -367,6 +492,7 @@ class EsInterfaceTest_Search(TestCase):
 
         self.assertIsNone(deep.diff(act_body, body))
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -390,14 +516,16 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_size__valid")
+        body, aggs_body = split_aggs(body)
         res = search(size=40)
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -411,21 +539,165 @@ class EsInterfaceTest_Search(TestCase):
         mock_count.return_value = self.MOCK_COUNT_RETURN_VALUE
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
-        mock_scroll.side_effect = copy.deepcopy(self.MOCK_SCROLL_SIDE_EFFECT)
         body = load("search_with_frm__valid")
+        body, aggs_body = split_aggs(body)
         res = search(frm=20)
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
-        self.assertEqual(mock_scroll.call_count, 2)
-        search_result = copy.deepcopy(self.MOCK_SEARCH_RESULT)
-        search_result['hits'][
-            'hits'] = self.MOCK_SCROLL_SIDE_EFFECT[1]['hits']['hits']
-        self.assertDictEqual(search_result, res)
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
+        mock_scroll.assert_not_called()
+        self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
+
+    @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+    @mock.patch("complaint_search.es_interface._get_meta")
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_search_meta_from_snapshot(self, mock_search, mock_get_meta):
+        mock_search.side_effect = copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT) + \
+            [copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT[0]), {"aggregations": {}}]
+        search()
+        res = search()
+        mock_get_meta.assert_not_called()
+        self.assertEqual(4, mock_search.call_count)
+        self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
+
+    @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+    @mock.patch("complaint_search.es_interface._COMPLAINT_DOC_TYPE", "DOC_TYPE")
+    @mock.patch("complaint_search.es_interface._get_now")
+    @mock.patch.object(Elasticsearch, 'search')
+    @mock.patch.object(Elasticsearch, 'count')
+    @mock.patch.object(Elasticsearch, 'msearch')
+    def test_search_meta_batched_with_hits(self, mock_msearch, mock_count,
+                                           mock_search, mock_now):
+        _META_SNAPSHOT.reset()
+        mock_now.return_value = datetime(2017, 1, 3)
+        mock_msearch.return_value = {
+            "responses": [
+                copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT[0]),
+                copy.deepcopy(self.MOCK_META_RETURN_VALUE)
+            ]
+        }
+        mock_search.return_value = copy.deepcopy(
+            self.MOCK_SEARCH_SIDE_EFFECT[1])
+        body, aggs_body = split_aggs(load("search_no_param__valid"))
+        res = search()
+        header = {"index": "INDEX", "type": "DOC_TYPE"}
+        mock_msearch.assert_called_once_with(
+            body=[header, body, header, _META_BODY], request_timeout=mock.ANY)
+        mock_search.assert_called_once_with(body=aggs_body, index="INDEX",
+            doc_type="DOC_TYPE", request_cache=True, **DEADLINE)
+        mock_count.assert_not_called()
+        self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
+        self.assertTrue(_META_SNAPSHOT.is_loaded())
+
+    @mock.patch.object(Elasticsearch, 'msearch')
+    def test_search_msearch_error(self, mock_msearch):
+        _META_SNAPSHOT.reset()
+        mock_msearch.return_value = {
+            "responses": [
+                {"error": {"type": "search_phase_execution_exception"},
+                 "status": 400},
+                copy.deepcopy(self.MOCK_META_RETURN_VALUE)
+            ]
+        }
+        with self.assertRaises(TransportError) as cm:
+            search()
+        self.assertEqual(400, cm.exception.status_code)
+        self.assertEqual("search_phase_execution_exception",
+                         cm.exception.error)
+        self.assertFalse(_META_SNAPSHOT.is_loaded())
+
+    @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_search_with_no_aggs__valid(self, mock_search):
+        mock_search.return_value = copy.deepcopy(
+            self.MOCK_SEARCH_SIDE_EFFECT[0])
+        body, aggs_body = split_aggs(load("search_no_param__valid"))
+        res = search(no_aggs=True)
+        mock_search.assert_called_once_with(body=body, index="INDEX",
+                                            doc_type=_COMPLAINT_DOC_TYPE,
+                                            **DEADLINE)
+        self.assertNotIn("aggregations", res)
+
+    @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+    @mock.patch("complaint_search.es_interface._MAX_RESULT_WINDOW", 10)
+    @mock.patch("complaint_search.es_interface._get_meta")
+    @mock.patch.object(Elasticsearch, 'search')
+    @mock.patch.object(Elasticsearch, 'scroll')
+    @mock.patch.object(Elasticsearch, 'clear_scroll')
+    def test_search_with_frm__beyond_result_window(self, mock_clear_scroll,
+                                                  mock_scroll, mock_search,
+                                                  mock_get_meta):
+        mock_search.side_effect = copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT)
+        mock_get_meta.return_value = copy.deepcopy(
+            self.MOCK_SEARCH_RESULT["_meta"])
+        scroll_side_effect = copy.deepcopy(self.MOCK_SCROLL_SIDE_EFFECT)
+        scroll_side_effect[0]["_scroll_id"] = "scroll_id_1"
+        scroll_side_effect[1]["_scroll_id"] = "scroll_id_2"
+        mock_scroll.side_effect = scroll_side_effect
+        body, aggs_body = split_aggs(load("search_with_frm__valid"))
+        del body["from"]
+        body["size"] = 4
+        res = search(frm=8, size=4)
+        self.assertEqual(2, len(mock_search.call_args_list))
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
+        self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
+        self.assertEqual(mock_search.call_args_list[0][1]['scroll'], "1m")
+        self.assertEqual(2, mock_scroll.call_count)
+        mock_scroll.assert_called_with(scroll_id="scroll_id_1", scroll="1m",
+                                       request_timeout=mock.ANY)
+        mock_clear_scroll.assert_not_called()
+        self.assertEqual([8, 9, 10, 11], res['hits']['hits'])
+        self.assertNotIn('_scroll_id', res)
+        self.assertEqual(encode_cursor("scroll_id_2"), res['_search_after'])
+
+    @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+    @mock.patch("complaint_search.es_interface._get_meta")
+    @mock.patch.object(Elasticsearch, 'search')
+    @mock.patch.object(Elasticsearch, 'scroll')
+    @mock.patch.object(Elasticsearch, 'clear_scroll')
+    def test_search_with_search_after__valid(self, mock_clear_scroll,
+                                             mock_scroll, mock_search,
+                                             mock_get_meta):
+        mock_get_meta.return_value = copy.deepcopy(
+            self.MOCK_SEARCH_RESULT["_meta"])
+        mock_scroll.return_value = {
+            "_scroll_id": "scroll_id_2",
+            "hits": {"hits": [4, 5, 6, 7]}
+        }
+        res = search(size=4, search_after=encode_cursor("scroll_id_1"))
+        mock_search.assert_not_called()
+        mock_scroll.assert_called_once_with(scroll_id="scroll_id_1",
+                                            scroll="1m",
+                                            request_timeout=mock.ANY)
+        mock_clear_scroll.assert_not_called()
+        self.assertEqual([4, 5, 6, 7], res['hits']['hits'])
+        self.assertEqual(encode_cursor("scroll_id_2"), res['_search_after'])
+        self.assertDictEqual(self.MOCK_SEARCH_RESULT['_meta'], res['_meta'])
+
+    @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+    @mock.patch("complaint_search.es_interface._get_meta")
+    @mock.patch.object(Elasticsearch, 'search')
+    @mock.patch.object(Elasticsearch, 'scroll')
+    @mock.patch.object(Elasticsearch, 'clear_scroll')
+    def test_search_with_search_after__last_page(self, mock_clear_scroll,
+                                                 mock_scroll, mock_search,
+                                                 mock_get_meta):
+        mock_get_meta.return_value = copy.deepcopy(
+            self.MOCK_SEARCH_RESULT["_meta"])
+        mock_scroll.return_value = {
+            "_scroll_id": "scroll_id_2",
+            "hits": {"hits": [4, 5]}
+        }
+        res = search(size=4, search_after=encode_cursor("scroll_id_1"))
+        mock_search.assert_not_called()
+        mock_clear_scroll.assert_called_once_with(scroll_id="scroll_id_2")
+        self.assertEqual([4, 5], res['hits']['hits'])
+        self.assertNotIn('_search_after', res)
 
     @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
     @mock.patch("complaint_search.es_interface._get_meta")
@@ -446,24 +718,29 @@ class EsInterfaceTest_Search(TestCase):
         # mock_count.side_effect = []
         # for i in range(4):
 
-        mock_search.side_effect = [copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT[0])
-                                   for i in range(4)]
+        # After the first search the product facet comes from the cache
+        mock_search.side_effect = copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT) + \
+            [copy.deepcopy(self.MOCK_SEARCH_SIDE_EFFECT[0]), {"aggregations": {}}] * 3
 
         mock_count.side_effect = [copy.deepcopy(self.MOCK_COUNT_RETURN_VALUE)
                                   for i in range(4)]
         mock_get_meta.side_effect = [copy.deepcopy(self.MOCK_SEARCH_RESULT["_meta"])
                                      for i in range(4)]
         body = load("search_with_sort__valid")
+        body, aggs_body = split_aggs(body)
 
         for s in sort_fields:
             res = search(sort=s[0])
             body["sort"] = [{s[1]: {"order": s[2]}}]
             mock_search.assert_any_call(
-                body=body, index="INDEX", doc_type=_COMPLAINT_DOC_TYPE, scroll="10m")
+                body=body, index="INDEX", doc_type=_COMPLAINT_DOC_TYPE,
+                **DEADLINE)
             self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
+        mock_search.assert_any_call(body=aggs_body, index="INDEX",
+            doc_type=_COMPLAINT_DOC_TYPE, request_cache=True, **DEADLINE)
         mock_scroll.assert_not_called()
-        self.assertEqual(4, mock_search.call_count)
+        self.assertEqual(8, mock_search.call_count)
 
     @mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
     @mock.patch("complaint_search.es_interface._get_meta")
@@ -476,11 +753,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_search_term_match__valid")
+        body, aggs_body = split_aggs(body)
         res = search(search_term="test term")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -488,6 +766,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -502,11 +781,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_search_term_qsq_and__valid")
+        body, aggs_body = split_aggs(body)
         res = search(search_term="test AND term")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -514,6 +794,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -528,11 +809,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_search_term_qsq_or__valid")
+        body, aggs_body = split_aggs(body)
         res = search(search_term="test OR term")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -540,6 +822,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -554,11 +837,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_search_term_qsq_not__valid")
+        body, aggs_body = split_aggs(body)
         res = search(search_term="test NOT term")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -566,6 +850,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -580,11 +865,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_search_term_qsq_to__valid")
+        body, aggs_body = split_aggs(body)
         res = search(search_term="term TO test")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -592,6 +878,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -606,11 +893,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_date_received_min__valid")
+        body, aggs_body = split_aggs(body)
         res = search(date_received_min="2014-04-14")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -618,6 +906,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -632,11 +921,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_date_received_max__valid")
+        body, aggs_body = split_aggs(body)
         res = search(date_received_max="2017-04-14")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -644,6 +934,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -658,11 +949,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_company_received_min__valid")
+        body, aggs_body = split_aggs(body)
         res = search(company_received_min="2014-04-14")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -670,6 +962,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -684,11 +977,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_company_received_max__valid")
+        body, aggs_body = split_aggs(body)
         res = search(company_received_max="2017-04-14")
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -696,6 +990,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -710,11 +1005,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_company__valid")
+        body, aggs_body = split_aggs(body)
         res = search(company=["Bank 1", "Second Bank"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -723,6 +1019,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -737,12 +1034,13 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_company_agg_exclude__valid")
+        body, aggs_body = split_aggs(body)
         res = search(agg_exclude=['company'], company=[
                      "Bank 1", "Second Bank"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -752,6 +1050,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -766,11 +1065,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_product__valid")
+        body, aggs_body = split_aggs(body)
         res = search([u"zip_code", u"company"], product=["Payday loan", u"Mortgage\u2022FHA mortgage"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -779,6 +1079,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -793,12 +1094,13 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_issue__valid")
+        body, aggs_body = split_aggs(body)
         res = search([u"zip_code", u"company"], issue=[u"Communication tactics\u2022Frequent or repeated calls",
                             "Loan servicing, payments, escrow account"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -807,6 +1109,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -821,11 +1124,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_state__valid")
+        body, aggs_body = split_aggs(body)
         res = search(state=["CA", "VA", "OR"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -834,6 +1138,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -848,11 +1153,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_zip_code__valid")
+        body, aggs_body = split_aggs(body)
         res = search(zip_code=["12345", "23435", "03433"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -862,6 +1168,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -876,12 +1183,13 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_zip_code_agg_exclude__valid")
+        body, aggs_body = split_aggs(body)
         res = search(agg_exclude=['zip_code'], zip_code=[
                      "12345", "23435", "03433"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -891,6 +1199,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -905,11 +1214,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_timely__valid")
+        body, aggs_body = split_aggs(body)
         res = search(timely=["Yes", "No"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -918,6 +1228,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -932,12 +1243,13 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_company_response__valid")
+        body, aggs_body = split_aggs(body)
         res = search(company_response=[
                      "Closed", "Closed with non-monetary relief"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -946,6 +1258,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -960,12 +1273,13 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_company_public_response__valid")
+        body, aggs_body = split_aggs(body)
         res = search(company_public_response=["Company chooses not to provide a public response",
                                               "Company believes it acted appropriately as authorized by contract or law"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -974,6 +1288,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -988,11 +1303,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_consumer_consent_provided__valid")
+        body, aggs_body = split_aggs(body)
         res = search(consumer_consent_provided=["Consent provided"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -1001,6 +1317,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -1015,11 +1332,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_submitted_via__valid")
+        body, aggs_body = split_aggs(body)
         res = search(submitted_via=["Web"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -1028,6 +1346,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -1042,11 +1361,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_tags__valid")
+        body, aggs_body = split_aggs(body)
         res = search(tags=["Older American", "Servicemember"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -1055,6 +1375,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -1069,11 +1390,12 @@ class EsInterfaceTest_Search(TestCase):
         mock_get_meta.return_value = copy.deepcopy(
             self.MOCK_SEARCH_RESULT["_meta"])
         body = load("search_with_has_narrative__valid")
+        body, aggs_body = split_aggs(body)
         res = search(has_narrative=["true"])
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -1082,6 +1404,7 @@ class EsInterfaceTest_Search(TestCase):
         self.assertIsNone(deep.diff(act_body, body))
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         self.assertEqual(self.MOCK_SEARCH_RESULT, res)
 
@@ -1098,11 +1421,12 @@ class EsInterfaceTest_Search(TestCase):
             self.MOCK_SEARCH_RESULT["_meta"])
         mock_scroll.return_value = self.MOCK_SEARCH_SIDE_EFFECT[0]
         body = load("search_no_highlight__valid")
+        body, aggs_body = split_aggs(body)
         res = search(no_highlight=True)
-        self.assertEqual(1, len(mock_search.call_args_list))
+        self.assertEqual(2, len(mock_search.call_args_list))
         self.assertEqual(2, len(mock_search.call_args_list[0]))
         self.assertEqual(0, len(mock_search.call_args_list[0][0]))
-        self.assertEqual(4, len(mock_search.call_args_list[0][1]))
+        self.assertEqual(5, len(mock_search.call_args_list[0][1]))
         act_body = mock_search.call_args_list[0][1]['body']
         diff = deep.diff(act_body, body)
         if diff:
@@ -1110,6 +1434,7 @@ class EsInterfaceTest_Search(TestCase):
             diff.print_full()
         self.assertDictEqual(mock_search.call_args_list[0][1]['body'], body)
         self.assertEqual(mock_search.call_args_list[0][1]['index'], 'INDEX')
+        self.assertDictEqual(mock_search.call_args_list[1][1]['body'], aggs_body)
         mock_scroll.assert_not_called()
         mock_rget.assert_not_called()
         self.assertDictEqual(self.MOCK_SEARCH_RESULT, res)
@@ -1165,7 +1490,7 @@ class EsInterfaceTest_Suggest(TestCase):
         res = suggest(text="Mortgage")
         self.assertEqual(len(mock_suggest.call_args), 2)
         self.assertEqual(0, len(mock_suggest.call_args[0]))
-        self.assertEqual(2, len(mock_suggest.call_args[1]))
+        self.assertEqual(3, len(mock_suggest.call_args[1]))
         act_body = mock_suggest.call_args[1]['body']
         self.assertDictEqual(mock_suggest.call_args[1]['body'], body)
         self.assertEqual(mock_suggest.call_args[1]['index'], 'INDEX')
@@ -1195,13 +1520,473 @@ class EsInterfaceTest_Suggest(TestCase):
         res = suggest(text="Loan", size=10)
         self.assertEqual(len(mock_suggest.call_args), 2)
         self.assertEqual(0, len(mock_suggest.call_args[0]))
-        self.assertEqual(2, len(mock_suggest.call_args[1]))
+        self.assertEqual(3, len(mock_suggest.call_args[1]))
         act_body = mock_suggest.call_args[1]['body']
         self.assertDictEqual(mock_suggest.call_args[1]['body'], body)
         self.assertEqual(mock_suggest.call_args[1]['index'], 'INDEX')
         self.assertEqual(['test 1', 'test 2'], res)
 
 
+class EsInterfaceTest_FacetCache(TestCase):
+
+    def setUp(self):
+        _FACET_CACHE.clear()
+        _META_SNAPSHOT.set({"last_indexed": "2017-01-01"})
+        self.addCleanup(_META_SNAPSHOT.reset)
+
+    def test_last_indexed(self):
+        self.assertEqual("2017-01-01", es_interface.last_indexed())
+        _META_SNAPSHOT.reset()
+        self.assertIsNone(es_interface.last_indexed())
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_cached_aggs__reindexed(self, mock_search):
+        mock_search.side_effect = mock_aggs_response
+        builder = AggregationBuilder()
+        query = {"match_all": {}}
+        _cached_aggs(query, builder)
+        _cached_aggs(query, builder)
+        self.assertEqual(1, mock_search.call_count)
+        _META_SNAPSHOT.set({"last_indexed": "2017-01-02"})
+        _cached_aggs(query, builder)
+        self.assertEqual(2, mock_search.call_count)
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_cached_aggs__only_changed_facets(self, mock_search):
+        mock_search.side_effect = mock_aggs_response
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1"])
+        query = {"match_all": {}}
+        first = _cached_aggs(query, builder)["aggregations"]
+        self.assertEqual(set(AggregationBuilder._AGG_FIELDS), set(first))
+
+        # Toggling a company changes every facet but the company one
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1", "Bank 2"])
+        second = _cached_aggs(query, builder)["aggregations"]
+        requested = mock_search.call_args[1]["body"]["aggs"]
+        self.assertEqual(1, len(requested))
+        self.assertNotIn("company", requested.values()[0]["aggs"])
+        self.assertEqual(len(AggregationBuilder._AGG_FIELDS) - 1,
+                         len(requested.values()[0]["aggs"]))
+        self.assertEqual(first, second)
+
+        # Nothing changed, so nothing is requested
+        _cached_aggs(query, builder)
+        self.assertEqual(2, mock_search.call_count)
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_cached_aggs__query_change(self, mock_search):
+        mock_search.side_effect = mock_aggs_response
+        builder = AggregationBuilder()
+        _cached_aggs({"match_all": {}}, builder)
+        _cached_aggs({"match": {"company": "bank"}}, builder)
+        self.assertEqual(2, mock_search.call_count)
+        requested = mock_search.call_args[1]["body"]["aggs"]
+        self.assertEqual(len(AggregationBuilder._AGG_FIELDS),
+                         len(requested.values()[0]["aggs"]))
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_cached_aggs__deadline_exceeded(self, mock_search):
+        mock_search.side_effect = mock_aggs_response
+        query = {"match_all": {}}
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1"])
+        _cached_aggs(query, builder)
+
+        # Only the company facet is cached for the new selection
+        mock_search.side_effect = ConnectionTimeout('TIMEOUT', 'timed out',
+                                                    None)
+        builder = AggregationBuilder()
+        builder.add(company=["Bank 1", "Bank 2"])
+        res = _cached_aggs(query, builder, Deadline("search"))
+        self.assertEqual(["company"], res["aggregations"].keys())
+        self.assertEqual(len(AggregationBuilder._AGG_FIELDS) - 1,
+                         len(res["partial"]))
+        self.assertNotIn("company", res["partial"])
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_cached_aggs__timed_out(self, mock_search):
+        def timed_out(**kwargs):
+            return dict(mock_aggs_response(**kwargs), timed_out=True)
+        mock_search.side_effect = timed_out
+        builder = AggregationBuilder()
+        res = _cached_aggs({"match_all": {}}, builder)
+        self.assertEqual(set(AggregationBuilder._AGG_FIELDS),
+                         set(res["aggregations"]))
+        self.assertEqual(sorted(AggregationBuilder._AGG_FIELDS),
+                         res["partial"])
+        # Incomplete facets are asked for again
+        mock_search.side_effect = mock_aggs_response
+        self.assertNotIn("partial", _cached_aggs({"match_all": {}}, builder))
+        self.assertEqual(2, mock_search.call_count)
+
+
+class EsInterfaceTest_CircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.addCleanup(_BREAKER.reset)
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_document_circuit_open(self, mock_search):
+        mock_search.side_effect = ConnectionTimeout('TIMEOUT', 'timed out',
+                                                    None)
+        for _ in range(_BREAKER.max_failures):
+            self.assertRaises(ConnectionTimeout, document, 123456)
+        self.assertRaises(CircuitOpen, document, 123456)
+        self.assertEqual(_BREAKER.max_failures, mock_search.call_count)
+
+
+class EsInterfaceTest_Deadline(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        _META_SNAPSHOT.set({"last_indexed": "2017-01-01"})
+        _FACET_CACHE.clear()
+
+    @mock.patch.dict("complaint_search.es_interface._DEADLINES", search=10)
+    @mock.patch("time.time")
+    def test_kwargs(self, mock_time):
+        mock_time.return_value = 100
+        deadline = Deadline("search")
+        mock_time.return_value = 105
+        self.assertEqual({"request_timeout": 5, "timeout": "4000ms"},
+                         deadline.kwargs())
+        self.assertEqual({"request_timeout": 5}, deadline.kwargs(search=False))
+        mock_time.return_value = 110
+        self.assertRaises(ConnectionTimeout, deadline.kwargs)
+
+    @mock.patch("complaint_search.es_interface._get_pool")
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_search_partial_aggregations(self, mock_search, mock_pool):
+        mock_search.return_value = {"hits": {"hits": [1, 2]}}
+        mock_pool.return_value.apply_async.return_value.get.side_effect = \
+            TimeoutError()
+        res = search()
+        self.assertEqual([1, 2], res["hits"]["hits"])
+        self.assertEqual({}, res["aggregations"])
+        self.assertEqual(sorted(AggregationBuilder._AGG_FIELDS),
+                         res["_partial_aggregations"])
+        self.assertEqual(1, metrics.get_metrics()["search_partial_aggregations"])
+        args = mock_pool.return_value.apply_async.call_args[0][1]
+        self.assertTrue(isinstance(args[2], Deadline))
+
+    @mock.patch.object(Elasticsearch, 'search')
+    def test_filter_suggest_deadline(self, mock_search):
+        mock_search.return_value = {"aggregations": {"zip_code": {
+            "zip_code": {"buckets": []}}}}
+        with mock.patch.dict("complaint_search.es_interface._DEADLINES",
+                             suggest_zip=0):
+            self.assertRaises(ConnectionTimeout, filter_suggest, 'zip_code',
+                              text='20')
+        filter_suggest('zip_code', text='20')
+        self.assertEqual(1, mock_search.call_count)
+
+
+class EsInterfaceTest_Pool(TestCase):
+
+    @mock.patch("complaint_search.es_interface._POOL", None)
+    @mock.patch("complaint_search.es_interface._SEARCH_THREADS", 3)
+    def test_get_pool(self):
+        pool = _get_pool()
+        self.addCleanup(pool.terminate)
+        self.assertTrue(isinstance(pool, ThreadPool))
+        self.assertEqual(3, len(pool._pool))
+        self.assertIs(pool, _get_pool())
+
+    @mock.patch("complaint_search.es_interface._SESSION", None)
+    @mock.patch("complaint_search.es_interface._EXPORT_POOL_SIZE", 4)
+    def test_get_session(self):
+        session = _get_session()
+        self.assertFalse(session.trust_env)
+        self.assertIs(session, _get_session())
+        poolmanager = session.get_adapter(_ES_URL).poolmanager
+        self.assertEqual(4, poolmanager.connection_pool_kw["maxsize"])
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                      poolmanager.connection_pool_kw["socket_options"])
+
+    @mock.patch("complaint_search.es_interface._SESSION", None)
+    @mock.patch("complaint_search.es_interface._EXPORT_POOL_SIZE", 4)
+    def test_export_pool_metrics(self):
+        self.assertEqual(0, metrics.get_metrics()["export_pool_in_use"])
+        pool = _get_session().get_adapter(_ES_URL).poolmanager \
+            .connection_from_url(_ES_URL)
+        conn = pool._get_conn()
+        self.assertEqual(1, metrics.get_metrics()["export_pool_in_use"])
+        self.assertEqual(0, metrics.get_metrics()["export_pool_idle"])
+        pool._put_conn(conn)
+        self.assertEqual(0, metrics.get_metrics()["export_pool_in_use"])
+        self.assertEqual(1, metrics.get_metrics()["export_pool_idle"])
+        self.assertEqual(1, metrics.get_metrics()["export_pool_opened"])
+
+
+def mock_shard_search(**kwargs):
+    # Shard N has complaint N + 1, and shard 0 also has complaint 4
+    shard = int(kwargs["preference"].split(":")[1])
+    return {
+        "_scroll_id": "SCROLL_{}".format(shard),
+        "hits": {"hits": [{"sort": [shard + 1], "_source": {
+            "complaint_id": str(shard + 1),
+            "tags": ["Older American", "Servicemember"],
+            "company": u"Bank \u00e9",
+        }}]}
+    }
+
+
+def mock_shard_scroll(scroll_id, scroll, request_timeout):
+    if scroll_id == "SCROLL_0":
+        return {"_scroll_id": "SCROLL_0_2", "hits": {"hits": [
+            {"sort": [4], "_source": {"complaint_id": "4"}}]}}
+    return {"_scroll_id": scroll_id, "hits": {"hits": []}}
+
+
+# The complaints of each shard, scrolled one a page
+SHARD_COMPLAINTS = {0: [1, 4], 1: [2], 2: [3]}
+
+
+def mock_resumed_page(shard, after):
+    complaints = [c for c in SHARD_COMPLAINTS[shard] if c > after][:1]
+    return {
+        "_scroll_id": "{}:{}".format(shard, complaints[0] if complaints
+                                     else after),
+        "hits": {"hits": [{"sort": [c], "_source": {"complaint_id": str(c)}}
+                          for c in complaints]}
+    }
+
+
+def mock_resumed_search(**kwargs):
+    # The shard's first page, after the resume_from filter if there is one
+    shard = int(kwargs["preference"].split(":")[1])
+    query = kwargs["body"]["query"]
+    after = 0
+    if "bool" in query and "filter" in query["bool"]:
+        after = int(query["bool"]["filter"][0]["range"]["complaint_id"]["gt"])
+    return mock_resumed_page(shard, after)
+
+
+def mock_resumed_scroll(scroll_id, scroll, request_timeout):
+    shard, after = scroll_id.split(":")
+    return mock_resumed_page(int(shard), int(after))
+
+
+def mock_slice_search(**kwargs):
+    # All the complaints of the slice's shards, in one page
+    shards = kwargs["preference"].split(":")[1].split(",")
+    complaints = sorted(c for shard in shards
+                        for c in SHARD_COMPLAINTS[int(shard)])
+    return {
+        "_scroll_id": "SCROLL",
+        "hits": {"hits": [{"sort": [c], "_source": {"complaint_id": str(c)}}
+                          for c in complaints]}
+    }
+
+
+def wait_for_export_threads():
+    # The slices free their threads just after putting their last page
+    for _ in range(100):
+        if not es_interface._EXPORT_THREADS_BUSY:
+            return
+        time.sleep(0.01)
+
+
+@mock.patch("complaint_search.es_interface._EXPORT_ENGINE", "native")
+@mock.patch("complaint_search.es_interface._COMPLAINT_ES_INDEX", "INDEX")
+@mock.patch("complaint_search.es_interface._COMPLAINT_DOC_TYPE", "DOC_TYPE")
+@mock.patch.object(Elasticsearch, 'clear_scroll')
+@mock.patch.object(Elasticsearch, 'scroll')
+@mock.patch.object(Elasticsearch, 'search')
+@mock.patch.object(Elasticsearch, 'search_shards')
+class EsInterfaceTest_NativeExport(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        _BREAKER.reset()
+        self.addCleanup(_BREAKER.reset)
+
+    def test_export_json(self, mock_shards, mock_search, mock_scroll,
+                         mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}], [{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        res = json.loads("".join(search(format="json")))
+        # The shards are merged in complaint_id order
+        self.assertEqual(["1", "2", "3", "4"],
+                         [doc["complaint_id"] for doc in res])
+        self.assertEqual(3, mock_search.call_count)
+        body = mock_search.call_args[1]["body"]
+        self.assertEqual([{"complaint_id": {"order": "asc"}}], body["sort"])
+        self.assertNotIn("highlight", body)
+        self.assertNotIn("from", body)
+        self.assertEqual(3, mock_clear.call_count)
+        self.assertEqual(4, metrics.get_metrics()["export_documents"])
+
+    def test_export_csv(self, mock_shards, mock_search, mock_scroll,
+                        mock_clear):
+        mock_shards.return_value = {"shards": [[{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        lines = "".join(search(format="csv")).splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual(",".join('"' + header + '"'
+                         for header in CSV_ORDERED_HEADERS.values()),
+                         lines[0])
+        row = lines[1].split('","')
+        self.assertEqual(len(CSV_ORDERED_HEADERS), len(row))
+        self.assertEqual("Older American, Servicemember",
+                         row[CSV_ORDERED_HEADERS.keys().index("tags")])
+        self.assertEqual(u"Bank \u00e9".encode("utf-8"),
+                         row[CSV_ORDERED_HEADERS.keys().index("company")])
+        self.assertEqual('"4"', lines[2][-3:])
+
+    def test_export_ndjson(self, mock_shards, mock_search, mock_scroll,
+                           mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        lines = "".join(search(format="ndjson")).splitlines()
+        self.assertEqual(["1", "2", "4"],
+                         [json.loads(line)["complaint_id"] for line in lines])
+
+    @mock.patch("complaint_search.es_interface._EXPORT_ENGINE", "plugin")
+    @mock.patch("complaint_search.columnar.parquet_stream")
+    def test_export_parquet(self, mock_parquet, mock_shards, mock_search,
+                            mock_scroll, mock_clear):
+        mock_shards.return_value = {"shards": [[{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        mock_parquet.side_effect = lambda pages: [
+            hit["_source"]["complaint_id"] for hits in pages for hit in hits]
+        self.assertEqual(["1", "4"], search(format="parquet"))
+        body = mock_search.call_args[1]["body"]
+        self.assertIn("has_narrative", body["_source"])
+        self.assertIn("date_received", body["_source"])
+
+    def test_export_empty(self, mock_shards, mock_search, mock_scroll,
+                          mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}]]}
+        mock_search.return_value = {"_scroll_id": "S", "hits": {"hits": []}}
+        self.assertEqual("[]", "".join(search(format="json")))
+        mock_scroll.assert_not_called()
+
+    def test_export_error(self, mock_shards, mock_search, mock_scroll,
+                          mock_clear):
+        mock_shards.return_value = {"shards": [[{}]]}
+        mock_search.side_effect = TransportError(500, "error")
+        # Raised before the response is sent, and counted by the breaker
+        self.assertRaises(TransportError, search, format="json")
+        self.assertEqual(1, _BREAKER._failures)
+        wait_for_export_threads()
+        self.assertEqual(0, es_interface._EXPORT_THREADS_BUSY)
+
+    @mock.patch("complaint_search.es_interface._EXPORT_BATCH_SIZE", 1)
+    def test_export_error_after_first_page(self, mock_shards, mock_search,
+                                           mock_scroll, mock_clear):
+        mock_shards.return_value = {"shards": [[{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = TransportError(500, "error")
+        res = search(format="json")
+        self.assertRaises(TransportError, list, res)
+
+    def test_export_stopped_slice_does_not_search(self, mock_shards,
+                                                  mock_search, mock_scroll,
+                                                  mock_clear):
+        stop = threading.Event()
+        stop.set()
+        out = Queue.Queue(1)
+        es_interface._scroll_shards({}, [0], out, stop)
+        mock_search.assert_not_called()
+        self.assertTrue(out.empty())
+
+    @mock.patch("complaint_search.es_interface._EXPORT_BATCH_SIZE", 2)
+    def test_export_pages_are_batched(self, mock_shards, mock_search,
+                                      mock_scroll, mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}], [{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        body = {"query": {"match_all": {}}, "sort": []}
+        pages = list(_export_pages(body))
+        self.assertEqual([2, 2], [len(hits) for hits in pages])
+
+    @mock.patch("complaint_search.es_interface._EXPORT_SLICES", 2)
+    def test_export_slices_are_capped(self, mock_shards, mock_search,
+                                      mock_scroll, mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}], [{}]]}
+        mock_search.side_effect = mock_slice_search
+        mock_scroll.return_value = {"_scroll_id": "SCROLL",
+                                    "hits": {"hits": []}}
+        res = json.loads("".join(search(format="json")))
+        self.assertEqual(["1", "2", "3", "4"],
+                         [doc["complaint_id"] for doc in res])
+        self.assertEqual(["_shards:0,2", "_shards:1"], sorted(
+            call[1]["preference"] for call in mock_search.call_args_list))
+
+    @mock.patch("complaint_search.es_interface._EXPORT_POOL", None)
+    @mock.patch("complaint_search.es_interface.ThreadPool", wraps=ThreadPool)
+    def test_export_pool_is_shared(self, mock_pool, mock_shards, mock_search,
+                                   mock_scroll, mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}], [{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        for _ in range(2):
+            self.assertEqual(4, len(json.loads("".join(
+                search(format="json")))))
+        self.addCleanup(es_interface._EXPORT_POOL.terminate)
+        mock_pool.assert_called_once_with(es_interface._EXPORT_THREADS)
+        wait_for_export_threads()
+        self.assertEqual(0, es_interface._EXPORT_THREADS_BUSY)
+
+    @mock.patch("complaint_search.es_interface._EXPORT_THREADS", 4)
+    @mock.patch("complaint_search.es_interface._EXPORT_THREADS_BUSY", 3)
+    @mock.patch("complaint_search.es_interface._EXPORT_THREADS_WAIT", 0.01)
+    def test_export_threads_busy(self, mock_shards, mock_search, mock_scroll,
+                                 mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}]]}
+        with self.assertRaises(TransportError) as context:
+            search(format="json")
+        self.assertEqual(429, context.exception.status_code)
+        mock_search.assert_not_called()
+        self.assertEqual(0, _BREAKER._failures)
+        self.assertEqual(1, metrics.get_metrics()["export_threads_exhausted"])
+
+    @mock.patch("complaint_search.es_interface._EXPORT_ENGINE", "plugin")
+    def test_export_resume_from(self, mock_shards, mock_search, mock_scroll,
+                                mock_clear):
+        mock_shards.return_value = {"shards": [[{}]]}
+        mock_search.side_effect = mock_shard_search
+        mock_scroll.side_effect = mock_shard_scroll
+        lines = "".join(search(format="csv", resume_from="3")).splitlines()
+        # No header, the rows follow the ones already received
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].startswith('"'))
+        self.assertNotIn('"Complaint ID"', lines[0])
+        query = mock_search.call_args[1]["body"]["query"]
+        self.assertEqual([{"range": {"complaint_id": {"gt": "3"}}}],
+                         query["bool"]["filter"])
+
+    @mock.patch("complaint_search.es_interface._EXPORT_BATCH_SIZE", 1)
+    @mock.patch("complaint_search.export_checkpoints._CACHE",
+                response_cache.LRUCache(10, 60))
+    def test_export_resumed_can_be_appended(self, mock_shards, mock_search,
+                                            mock_scroll, mock_clear):
+        mock_shards.return_value = {"shards": [[{}], [{}], [{}]]}
+        mock_search.side_effect = mock_resumed_search
+        mock_scroll.side_effect = mock_resumed_scroll
+        for format in ("csv", "ndjson"):
+            export_id = "EXPORT_" + format
+            content = "".join(search(format=format, export_id=export_id))
+            # The download stopped inside the third record
+            lines = content.splitlines(True)
+            if format == "csv":
+                lines = lines[1:]
+            received = content[:content.index(lines[2]) + 5]
+            checkpoint = export_checkpoints.find(export_id, len(received))
+            self.assertEqual("2", checkpoint["resume_from"])
+            resumed = "".join(search(
+                format=format, resume_from=checkpoint["resume_from"]))
+            self.assertEqual(content,
+                             received[:checkpoint["offset"]] + resumed)
+
+
 class EsInterfaceTest_FilterSuggest(TestCase):
 
     def setUp(self):
@@ -1285,7 +2070,8 @@ class EsInterfaceTest_FilterSuggest(TestCase):
                 }
             },
             doc_type='DOCTYPE',
-            index='INDEX')
+            index='INDEX',
+            **DEADLINE)
         mock_builder2.assert_called_once_with('company.suggest')
         self.assertEqual(actual, [
             'bank 1', 'Bank 2', 'BANK 3rd', 'bank 4', 'BANK 5th', 'company 1'
@@ -1353,7 +2139,8 @@ class EsInterfaceTest_FilterSuggest(TestCase):
                 }
             },
             doc_type='DOCTYPE',
-            index='INDEX')
+            index='INDEX',
+            **DEADLINE)
         mock_builder2.assert_called_once_with('zip_code')
         self.assertEqual(actual, [
             '207XX', '200XX', '201XX', '208XX', '206XX'
@@ -1371,7 +2158,7 @@ class EsInterfaceTest_Document(TestCase):
         res = document(123456)
         self.assertEqual(len(mock_search.call_args), 2)
         self.assertEqual(0, len(mock_search.call_args[0]))
-        self.assertEqual(3, len(mock_search.call_args[1]))
+        self.assertEqual(5, len(mock_search.call_args[1]))
         act_body = mock_search.call_args[1]['body']
         self.assertDictEqual(mock_search.call_args[1]['body'], body)
         self.assertEqual(mock_search.call_args[1]['doc_type'], 'DOC_TYPE')
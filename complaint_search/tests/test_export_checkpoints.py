@@ -0,0 +1,111 @@
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from rest_framework import status
+from rest_framework.test import APITestCase
+import mock
+from complaint_search import export_checkpoints, response_cache, throttle_store
+from complaint_search.throttling import (
+    ExportUIRateThrottle,
+    ExportAnonRateThrottle,
+)
+
+
+class ExportCheckpointTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('complaint_search.export_checkpoints._CACHE',
+                             response_cache.LRUCache(10, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_find(self):
+        export_checkpoints.record('a', 100, '10')
+        export_checkpoints.record('a', 200, '20')
+        self.assertEqual({"offset": 100, "resume_from": "10"},
+                         export_checkpoints.find('a', 199))
+        self.assertEqual({"offset": 200, "resume_from": "20"},
+                         export_checkpoints.find('a', 200))
+        self.assertIsNone(export_checkpoints.find('a', 99))
+        self.assertIsNone(export_checkpoints.find('b', 200))
+
+    @mock.patch('complaint_search.export_checkpoints._KEEP', 2)
+    def test_record_keeps_the_latest(self):
+        for offset in (100, 200, 300):
+            export_checkpoints.record('a', offset, str(offset))
+        self.assertIsNone(export_checkpoints.find('a', 150))
+        self.assertEqual("200", export_checkpoints.find('a', 250)["resume_from"])
+
+
+class ExportCheckpointViewTests(APITestCase):
+
+    def setUp(self):
+        throttle_store.clear()
+        self.orig_export_ui_rate = ExportUIRateThrottle.rate
+        self.orig_export_anon_rate = ExportAnonRateThrottle.rate
+        ExportUIRateThrottle.rate = '2000/min'
+        ExportAnonRateThrottle.rate = '2000/min'
+        patcher = mock.patch('complaint_search.export_checkpoints._CACHE',
+                             response_cache.LRUCache(10, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.export_id = 'a' * 32
+
+    def tearDown(self):
+        throttle_store.clear()
+        ExportUIRateThrottle.rate = self.orig_export_ui_rate
+        ExportAnonRateThrottle.rate = self.orig_export_anon_rate
+
+    def test_checkpoint(self):
+        export_checkpoints.record(self.export_id, 100, '10')
+        url = reverse('complaint_search:export_checkpoint',
+                      args=(self.export_id,))
+        response = self.client.get(url, {"received": 150})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({"offset": 100, "resume_from": "10"}, response.data)
+
+        response = self.client.get(url, {"received": 50})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_checkpoint_invalid_received(self):
+        url = reverse('complaint_search:export_checkpoint',
+                      args=(self.export_id,))
+        response = self.client.get(url, {"received": "all"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    @mock.patch('complaint_search.es_interface.exports_are_resumable',
+                return_value=True)
+    @mock.patch('complaint_search.es_interface.search')
+    def test_export_header(self, mock_essearch, mock_resumable):
+        mock_essearch.return_value = iter(["a\n"])
+        url = reverse('complaint_search:search')
+        response = self.client.get(url, {"format": "csv"})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        export_id = mock_essearch.call_args[1]["export_id"]
+        self.assertTrue(response['Export-Checkpoint'].endswith(reverse(
+            'complaint_search:export_checkpoint', args=(export_id,))))
+
+        response = self.client.get(url, {"format": "json"})
+        self.assertNotIn("export_id", mock_essearch.call_args[1])
+        self.assertFalse(response.has_header('Export-Checkpoint'))
+
+    @mock.patch('complaint_search.es_interface._EXPORT_ENGINE', 'native')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_export_header__no_shared_cache(self, mock_essearch):
+        mock_essearch.return_value = iter(["a\n"])
+        url = reverse('complaint_search:search')
+        for backend in ('none', 'locmem'):
+            with mock.patch('complaint_search.response_cache._BACKEND',
+                            backend):
+                response = self.client.get(url, {"format": "csv"})
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertNotIn("export_id", mock_essearch.call_args[1])
+            self.assertFalse(response.has_header('Export-Checkpoint'))
+
+    @mock.patch('complaint_search.es_interface._EXPORT_ENGINE', 'native')
+    @mock.patch('complaint_search.response_cache._BACKEND', 'django')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_export_header__shared_cache(self, mock_essearch):
+        mock_essearch.return_value = iter(["a\n"])
+        url = reverse('complaint_search:search')
+        response = self.client.get(url, {"format": "csv"})
+        self.assertTrue(response.has_header('Export-Checkpoint'))
@@ -0,0 +1,217 @@
+from django.test import TestCase
+from multiprocessing import Pool
+import gzip
+import os
+import shutil
+import tempfile
+import mock
+from complaint_search import es_interface, export_jobs, metrics
+from complaint_search.defaults import PARAMS
+
+
+class SyncPool(object):
+    """Runs jobs right away instead of in a worker process"""
+
+    def __init__(self, run=True):
+        self.run = run
+        self.calls = []
+
+    def apply_async(self, func, args, callback=None):
+        self.calls.append(args)
+        if self.run:
+            callback(func(*args))
+
+
+def use_clients():
+    # Runs in a pool worker, using what an export uses
+    es_interface._get_session()
+    es_interface._get_pool()
+    es_interface._BREAKER.call(lambda: None)
+    metrics.incr('export_jobs_test')
+    return True
+
+
+def params(**kwargs):
+    result = dict(PARAMS)
+    result.update(format='csv', **kwargs)
+    return result
+
+
+class ExportJobTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.pool = SyncPool()
+        for name, value in (('_JOB_DIR', self.dir),
+                            ('_PENDING', set()),
+                            ('_get_pool', lambda: self.pool)):
+            patcher = mock.patch('complaint_search.export_jobs.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_submit(self, mock_search):
+        mock_search.return_value = iter(['"a"\n', '"b"\n'])
+        job = export_jobs.submit(params(state=['VA']))
+        self.assertEqual(40, len(job["id"]))
+        mock_search.assert_called_once_with(**params(state=['VA']))
+
+        job = export_jobs.get_job(job["id"])
+        self.assertEqual(export_jobs.DONE, job["status"])
+        self.assertEqual(8, job["bytes"])
+        self.assertEqual(64, len(job["sha256"]))
+        with gzip.open(export_jobs.data_path(job["id"])) as f:
+            self.assertEqual('"a"\n"b"\n', f.read())
+        self.assertEqual(set(), export_jobs._PENDING)
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_submit__same_params_attach(self, mock_search):
+        self.pool.run = False
+        first = export_jobs.submit(params(state=['VA', 'MD']))
+        second = export_jobs.submit(params(state=['MD', 'VA']))
+        self.assertEqual(first["id"], second["id"])
+        self.assertEqual(export_jobs.QUEUED, second["status"])
+        self.assertEqual(1, len(self.pool.calls))
+        other = export_jobs.submit(params(state=['CA']))
+        self.assertNotEqual(first["id"], other["id"])
+
+    @mock.patch('complaint_search.export_jobs._QUEUE_SIZE', 1)
+    def test_submit__queue_full(self):
+        self.pool.run = False
+        export_jobs.submit(params(state=['VA']))
+        self.assertRaises(export_jobs.QueueFull,
+                          export_jobs.submit, params(state=['CA']))
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_submit__failed_job_retried(self, mock_search):
+        mock_search.side_effect = IOError("ES is down")
+        job = export_jobs.submit(params())
+        job = export_jobs.get_job(job["id"])
+        self.assertEqual(export_jobs.FAILED, job["status"])
+        self.assertEqual("ES is down", job["error"])
+        self.assertFalse(os.path.exists(export_jobs.data_path(job["id"])))
+        self.assertEqual([job["id"] + '.json'], os.listdir(self.dir))
+
+        mock_search.side_effect = None
+        mock_search.return_value = iter(['"a"\n'])
+        export_jobs.submit(params())
+        self.assertEqual(export_jobs.DONE,
+                         export_jobs.get_job(job["id"])["status"])
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_submit__expired_removed(self, mock_search):
+        mock_search.return_value = iter(['"a"\n'])
+        old = export_jobs.submit(params(state=['VA']))
+        with mock.patch('time.time', return_value=old["created"] + 7200):
+            self.pool.run = False
+            job = export_jobs.submit(params(state=['VA']))
+        self.assertEqual(export_jobs.QUEUED, job["status"])
+        self.assertFalse(os.path.exists(export_jobs.data_path(old["id"])))
+
+    def test_submit__created_by_another_process(self):
+        self.pool.run = False
+        job_id = export_jobs.fingerprint(params())
+        other = {"id": job_id, "status": export_jobs.RUNNING,
+                 "format": "csv", "created": 1, "finished": None}
+        create_status = export_jobs._create_status
+
+        def create_after_other(job):
+            # Another server process creates the job first
+            create_status(dict(other))
+            return create_status(job)
+
+        with mock.patch('complaint_search.export_jobs._create_status',
+                        side_effect=create_after_other):
+            job = export_jobs.submit(params())
+        self.assertEqual(export_jobs.RUNNING, job["status"])
+        self.assertEqual(1, job["created"])
+        self.assertEqual([], self.pool.calls)
+        self.assertEqual(set(), export_jobs._PENDING)
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_submit__retried_by_another_process(self, mock_search):
+        mock_search.side_effect = IOError("ES is down")
+        failed = export_jobs.submit(params())
+        self.pool.run = False
+        retry = {"id": failed["id"], "status": export_jobs.QUEUED,
+                 "format": "csv", "created": failed["created"] + 1,
+                 "finished": None}
+        retire_status = export_jobs._retire_status
+
+        def retire_after_other(job):
+            # Another server process retried the failed job first
+            retire_status(job)
+            export_jobs._create_status(dict(retry))
+            return retire_status(job)
+
+        with mock.patch('complaint_search.export_jobs._retire_status',
+                        side_effect=retire_after_other):
+            job = export_jobs.submit(params())
+        self.assertEqual(retry["created"], job["created"])
+        self.assertEqual(retry["created"],
+                         export_jobs.get_job(failed["id"])["created"])
+        self.assertEqual(1, len(self.pool.calls))
+        self.assertEqual([failed["id"] + '.json'], os.listdir(self.dir))
+
+    def test_get_job__unknown(self):
+        self.assertIsNone(export_jobs.get_job('0' * 40))
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_run_job__status_file_missing(self, mock_search):
+        mock_search.return_value = iter(['"a"\n'])
+        self.pool.run = False
+        job = export_jobs.submit(params())
+        os.remove(os.path.join(self.dir, job["id"] + '.json'))
+        self.assertEqual(job["id"], export_jobs._run_job(job["id"], params()))
+        self.assertEqual(export_jobs.DONE,
+                         export_jobs.get_job(job["id"])["status"])
+
+    @mock.patch('complaint_search.export_jobs._write_status')
+    def test_run_job__status_not_written(self, mock_write):
+        self.pool.run = False
+        job = export_jobs.submit(params())
+        mock_write.side_effect = OSError("disk full")
+        self.pool.run = True
+        self.assertEqual(job["id"], export_jobs._run_job(job["id"], params()))
+
+    @mock.patch('complaint_search.export_jobs._QUEUE_SIZE', 1)
+    @mock.patch('complaint_search.export_jobs._is_alive', return_value=False)
+    def test_submit__worker_killed(self, mock_alive):
+        self.pool.run = False
+        job = export_jobs.submit(params(state=['VA']))
+        # The worker died while running the job, so no callback was made
+        job.update(status=export_jobs.RUNNING, pid=12345)
+        export_jobs._write_status(job)
+
+        other = export_jobs.submit(params(state=['CA']))
+        self.assertEqual(export_jobs.QUEUED, other["status"])
+        job = export_jobs.get_job(job["id"])
+        self.assertEqual(export_jobs.FAILED, job["status"])
+        self.assertEqual("The export worker died", job["error"])
+        mock_alive.assert_called_once_with(12345)
+        self.assertEqual(set([other["id"]]), export_jobs._PENDING)
+
+    @mock.patch('complaint_search.export_jobs._QUEUE_SIZE', 1)
+    def test_submit__status_file_lost(self):
+        self.pool.run = False
+        job = export_jobs.submit(params(state=['VA']))
+        os.remove(os.path.join(self.dir, job["id"] + '.json'))
+        export_jobs.submit(params(state=['CA']))
+        self.assertNotIn(job["id"], export_jobs._PENDING)
+
+    def test_init_worker_after_fork(self):
+        # Threads of the server held these locks when the pool forked
+        locks = [es_interface._SESSION_LOCK, es_interface._POOL_LOCK,
+                 es_interface._BREAKER._lock, metrics._LOCK]
+        for lock in locks:
+            lock.acquire()
+        try:
+            pool = Pool(1, initializer=export_jobs._init_worker)
+            try:
+                self.assertTrue(pool.apply_async(use_clients).get(timeout=10))
+            finally:
+                pool.terminate()
+        finally:
+            for lock in locks:
+                lock.release()
@@ -0,0 +1,136 @@
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory
+from StringIO import StringIO
+import gzip
+import os
+import shutil
+import tempfile
+import mock
+from complaint_search import export_snapshots
+
+
+class ExportSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patcher = mock.patch(
+            'complaint_search.export_snapshots._SNAPSHOT_DIR', self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.last_indexed = "2017-04-14T12:00:00-05:00"
+        patcher = mock.patch('complaint_search.es_interface.get_meta',
+                             side_effect=lambda: {
+                                 "last_indexed": self.last_indexed})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('complaint_search.es_interface.search',
+                             side_effect=lambda format: iter(
+                                 ["{} row 1\n".format(format), "row 2\n"]))
+        self.mock_search = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read(self, entry):
+        with gzip.open(os.path.join(self.dir, entry["name"])) as f:
+            return f.read()
+
+    def test_build_snapshots(self):
+        self.assertEqual(["csv", "json"], export_snapshots.build_snapshots())
+        entry = export_snapshots.get_snapshot("csv")
+        self.assertEqual("csv row 1\nrow 2\n", self.read(entry))
+        self.assertEqual(os.path.getsize(
+            os.path.join(self.dir, entry["name"])), entry["size"])
+        self.assertEqual(64, len(entry["sha256"]))
+        self.assertIsNone(export_snapshots.get_snapshot("ndjson"))
+
+    def test_build_snapshots__unchanged(self):
+        export_snapshots.build_snapshots()
+        self.assertEqual([], export_snapshots.build_snapshots())
+        self.assertEqual(2, self.mock_search.call_count)
+        self.assertEqual(["csv"], export_snapshots.build_snapshots(
+            ["csv"], force=True))
+
+    def test_build_snapshots__index_changed(self):
+        export_snapshots.build_snapshots(["csv"])
+        old = export_snapshots.get_snapshot("csv")
+        self.last_indexed = "2017-04-15T12:00:00-05:00"
+        with mock.patch('time.time', return_value=2000000000):
+            self.assertEqual(["csv"], export_snapshots.build_snapshots(["csv"]))
+        self.assertNotEqual(old["name"],
+                            export_snapshots.get_snapshot("csv")["name"])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, old["name"])))
+
+    def test_build_snapshots__disabled(self):
+        with mock.patch('complaint_search.export_snapshots._SNAPSHOT_DIR', ''):
+            self.assertRaises(ValueError, export_snapshots.build_snapshots)
+            self.assertIsNone(export_snapshots.get_snapshot("csv"))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('build_export_snapshots', format=['csv'], stdout=out)
+        self.assertIn('Built export snapshots: csv', out.getvalue())
+        call_command('build_export_snapshots', format=['csv'], stdout=out)
+        self.assertIn('up to date', out.getvalue())
+
+    def test_is_unfiltered(self):
+        self.assertTrue(export_snapshots.is_unfiltered(
+            {"format": "csv", "field": "complaint_what_happened"}))
+        self.assertFalse(export_snapshots.is_unfiltered(
+            {"format": "csv", "field": "_all"}))
+        self.assertFalse(export_snapshots.is_unfiltered(
+            {"format": "csv", "sort": "created_date_desc"}))
+        self.assertFalse(export_snapshots.is_unfiltered(
+            {"format": "csv", "state": ["VA"]}))
+
+
+class FileResponseTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patcher = mock.patch(
+            'complaint_search.export_snapshots._SNAPSHOT_DIR', self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with open(os.path.join(self.dir, 'complaints-1.csv.gz'), 'wb') as f:
+            f.write('0123456789')
+        self.entry = {"name": "complaints-1.csv.gz", "size": 10,
+                      "sha256": "ab" * 32}
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        request = self.factory.get('/', **headers)
+        return export_snapshots.snapshot_response(request, self.entry,
+                                                  'text/csv')
+
+    def test_full(self):
+        response = self.get()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('0123456789', "".join(response.streaming_content))
+        self.assertEqual('10', response['Content-Length'])
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertEqual('"{}"'.format("ab" * 32), response['ETag'])
+        self.assertTrue(response['Digest'].startswith('SHA-256='))
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('2345', "".join(response.streaming_content))
+        self.assertEqual('bytes 2-5/10', response['Content-Range'])
+        self.assertEqual('4', response['Content-Length'])
+
+    def test_range_open_ended(self):
+        response = self.get(HTTP_RANGE='bytes=7-')
+        self.assertEqual('789', "".join(response.streaming_content))
+        response = self.get(HTTP_RANGE='bytes=-2')
+        self.assertEqual('89', "".join(response.streaming_content))
+
+    def test_range_not_satisfiable(self):
+        response = self.get(HTTP_RANGE='bytes=10-')
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */10', response['Content-Range'])
+
+    def test_range_if_range_mismatch(self):
+        response = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"old"')
+        self.assertEqual(200, response.status_code)
@@ -0,0 +1,69 @@
+from django.test import TestCase
+from complaint_search.query_analyzer import QueryRejected, analyze
+import mock
+
+
+class AnalyzeTests(TestCase):
+
+    def assertRejected(self, reason, search_term, field='complaint_what_happened'):
+        with self.assertRaises(QueryRejected) as context:
+            analyze(search_term, field)
+        self.assertEqual(reason, context.exception.reason)
+
+    def test_analyze__plain(self):
+        self.assertEqual(('bank AND (loan OR "credit card")', 4, []),
+                         analyze('bank AND (loan OR "credit card")',
+                                 'complaint_what_happened'))
+
+    def test_analyze__all_fields(self):
+        self.assertEqual(6, analyze('bank "credit card"', '_all').cost)
+
+    def test_analyze__leading_wildcard(self):
+        self.assertEqual(('bank mort*', 11, ['leading_wildcard']),
+                         analyze('*bank ?mort*', 'complaint_what_happened'))
+        # Nothing is left of a lone wildcard, which matches everything
+        self.assertEqual(('', 0, ['leading_wildcard']),
+                         analyze('*', 'complaint_what_happened'))
+
+    def test_analyze__escaped_wildcard(self):
+        self.assertEqual(('\\*bank', 1, []),
+                         analyze('\\*bank', 'complaint_what_happened'))
+
+    def test_analyze__fuzziness(self):
+        self.assertEqual(('mortage~1 bank~1', 10, ['fuzziness']),
+                         analyze('mortage~ bank~1', 'complaint_what_happened'))
+        self.assertEqual('mortage~1^2',
+                         analyze('mortage~2^2', 'complaint_what_happened').term)
+
+    def test_analyze__phrase_slop(self):
+        self.assertEqual(('"credit card"~3', 2, []),
+                         analyze('"credit card"~3', 'complaint_what_happened'))
+
+    def test_analyze__literal(self):
+        self.assertEqual(('and\\/or help\\!', 2, ['escaped']),
+                         analyze('and/or help!', 'complaint_what_happened'))
+
+    def test_analyze__field_and_range(self):
+        self.assertEqual(('company:"Bank" date_received:[2017 TO 2018]', 7, []),
+                         analyze('company:"Bank" date_received:[2017 TO 2018]',
+                                 'complaint_what_happened'))
+
+    def test_analyze__regex(self):
+        self.assertRejected('regex', '/ban.*k/')
+        self.assertRejected('regex', 'company:/ban.*k/')
+
+    def test_analyze__syntax(self):
+        self.assertRejected('syntax', '"credit card')
+        self.assertRejected('syntax', '(bank OR loan')
+        self.assertRejected('syntax', 'bank OR loan)')
+        self.assertRejected('syntax', '[2017 TO 2018')
+        self.assertRejected('syntax', ':bank')
+
+    def test_analyze__too_deep(self):
+        self.assertRejected('too_deep', '((((((bank))))))')
+
+    @mock.patch('complaint_search.query_analyzer._MAX_COST', 20)
+    def test_analyze__too_expensive(self):
+        self.assertEqual(20, analyze('ban* loa*', 'complaint_what_happened').cost)
+        self.assertRejected('too_expensive', 'ban* loa* card')
+        self.assertRejected('too_expensive', 'ban* loa*', '_all')
@@ -0,0 +1,140 @@
+from django.core.cache import caches
+from django.test import TestCase
+from elasticsearch import ConnectionTimeout, TransportError
+from complaint_search import metrics
+from complaint_search.circuit_breaker import CircuitOpen
+from complaint_search.response_cache import (
+    DjangoCache,
+    LRUCache,
+    NoCache,
+    cached,
+    create_shared_cache,
+)
+import mock
+
+
+class LRUCacheTests(TestCase):
+
+    def test_get__missing(self):
+        self.assertIsNone(LRUCache(2, 60).get('a'))
+
+    def test_set_get(self):
+        lru = LRUCache(2, 60)
+        lru.set('a', 1)
+        self.assertEqual(1, lru.get('a'))
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(2, 60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+
+    @mock.patch('complaint_search.response_cache.time')
+    def test_expires(self, mock_time):
+        mock_time.time.return_value = 1000
+        lru = LRUCache(2, 60)
+        lru.set('a', 1)
+        mock_time.time.return_value = 1061
+        self.assertIsNone(lru.get('a'))
+
+    def test_clear(self):
+        lru = LRUCache(2, 60)
+        lru.set('a', 1)
+        lru.clear()
+        self.assertIsNone(lru.get('a'))
+
+
+class DjangoCacheTests(TestCase):
+
+    def test_set_get(self):
+        self.addCleanup(caches['default'].clear)
+        shared = DjangoCache('default', 60)
+        shared.set('a', {'hits': 1})
+        self.assertEqual({'hits': 1}, caches['default'].get('ccdb5_search:a'))
+        self.assertEqual({'hits': 1}, shared.get('a'))
+        self.assertIsNone(DjangoCache('default', 60, 'ccdb5_other:').get('a'))
+
+
+class CreateSharedCacheTests(TestCase):
+
+    @mock.patch('complaint_search.response_cache._BACKEND', 'django')
+    def test_django(self):
+        self.assertIsInstance(create_shared_cache('p:'), DjangoCache)
+
+    def test_not_shared(self):
+        for backend in ('locmem', 'none'):
+            with mock.patch('complaint_search.response_cache._BACKEND',
+                            backend):
+                self.assertIsInstance(create_shared_cache('p:'), NoCache)
+
+
+class CachedTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    @mock.patch('complaint_search.response_cache._CACHE', LRUCache(2, 60))
+    def test_cached(self):
+        search = mock.MagicMock(return_value={'hits': 1})
+        self.assertEqual({'hits': 1}, cached('a', search))
+        self.assertEqual({'hits': 1}, cached('a', search))
+        self.assertEqual(1, search.call_count)
+        self.assertEqual(1, metrics.get_metrics()['search_cache_hits'])
+        self.assertEqual(1, metrics.get_metrics()['search_cache_misses'])
+
+    @mock.patch('complaint_search.response_cache._CACHE', LRUCache(2, 60))
+    def test_cached__cursor_not_cached(self):
+        search = mock.MagicMock(return_value={'_search_after': 'cursor'})
+        cached('a', search)
+        cached('a', search)
+        self.assertEqual(2, search.call_count)
+
+    @mock.patch('complaint_search.response_cache._CACHE', NoCache())
+    def test_cached__no_cache(self):
+        search = mock.MagicMock(return_value={'hits': 1})
+        cached('a', search)
+        cached('a', search)
+        self.assertEqual(2, search.call_count)
+
+    @mock.patch('complaint_search.response_cache._CACHE', LRUCache(2, 60))
+    def test_cached__partial_not_cached(self):
+        search = mock.MagicMock(return_value={'_partial_aggregations': []})
+        cached('a', search)
+        cached('a', search)
+        self.assertEqual(2, search.call_count)
+
+
+@mock.patch('complaint_search.response_cache._CACHE', NoCache())
+class StaleTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        patcher = mock.patch('complaint_search.response_cache._STALE_CACHE',
+                             LRUCache(2, 60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stale__circuit_open(self):
+        cached('a', mock.MagicMock(return_value={'hits': 1}))
+        search = mock.MagicMock(side_effect=CircuitOpen())
+        self.assertEqual({'hits': 1, '_stale': True}, cached('a', search))
+        self.assertEqual(1, metrics.get_metrics()['search_stale_served'])
+
+    def test_stale__timeout(self):
+        cached('a', mock.MagicMock(return_value={'hits': 1}))
+        search = mock.MagicMock(
+            side_effect=ConnectionTimeout('TIMEOUT', 'timed out', None))
+        self.assertTrue(cached('a', search)['_stale'])
+
+    def test_stale__missing(self):
+        search = mock.MagicMock(side_effect=CircuitOpen())
+        self.assertRaises(CircuitOpen, cached, 'a', search)
+
+    def test_stale__request_error(self):
+        cached('a', mock.MagicMock(return_value={'hits': 1}))
+        search = mock.MagicMock(side_effect=TransportError(400, 'parse'))
+        self.assertRaises(TransportError, cached, 'a', search)
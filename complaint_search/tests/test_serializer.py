@@ -1,8 +1,14 @@
 # Most of the serializer code has been tested through the views
 import copy
+import mock
 from django.test import TestCase
 from complaint_search.defaults import PARAMS
-from complaint_search.serializer import SearchInputSerializer
+from complaint_search.cursor import encode_cursor
+from complaint_search.serializer import (
+    SearchInputSerializer,
+    fingerprint,
+    search_cost,
+)
 
 class SearchInputSerializerTests(TestCase):
 
@@ -47,3 +53,124 @@ class SearchInputSerializerTests(TestCase):
 
 
 
+
+    def test_is_valid__valid_search_after(self):
+        self.data['search_after'] = encode_cursor("scroll_id")
+        serializer = SearchInputSerializer(data=self.data)
+        self.assertTrue(serializer.is_valid())
+
+    def test_is_valid__invalid_search_after(self):
+        self.data['search_after'] = "not a cursor"
+        serializer = SearchInputSerializer(data=self.data)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors.get('search_after'), [u'search_after is not a valid cursor'])
+
+    @mock.patch("complaint_search.serializer.exports_are_resumable")
+    def test_is_valid__valid_resume_from(self, mock_resumable):
+        mock_resumable.return_value = True
+        self.data['format'] = 'csv'
+        self.data['resume_from'] = '1234567'
+        serializer = SearchInputSerializer(data=self.data)
+        self.assertTrue(serializer.is_valid())
+
+    @mock.patch("complaint_search.serializer.exports_are_resumable")
+    def test_is_valid__resume_from_not_resumable(self, mock_resumable):
+        mock_resumable.return_value = False
+        self.data['format'] = 'csv'
+        self.data['resume_from'] = '1234567'
+        serializer = SearchInputSerializer(data=self.data)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors.get('resume_from'), [u'exports can not be resumed'])
+
+    @mock.patch("complaint_search.serializer.exports_are_resumable")
+    def test_is_valid__resume_from_without_export(self, mock_resumable):
+        mock_resumable.return_value = True
+        self.data['resume_from'] = '1234567'
+        serializer = SearchInputSerializer(data=self.data)
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors.get('non_field_errors'), [u'resume_from is only valid for csv and ndjson exports'])
+
+    @mock.patch("complaint_search.columnar.is_available", return_value=True)
+    @mock.patch("complaint_search.serializer.exports_are_resumable")
+    def test_is_valid__resume_from_not_appendable(self, mock_resumable,
+                                                  mock_available):
+        mock_resumable.return_value = True
+        self.data['resume_from'] = '1234567'
+        for format in ('json', 'parquet'):
+            self.data['format'] = format
+            serializer = SearchInputSerializer(data=self.data)
+            self.assertFalse(serializer.is_valid())
+            self.assertEqual(serializer.errors.get('non_field_errors'), [u'resume_from is only valid for csv and ndjson exports'])
+
+    def test_is_valid__invalid_resume_from(self):
+        self.data['format'] = 'csv'
+        self.data['resume_from'] = '12; drop'
+        serializer = SearchInputSerializer(data=self.data)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('resume_from', serializer.errors)
+
+
+class FingerprintTests(TestCase):
+
+    def validate(self, data):
+        serializer = SearchInputSerializer(data=data)
+        self.assertTrue(serializer.is_valid())
+        return serializer.validated_data
+
+    def test_fingerprint__defaults(self):
+        self.assertEqual(
+            fingerprint(self.validate({})),
+            fingerprint(self.validate({'size': 10, 'frm': 0,
+                                       'sort': 'relevance_desc'})))
+
+    def test_fingerprint__list_order(self):
+        self.assertEqual(
+            fingerprint(self.validate({'state': ['VA', 'MD']})),
+            fingerprint(self.validate({'state': ['MD', 'VA']})))
+
+    def test_fingerprint__dates(self):
+        self.assertNotEqual(
+            fingerprint(self.validate({'date_received_min': '2017-01-01'})),
+            fingerprint(self.validate({'date_received_min': '2017-01-02'})))
+
+    def test_fingerprint__format(self):
+        self.assertNotEqual(
+            fingerprint(self.validate({'format': 'csv'})),
+            fingerprint(self.validate({'format': 'json'})))
+
+
+class SearchCostTests(TestCase):
+
+    def cost(self, data):
+        serializer = SearchInputSerializer(data=data)
+        self.assertTrue(serializer.is_valid())
+        return search_cost(serializer.validated_data)
+
+    def test_search_cost__default(self):
+        self.assertEqual(1, self.cost({}))
+
+    def test_search_cost__no_aggs(self):
+        self.assertEqual(1, self.cost({'no_aggs': True}))
+        self.assertAlmostEqual(10.4, self.cost({'no_aggs': True,
+                                                'size': 1000}))
+
+    def test_search_cost__size(self):
+        self.assertAlmostEqual(10.9, self.cost({'size': 1000}))
+
+    def test_search_cost__highlight_all(self):
+        self.assertAlmostEqual(1.2, self.cost({'field': 'all'}))
+        self.assertEqual(1, self.cost({'field': 'all',
+                                       'no_highlight': True}))
+
+    def test_search_cost__deep_paging(self):
+        self.assertAlmostEqual(10, self.cost({'frm': 9000}))
+        cursor = encode_cursor([1, 2])
+        self.assertEqual(1, self.cost({'frm': 9000,
+                                       'search_after': cursor}))
+
+    def test_search_cost__search_term(self):
+        self.assertAlmostEqual(1.2, self.cost({'search_term': 'mortga*'}))
+
+    def test_search_cost__export(self):
+        self.assertEqual(1, self.cost({'format': 'csv', 'size': 1000}))
+
@@ -0,0 +1,72 @@
+from django.test import TestCase
+from complaint_search.snapshot import Snapshot
+import mock
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        self.loader = mock.MagicMock(side_effect=[{"v": 1}, {"v": 2}])
+
+    def test_age__not_loaded(self):
+        snapshot = Snapshot(self.loader, 60)
+        self.assertIsNone(snapshot.age())
+        self.loader.assert_not_called()
+
+    def test_get__loads_once(self):
+        snapshot = Snapshot(self.loader, 60)
+        self.assertEqual({"v": 1}, snapshot.get())
+        self.assertEqual({"v": 1}, snapshot.get())
+        self.assertEqual(1, self.loader.call_count)
+        self.assertTrue(snapshot.age() >= 0)
+
+    def test_get__returns_copy(self):
+        snapshot = Snapshot(self.loader, 60)
+        snapshot.get()["v"] = 99
+        self.assertEqual({"v": 1}, snapshot.get())
+
+    @mock.patch("complaint_search.snapshot.time")
+    def test_get__stale_serves_previous_value(self, mock_time):
+        mock_time.time.return_value = 1000
+        snapshot = Snapshot(self.loader, 60)
+        snapshot.get()
+        mock_time.time.return_value = 1061
+        with mock.patch.object(Snapshot, '_refresh_in_background') as mock_bg:
+            self.assertEqual({"v": 1}, snapshot.get())
+            mock_bg.assert_called_once_with()
+
+    @mock.patch("complaint_search.snapshot.threading.Thread")
+    def test_refresh_in_background__starts_one_thread(self, mock_thread):
+        snapshot = Snapshot(self.loader, 60)
+        snapshot._refresh_in_background()
+        snapshot._refresh_in_background()
+        self.assertEqual(1, mock_thread.call_count)
+        mock_thread.return_value.start.assert_called_once_with()
+
+    def test_background_refresh__keeps_value_on_error(self):
+        loader = mock.MagicMock(side_effect=[{"v": 1}, ValueError("down")])
+        snapshot = Snapshot(loader, 60)
+        snapshot.get()
+        snapshot._is_refreshing = True
+        snapshot._background_refresh()
+        self.assertEqual({"v": 1}, snapshot.get())
+        self.assertFalse(snapshot._is_refreshing)
+
+    def test_reset(self):
+        snapshot = Snapshot(self.loader, 60)
+        snapshot.get()
+        snapshot.reset()
+        self.assertIsNone(snapshot.age())
+        self.assertEqual({"v": 2}, snapshot.get())
+
+    @mock.patch("complaint_search.snapshot.threading.Thread")
+    def test_after_fork(self, mock_thread):
+        snapshot = Snapshot(self.loader, 60)
+        snapshot.get()
+        snapshot._refresh_in_background()
+        snapshot._lock.acquire()
+        snapshot.after_fork()
+        self.assertFalse(snapshot.is_loaded())
+        self.assertEqual({"v": 2}, snapshot.get())
+        snapshot._refresh_in_background()
+        self.assertEqual(2, mock_thread.call_count)
@@ -1,7 +1,15 @@
 from django.test import TestCase
+import gzip
+import json
+from io import BytesIO
+from requests.packages.urllib3.response import HTTPResponse
+from complaint_search import metrics
 from complaint_search.stream_content import (
+    StreamBlockContent,
     StreamCSVContent,
     StreamJSONContent,
+    StreamNDJSONContent,
+    StreamRawContent,
 )
 
 
@@ -56,3 +64,121 @@ class StreamJSONContentTests(TestCase):
                 '{"product": "test", "complaint_id": 23456, "tags": "Older Americans"},' \
                 '{"product": "loan", "complaint_id": 45678, "tags": null}]'
             self.assertEqual(exp_result, result)
+
+    def test_next_batches(self):
+        sc = StreamJSONContent(iter(self.content_list), batch_size=1)
+        content = [item for item in sc]
+        self.assertEqual(4, len(content))
+        self.assertTrue(content[0].startswith('[{"product": "mortgage"'))
+        self.assertTrue(content[1].startswith(',{"product": "test"'))
+        self.assertTrue(content[2].startswith(',{"product": "loan"'))
+        self.assertEqual("]", content[3])
+
+    def test_next_empty(self):
+        sc = StreamJSONContent(iter([]))
+        self.assertListEqual(["[]"], [item for item in sc])
+
+    def test_next_long_record(self):
+        narrative = "x" * (4 * 1024 * 1024)
+        content = '{"index": {"_id": 1}}\n' \
+            '{"complaint_what_happened": "' + narrative + '"}\n'
+        sc = StreamJSONContent(content[i:i + 512]
+                               for i in range(0, len(content), 512))
+        result = json.loads("".join(sc))
+        self.assertEqual(narrative, result[0]["complaint_what_happened"])
+        self.assertTrue(len(sc.buffer) < 1024)
+
+
+class StreamNDJSONContentTests(TestCase):
+
+    def setUp(self):
+        self.content = '{"index": {"_index": "test", "_id": 12345}}\n' \
+            '{"product": "mortgage", "complaint_id": 12345}\n' \
+            '{"index": {"_index": "test", "_id": 23456}}\n' \
+            '{"product": "test", "complaint_id": 23456}\n' \
+            '{"index": {"_index": "test", "_id": 45678}}\n' \
+            '{"product": "loan", "complaint_id": 45678} \n'
+
+    def test_next_ndjson(self):
+        for size in (1, 7, 20, 1024):
+            content_list = [self.content[(i * size):(i * size + size)]
+                            for i in range(len(self.content) / size + 1)]
+            sc = StreamNDJSONContent(iter(content_list), batch_size=1)
+            lines = "".join(sc).splitlines()
+            self.assertListEqual([12345, 23456, 45678],
+                                 [json.loads(line)["complaint_id"]
+                                  for line in lines])
+
+    def test_next_ndjson_empty(self):
+        sc = StreamNDJSONContent(iter([]))
+        self.assertListEqual([], [item for item in sc])
+
+
+def raw_response(body, gzipped=False):
+    """An unread urllib3 response, as requests hands it out with stream=True"""
+    headers = {}
+    if gzipped:
+        out = BytesIO()
+        with gzip.GzipFile(fileobj=out, mode="wb") as f:
+            f.write(body)
+        body = out.getvalue()
+        headers["content-encoding"] = "gzip"
+    return HTTPResponse(body=BytesIO(body), headers=headers,
+                        preload_content=False)
+
+
+class StreamRawContentTests(TestCase):
+
+    def test_next_blocks(self):
+        sc = StreamRawContent(raw_response(b"x" * 40), block_size=16)
+        self.assertListEqual([b"x" * 16, b"x" * 16, b"x" * 8],
+                             [block for block in sc])
+
+    def test_next_gzipped(self):
+        body = b"".join(b'{"index":{}}\n{"complaint_id":%d}\n' % i
+                        for i in range(1000))
+        sc = StreamRawContent(raw_response(body, gzipped=True),
+                              block_size=256)
+        self.assertEqual(body, b"".join(sc))
+
+    def test_next_gzipped_json(self):
+        sc = StreamJSONContent(StreamRawContent(raw_response(
+            b'{"index":{}}\n{"complaint_id":1}\n', gzipped=True)))
+        self.assertEqual([{"complaint_id": 1}], json.loads("".join(sc)))
+
+    def test_close_early(self):
+        raw = raw_response(b"x" * 40)
+        sc = StreamRawContent(raw, block_size=16)
+        next(sc)
+        sc.close()
+        self.assertTrue(raw.closed)
+        self.assertListEqual([], [block for block in sc])
+
+
+class StreamBlockContentTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_next_coalesces(self):
+        sc = StreamBlockContent(iter(["ab", "cd", "e", "fghij", "k"]),
+                                block_size=4)
+        self.assertListEqual(["abcd", "efghij", "k"], [item for item in sc])
+        self.assertEqual(11, metrics.get_metrics()["export_bytes"])
+        self.assertIn("export_seconds", metrics.get_metrics())
+
+    def test_close_reports_once(self):
+        sc = StreamBlockContent(iter(["ab", "cd"]), block_size=2)
+        next(sc)
+        sc.close()
+        sc.close()
+        self.assertEqual(2, metrics.get_metrics()["export_bytes"])
+
+    def test_close_closes_content(self):
+        raw = raw_response(b"a,b\n" * 10)
+        sc = StreamBlockContent(
+            StreamCSVContent("h\n", StreamRawContent(raw, block_size=16)),
+            block_size=2)
+        next(sc)
+        sc.close()
+        self.assertTrue(raw.closed)
@@ -0,0 +1,54 @@
+from django.test import TestCase
+import os
+import shutil
+import tempfile
+from complaint_search.throttle_store import GCRAStore
+
+
+class GCRAStoreTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = GCRAStore(os.path.join(directory, 'throttle.sqlite3'))
+
+    def test_allows_limit_per_period(self):
+        for _ in range(3):
+            self.assertEqual((True, 0), self.store.update('a', 3, 60, now=100))
+        self.assertEqual((False, 20), self.store.update('a', 3, 60, now=100))
+        # Another key has its own limit
+        self.assertEqual((True, 0), self.store.update('b', 3, 60, now=100))
+
+    def test_refills_over_time(self):
+        for _ in range(3):
+            self.store.update('a', 3, 60, now=100)
+        allowed, wait = self.store.update('a', 3, 60, now=110)
+        self.assertFalse(allowed)
+        self.assertEqual(10, wait)
+        self.assertEqual((True, 0), self.store.update('a', 3, 60, now=120))
+        self.assertFalse(self.store.update('a', 3, 60, now=120)[0])
+
+    def test_denied_requests_do_not_count(self):
+        self.store.update('a', 1, 60, now=100)
+        for _ in range(5):
+            self.assertFalse(self.store.update('a', 1, 60, now=130)[0])
+        self.assertTrue(self.store.update('a', 1, 60, now=160)[0])
+
+    def test_cost(self):
+        self.assertEqual((True, 0), self.store.update('a', 4, 60, 3, now=100))
+        self.assertEqual((False, 15), self.store.update('a', 4, 60, 2, now=100))
+        self.assertEqual((True, 0), self.store.update('a', 4, 60, 1, now=100))
+        # A cost above the limit is charged as the whole limit
+        self.assertEqual((True, 0), self.store.update('b', 4, 60, 10, now=100))
+        self.assertFalse(self.store.update('b', 4, 60, 0.1, now=100)[0])
+
+    def test_shared_between_connections(self):
+        other = GCRAStore(self.store.path)
+        self.store.update('a', 2, 60, now=100)
+        other.update('a', 2, 60, now=100)
+        self.assertFalse(self.store.update('a', 2, 60, now=100)[0])
+
+    def test_clear(self):
+        self.store.update('a', 1, 60, now=100)
+        self.store.clear()
+        self.assertTrue(self.store.update('a', 1, 60, now=100)[0])
@@ -3,8 +3,10 @@ from django.core.cache import cache
 from rest_framework import status
 from rest_framework.test import APITestCase
 from unittest import skip
-from elasticsearch import TransportError
+from elasticsearch import ConnectionTimeout, TransportError
 import mock
+import sqlite3
+from complaint_search import throttle_store
 from complaint_search.es_interface import document
 from complaint_search.throttling import (
     DocumentAnonRateThrottle,
@@ -14,12 +16,14 @@ from complaint_search.throttling import (
 class DocumentTests(APITestCase):
 
     def setUp(self):
+        throttle_store.clear()
         self.orig_document_anon_rate = DocumentAnonRateThrottle.rate
         # Setting rates to something really big so it doesn't affect testing
         DocumentAnonRateThrottle.rate = '2000/min'
 
     def tearDown(self):
         cache.clear()
+        throttle_store.clear()
         DocumentAnonRateThrottle.rate = self.orig_document_anon_rate
 
     @mock.patch('complaint_search.es_interface.document')
@@ -87,4 +91,22 @@ class DocumentTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertDictEqual({"error": "Elasticsearch error: Error"}, response.data)
 
+    @mock.patch('complaint_search.es_interface.document')
+    def test_document__deadline_exceeded(self, mock_esdocument):
+        mock_esdocument.side_effect = ConnectionTimeout(
+            'TIMEOUT', "Deadline exceeded", None)
+        url = reverse('complaint_search:document', kwargs={"id": "123456"})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertDictEqual({"error": "Elasticsearch error: Deadline exceeded"},
+                             response.data)
 
+    @mock.patch('complaint_search.throttle_store.update')
+    @mock.patch('complaint_search.es_interface.document')
+    def test_document__throttle_store_error(self, mock_esdocument,
+                                            mock_update):
+        mock_esdocument.return_value = 'OK'
+        mock_update.side_effect = sqlite3.OperationalError('locked')
+        url = reverse('complaint_search:document', kwargs={"id": "123456"})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -0,0 +1,140 @@
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+import gzip
+import shutil
+import tempfile
+import mock
+from complaint_search import export_jobs, throttle_store
+from complaint_search.throttling import (
+    ExportUIRateThrottle,
+    ExportAnonRateThrottle,
+)
+
+
+class ExportJobViewTests(APITestCase):
+
+    def setUp(self):
+        throttle_store.clear()
+        self.orig_export_ui_rate = ExportUIRateThrottle.rate
+        self.orig_export_anon_rate = ExportAnonRateThrottle.rate
+        ExportUIRateThrottle.rate = '2000/min'
+        ExportAnonRateThrottle.rate = '2000/min'
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patcher = mock.patch('complaint_search.export_jobs._JOB_DIR', self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.job_id = 'a' * 40
+
+    def tearDown(self):
+        cache.clear()
+        throttle_store.clear()
+        ExportUIRateThrottle.rate = self.orig_export_ui_rate
+        ExportAnonRateThrottle.rate = self.orig_export_anon_rate
+
+    def write_job(self, **kwargs):
+        job = {"id": self.job_id, "status": export_jobs.DONE,
+               "format": "csv", "bytes": 4, "created": 1, "finished": 2,
+               "error": None}
+        job.update(kwargs)
+        export_jobs._write_status(job)
+        with gzip.open(export_jobs.data_path(self.job_id), 'wb') as f:
+            f.write('"a"\n')
+        job["sha256"] = 'ab' * 32
+        export_jobs._write_status(job)
+
+    @mock.patch('complaint_search.export_jobs.submit')
+    def test_submit(self, mock_submit):
+        mock_submit.return_value = {"id": self.job_id,
+                                    "status": export_jobs.QUEUED}
+        url = reverse('complaint_search:export_job_submit', args=('csv',))
+        response = self.client.post(url + '?state=VA&search_term=bank')
+        self.assertEqual(status.HTTP_202_ACCEPTED, response.status_code)
+        self.assertEqual(self.job_id, response.data["id"])
+        self.assertNotIn("download", response.data)
+        params = mock_submit.call_args[0][0]
+        self.assertEqual("csv", params["format"])
+        self.assertEqual(["VA"], params["state"])
+
+    @mock.patch('complaint_search.export_jobs.submit')
+    def test_submit__invalid(self, mock_submit):
+        url = reverse('complaint_search:export_job_submit', args=('csv',))
+        response = self.client.post(url + '?size=-1')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        mock_submit.assert_not_called()
+
+    @mock.patch('complaint_search.export_jobs.submit')
+    def test_submit__queue_full(self, mock_submit):
+        mock_submit.side_effect = export_jobs.QueueFull()
+        url = reverse('complaint_search:export_job_submit', args=('json',))
+        response = self.client.post(url)
+        self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE,
+                         response.status_code)
+        self.assertEqual('60', response['Retry-After'])
+
+    @mock.patch('complaint_search.export_jobs.submit')
+    def test_submit__throttled(self, mock_submit):
+        mock_submit.return_value = {"id": self.job_id,
+                                    "status": export_jobs.QUEUED}
+        ExportAnonRateThrottle.rate = '1/min'
+        url = reverse('complaint_search:export_job_submit', args=('csv',))
+        self.client.post(url)
+        response = self.client.post(url)
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS,
+                         response.status_code)
+
+    def test_status(self):
+        self.write_job()
+        url = reverse('complaint_search:export_job_status',
+                      args=(self.job_id,))
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(export_jobs.DONE, response.data["status"])
+        self.assertTrue(response.data["download"].endswith(
+            '/job/{}/download'.format(self.job_id)))
+
+    def test_status__unknown(self):
+        url = reverse('complaint_search:export_job_status',
+                      args=(self.job_id,))
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_download(self):
+        self.write_job()
+        url = reverse('complaint_search:export_job_download',
+                      args=(self.job_id,))
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual('"a"\n', "".join(response.streaming_content))
+
+    def test_download__throttled(self):
+        self.write_job()
+        ExportAnonRateThrottle.rate = self.orig_export_anon_rate
+        url = reverse('complaint_search:export_job_download',
+                      args=(self.job_id,))
+        limit = int(self.orig_export_anon_rate.split('/')[0])
+        for _ in range(limit):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS,
+                         response.status_code)
+
+        # Polling the job's status is not an export
+        url = reverse('complaint_search:export_job_status',
+                      args=(self.job_id,))
+        self.assertEqual(status.HTTP_200_OK, self.client.get(url).status_code)
+
+    def test_download__not_done(self):
+        self.write_job(status=export_jobs.RUNNING, finished=None)
+        url = reverse('complaint_search:export_job_download',
+                      args=(self.job_id,))
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_409_CONFLICT, response.status_code)
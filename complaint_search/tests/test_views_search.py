@@ -6,7 +6,9 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 from unittest import skip
 import copy
+import json
 import mock
+import zlib
 from datetime import date, datetime
 from elasticsearch import TransportError
 from complaint_search.defaults import (
@@ -14,6 +16,8 @@ from complaint_search.defaults import (
     PARAMS,
 )
 from complaint_search.es_interface import search
+from complaint_search import metrics, response_cache, throttle_store
+from complaint_search.circuit_breaker import CircuitOpen
 from complaint_search.serializer import SearchInputSerializer
 from complaint_search.throttling import (
     SearchAnonRateThrottle,
@@ -25,6 +29,7 @@ from complaint_search.throttling import (
 class SearchTests(APITestCase):
 
     def setUp(self):
+        throttle_store.clear()
         self.orig_search_anon_rate = SearchAnonRateThrottle.rate
         self.orig_export_ui_rate = ExportUIRateThrottle.rate
         self.orig_export_anon_rate = ExportAnonRateThrottle.rate
@@ -32,9 +37,15 @@ class SearchTests(APITestCase):
         SearchAnonRateThrottle.rate = '2000/min'
         ExportUIRateThrottle.rate = '2000/min'
         ExportAnonRateThrottle.rate = '2000/min'
+        for name in ('_CACHE', '_STALE_CACHE'):
+            patcher = mock.patch('complaint_search.response_cache.' + name,
+                                 response_cache.LRUCache(10, 60))
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def tearDown(self):
         cache.clear()
+        throttle_store.clear()
         SearchAnonRateThrottle.rate = self.orig_search_anon_rate
         ExportUIRateThrottle.rate = self.orig_export_ui_rate
         ExportAnonRateThrottle.rate = self.orig_export_anon_rate
@@ -61,6 +72,151 @@ class SearchTests(APITestCase):
             **self.buildDefaultParams({}))
         self.assertEqual('OK', response.data)
 
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_cached(self, mock_essearch):
+        """
+        Searches that only differ in parameter order or spelled out defaults
+        are answered from the cache
+        """
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = {'hits': 'OK'}
+        response = self.client.get(url + '?company=B&company=A')
+        self.assertEqual({'hits': 'OK'}, response.data)
+        response = self.client.get(
+            url + '?size=10&company=A&company=B&sort=relevance_desc')
+        self.assertEqual({'hits': 'OK'}, response.data)
+        self.assertEqual(1, mock_essearch.call_count)
+
+        response = self.client.get(url + '?company=A')
+        self.assertEqual(2, mock_essearch.call_count)
+
+    @mock.patch('complaint_search.es_interface.last_indexed')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_cached__reindexed(self, mock_essearch, mock_indexed):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = {'hits': 'OK'}
+        mock_indexed.return_value = '2017-01-01T12:00:00-05:00'
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(1, mock_essearch.call_count)
+        mock_indexed.return_value = '2017-01-02T12:00:00-05:00'
+        self.client.get(url)
+        self.assertEqual(2, mock_essearch.call_count)
+
+    @mock.patch('complaint_search.response_cache._CACHE',
+                response_cache.NoCache())
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_circuit_open_stale(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = {'hits': 'OK'}
+        self.client.get(url + '?company=A')
+
+        mock_essearch.side_effect = CircuitOpen()
+        response = self.client.get(url + '?company=A')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'hits': 'OK', '_stale': True}, response.data)
+        self.assertEqual('110 - "Response is Stale"', response['Warning'])
+
+        response = self.client.get(url + '?company=B')
+        self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE,
+                         response.status_code)
+
+    @mock.patch('complaint_search.views.datetime')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_export_not_cached(self, mock_essearch, mock_dt):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = 'OK'
+        mock_dt.now.return_value = datetime(2017,1,1,12,0)
+        self.client.get(url, {"format": "csv"})
+        self.client.get(url, {"format": "csv"})
+        self.assertEqual(2, mock_essearch.call_count)
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_gzip_export(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        rows = ['"Row {}"\n'.format(i) for i in range(1000)]
+        mock_essearch.return_value = iter(rows)
+        response = self.client.get(url, {"format": "csv"},
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        content = "".join(response.streaming_content)
+        self.assertEqual("".join(rows),
+                         zlib.decompress(content, 16 + zlib.MAX_WBITS))
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_gzip_json(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = {"hits": ["complaint"] * 1000}
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(str(len(response.content)),
+                         response['Content-Length'])
+        self.assertEqual(mock_essearch.return_value, json.loads(
+            zlib.decompress(response.content, 16 + zlib.MAX_WBITS)))
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_small_json_not_compressed(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = 'OK'
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual('OK', response.data)
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_gzip_not_accepted(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = {"hits": ["complaint"] * 1000}
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @mock.patch('complaint_search.decorators.brotli')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_brotli_preferred(self, mock_essearch, mock_brotli):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = iter(['"Row"\n'])
+        mock_brotli.Compressor.return_value.process.return_value = 'BR'
+        mock_brotli.Compressor.return_value.finish.return_value = 'END'
+        response = self.client.get(url, {"format": "csv"},
+                                   HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual('br', response['Content-Encoding'])
+        self.assertEqual('BREND', "".join(response.streaming_content))
+
+    @mock.patch('complaint_search.export_snapshots.snapshot_response')
+    @mock.patch('complaint_search.export_snapshots.get_snapshot')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_export_snapshot(self, mock_essearch, mock_snapshot,
+                                    mock_file_response):
+        url = reverse('complaint_search:search')
+        mock_snapshot.return_value = {"name": "complaints-1.csv.gz"}
+        mock_file_response.return_value = HttpResponse('SNAPSHOT')
+        response = self.client.get(url, {"format": "csv"},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('SNAPSHOT', response.content)
+        self.assertIn('attachment', response['Content-Disposition'])
+        mock_snapshot.assert_called_once_with('csv')
+        mock_essearch.assert_not_called()
+
+    @mock.patch('complaint_search.export_snapshots.get_snapshot')
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_export_snapshot__not_used(self, mock_essearch,
+                                              mock_snapshot):
+        url = reverse('complaint_search:search')
+        mock_snapshot.return_value = {"name": "complaints-1.csv.gz"}
+        mock_essearch.return_value = iter(['"Row"\n'])
+        # Filtered
+        self.client.get(url, {"format": "csv", "state": "VA"},
+                        HTTP_ACCEPT_ENCODING='gzip')
+        # gzip not accepted
+        self.client.get(url, {"format": "csv"})
+        # Not the search the snapshot was built with
+        self.client.get(url, {"format": "csv", "field": "all"},
+                        HTTP_ACCEPT_ENCODING='gzip')
+        self.client.get(url, {"format": "csv", "sort": "created_date_desc"},
+                        HTTP_ACCEPT_ENCODING='gzip')
+        mock_snapshot.assert_not_called()
+        self.assertEqual(4, mock_essearch.call_count)
+
     @mock.patch('complaint_search.es_interface.search')
     def test_search_cors_headers(self, mock_essearch):
         """
@@ -73,9 +229,10 @@ class SearchTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.has_header('Access-Control-Allow-Origin'))
 
+    @mock.patch('complaint_search.columnar.is_available', return_value=True)
     @mock.patch('complaint_search.views.datetime')
     @mock.patch('complaint_search.es_interface.search')
-    def test_search_with_format(self, mock_essearch, mock_dt):
+    def test_search_with_format(self, mock_essearch, mock_dt, mock_available):
         """
         Searching with format
         """
@@ -92,6 +249,29 @@ class SearchTests(APITestCase):
         mock_essearch.has_calls([ mock.call(format=k) for k in FORMAT_CONTENT_TYPE_MAP ], any_order=True)
         self.assertEqual(len(FORMAT_CONTENT_TYPE_MAP), mock_essearch.call_count)
 
+    @mock.patch('complaint_search.columnar.is_available', return_value=False)
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_with_format_parquet__unavailable(self, mock_essearch,
+                                                     mock_available):
+        url = reverse('complaint_search:search')
+        response = self.client.get(url, {"format": "parquet"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        mock_essearch.assert_not_called()
+        self.assertDictEqual(
+            {"format": ["parquet export is not available"]}, response.data)
+
+    @mock.patch('complaint_search.columnar.is_available', return_value=True)
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_with_format_parquet__not_compressed(self, mock_essearch,
+                                                        mock_available):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = iter(["PAR1", "PAR1"])
+        response = self.client.get(url, {"format": "parquet"},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual("PAR1PAR1", "".join(response.streaming_content))
+
     @mock.patch('complaint_search.es_interface.search')
     def test_search_with_field__valid(self, mock_essearch):
         url = reverse('complaint_search:search')
@@ -272,6 +452,34 @@ class SearchTests(APITestCase):
             **self.buildDefaultParams(params))
         self.assertEqual('OK', response.data)
 
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_with_search_term__rewritten(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        metrics.reset()
+        mock_essearch.return_value = 'OK'
+        response = self.client.get(url, {"search_term": "*mortgage~3"})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        mock_essearch.assert_called_once_with(agg_exclude=self.buildDefaultAggExclude(),
+            **self.buildDefaultParams({"search_term": "mortgage~1"}))
+        stats = metrics.get_metrics()
+        self.assertEqual(1, stats["query_accepted"])
+        self.assertEqual(1, stats["query_rewritten.leading_wildcard"])
+        self.assertEqual(1, stats["query_rewritten.fuzziness"])
+
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_with_search_term__rejected(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        metrics.reset()
+        response = self.client.get(url, {"search_term": "/mort.*age/"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        mock_essearch.assert_not_called()
+        self.assertDictEqual(
+            {"search_term": ["search_term can not be a regular expression"]},
+            response.data)
+        stats = metrics.get_metrics()
+        self.assertEqual(1, stats["query_rejected.regex"])
+        self.assertNotIn("query_accepted", stats)
+
     @mock.patch('complaint_search.es_interface.search')
     def test_search_with_date_received_min__valid(self, mock_essearch):
         url = reverse('complaint_search:search')
@@ -585,6 +793,8 @@ class SearchTests(APITestCase):
         self.assertDictEqual({"no_highlight": [u'"Not boolean" is not a valid boolean.']},
             response.data)
 
+    @mock.patch('complaint_search.response_cache._CACHE',
+        response_cache.NoCache())
     @mock.patch('complaint_search.es_interface.search')
     def test_search_with_search_anon_rate_throttle(self, mock_essearch):
         url = reverse('complaint_search:search')
@@ -605,6 +815,39 @@ class SearchTests(APITestCase):
         self.assertEqual(limit, mock_essearch.call_count)
         self.assertEqual(20, limit)
 
+    @mock.patch('complaint_search.response_cache._CACHE',
+        response_cache.NoCache())
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_with_search_anon_rate_throttle_cost(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = 'OK'
+        SearchAnonRateThrottle.rate = self.orig_search_anon_rate
+        # A page of 510 hits costs as much as 6 default searches
+        for _ in range(3):
+            response = self.client.get(url, {"size": 510})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url, {"size": 510})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(3, mock_essearch.call_count)
+        # What is left of the quota still admits cheaper searches
+        response = self.client.get(url, {"no_aggs": True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @mock.patch('complaint_search.response_cache._CACHE',
+        response_cache.NoCache())
+    @mock.patch('complaint_search.es_interface.search')
+    def test_search_with_search_anon_rate_throttle__validates_once(self, mock_essearch):
+        url = reverse('complaint_search:search')
+        mock_essearch.return_value = 'OK'
+        SearchAnonRateThrottle.rate = self.orig_search_anon_rate
+        metrics.reset()
+        response = self.client.get(url, {"search_term": "mortga*"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(1, metrics.get_metrics()["query_accepted"])
+
+    @mock.patch('complaint_search.response_cache._CACHE',
+        response_cache.NoCache())
     @mock.patch('complaint_search.es_interface.search')
     def test_search_with_search_ui_rate_throttle(self, mock_essearch):
         url = reverse('complaint_search:search')
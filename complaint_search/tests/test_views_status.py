@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from complaint_search import throttle_store
+from complaint_search.throttling import StatusRateThrottle
+import mock
+
+
+class StatusTests(APITestCase):
+
+    def setUp(self):
+        throttle_store.clear()
+
+    def tearDown(self):
+        cache.clear()
+        throttle_store.clear()
+
+    @mock.patch('complaint_search.metrics.get_metrics')
+    def test_status(self, mock_get_metrics):
+        mock_get_metrics.return_value = {'meta_snapshot_age_seconds': 12.5}
+        url = reverse('complaint_search:status')
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'meta_snapshot_age_seconds': 12.5}, response.data)
+
+    @mock.patch('complaint_search.metrics.get_metrics')
+    def test_status__not_allowed(self, mock_get_metrics):
+        url = reverse('complaint_search:status')
+        response = self.client.get(url, REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+        mock_get_metrics.assert_not_called()
+
+    @mock.patch('complaint_search.permissions._STATUS_ALLOWED_IPS',
+                ['203.0.113.7'])
+    def test_status__allowed_ips(self):
+        url = reverse('complaint_search:status')
+        response = self.client.get(url, REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+    def test_status__throttled(self):
+        url = reverse('complaint_search:status')
+        limit = int(StatusRateThrottle.rate.split('/')[0])
+        for _ in range(limit):
+            self.assertEqual(status.HTTP_200_OK,
+                             self.client.get(url).status_code)
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS,
+                         self.client.get(url).status_code)
@@ -0,0 +1,89 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+
+# sqlite database holding the rate limits, shared by the workers of a host
+_DB_PATH = os.environ.get('THROTTLE_DB', os.path.join(
+    tempfile.gettempdir(), 'ccdb5-throttle.sqlite3'))
+# Seconds an update waits for another worker's to finish
+_BUSY_TIMEOUT = 5
+# Updates between two purges of the keys whose limit is fully available
+_PURGE_INTERVAL = 1000
+
+
+class GCRAStore(object):
+    """
+    Rate limits in a sqlite database in WAL mode, so every worker on the
+    host counts against the same limits. Each key only stores its
+    theoretical arrival time (GCRA, the generic cell rate algorithm), so a
+    request costs one small row read and written in a single transaction,
+    however many requests the key made.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._updates = 0
+
+    def _connect(self):
+        # One connection per thread, and a new one after a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS throttle ('
+                         'key TEXT PRIMARY KEY, tat REAL NOT NULL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def update(self, key, limit, period, cost=1, now=None):
+        """
+        Counts a request of key costing cost requests (at most limit), where
+        key may make limit requests per period seconds. Returns whether the
+        request is allowed and, when it is not, the seconds until it would be.
+        """
+        now = time.time() if now is None else now
+        interval = float(period) / limit * min(cost, limit)
+        conn = self._connect()
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tat FROM throttle WHERE key = ?',
+                               (key,)).fetchone()
+            tat = max(row[0], now) if row else now
+            wait = tat + interval - now - period
+            if wait <= 0:
+                conn.execute('INSERT OR REPLACE INTO throttle (key, tat) '
+                             'VALUES (?, ?)', (key, tat + interval))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        self._updates += 1
+        if self._updates % _PURGE_INTERVAL == 0:
+            # A key whose arrival time has passed is the same as no key
+            conn.execute('DELETE FROM throttle WHERE tat < ?', (now,))
+
+        if wait > 0:
+            return False, wait
+        return True, 0
+
+    def clear(self):
+        self._connect().execute('DELETE FROM throttle')
+
+
+_STORE = GCRAStore(_DB_PATH)
+
+
+def update(key, limit, period, cost=1):
+    return _STORE.update(key, limit, period, cost)
+
+
+def clear():
+    """Forgets the requests of every key"""
+    _STORE.clear()
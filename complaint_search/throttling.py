@@ -1,6 +1,10 @@
 import os
+import logging
+import sqlite3
 from rest_framework.throttling import AnonRateThrottle
 from complaint_search.defaults import EXPORT_FORMATS
+from complaint_search import metrics, throttle_store
+from complaint_search.serializer import search_cost, search_input
 
 _CCDB_UI_URL = os.environ.get('CCDB_UI_URL', 
     'http://localhost:8000/data-research/consumer-complaints/search')
@@ -8,13 +12,48 @@ _CCDB_UI_URL = os.environ.get('CCDB_UI_URL',
 class CCDBRateThrottle(AnonRateThrottle):
     scope = 'ccdb'
 
+    def allow_request(self, request, view):
+        # GCRA in the shared throttle store instead of DRF's per-client list
+        # of timestamps in the cache
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        try:
+            allowed, self.wait_seconds = throttle_store.update(
+                self.key, self.num_requests, self.duration,
+                self.get_cost(request))
+        except sqlite3.Error:
+            # Requests are let through rather than failed with the store
+            logging.getLogger(__name__).exception('Throttle store failed')
+            metrics.incr('throttle_errors')
+            return True
+        return allowed
+
+    def wait(self):
+        return self.wait_seconds
+
     def is_referred_from_ui(self, request,view):
         return request.META.get('HTTP_REFERER') and \
             request.META.get('HTTP_REFERER').find(_CCDB_UI_URL) != -1
 
     def is_export(self, request): # otherwise it is a search
-        return request.query_params.get("format") and \
-            request.query_params.get("format") in EXPORT_FORMATS
+        # Export jobs have the format in their URL, and their downloads are
+        # exports whatever the format
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match and \
+            resolver_match.url_name == 'export_job_download':
+            return True
+        export_format = request.query_params.get("format") or \
+            request.parser_context.get("kwargs", {}).get("export_format")
+        return export_format and export_format in EXPORT_FORMATS
+
+    def get_cost(self, request):
+        """How many requests of the rate this request counts as"""
+        return 1
   
 class CCDBAnonRateThrottle(CCDBRateThrottle):
     scope = 'ccdb_anon'
@@ -54,6 +93,14 @@ class SearchAnonRateThrottle(CCDBAnonRateThrottle):
         else:
             return True
 
+    def get_cost(self, request):
+        # Searches are charged what they cost Elasticsearch, in default
+        # searches. Invalid ones are rejected by the view and cost 1.
+        serializer = search_input(request, request.query_params.get('format'))
+        if not serializer.is_valid():
+            return 1
+        return search_cost(serializer.validated_data)
+
 class ExportUIRateThrottle(CCDBUIRateThrottle):
     scope = 'ccdb_ui_export'
     rate = '6/min'
@@ -80,4 +127,8 @@ class ExportAnonRateThrottle(CCDBAnonRateThrottle):
 
 class DocumentAnonRateThrottle(CCDBAnonRateThrottle):
     scope = 'ccdb_anon_document'
-    rate = '5/min'
\ No newline at end of file
+    rate = '5/min'
+
+class StatusRateThrottle(CCDBRateThrottle):
+    scope = 'ccdb_status'
+    rate = '60/min'
@@ -1,4 +1,5 @@
 from django.conf.urls import include, url
+from complaint_search.defaults import EXPORT_FORMATS
 import complaint_search.views
 
 urlpatterns = [
@@ -13,6 +14,27 @@ urlpatterns = [
         name="suggest_zip"
     ),
     url(r'^_suggest', complaint_search.views.suggest, name="suggest"),
+    url(r'^_status', complaint_search.views.status_metrics, name="status"),
+    url(
+        r'^_export/(?P<export_format>{})$'.format('|'.join(EXPORT_FORMATS)),
+        complaint_search.views.export_job_submit,
+        name="export_job_submit"
+    ),
+    url(
+        r'^_export/checkpoint/(?P<export_id>[0-9a-f]{32})$',
+        complaint_search.views.export_checkpoint,
+        name="export_checkpoint"
+    ),
+    url(
+        r'^_export/job/(?P<job_id>[0-9a-f]{40})$',
+        complaint_search.views.export_job_status,
+        name="export_job_status"
+    ),
+    url(
+        r'^_export/job/(?P<job_id>[0-9a-f]{40})/download$',
+        complaint_search.views.export_job_download,
+        name="export_job_download"
+    ),
     url(r'^(?P<id>[0-9]+)$', complaint_search.views.document, name="document"),
     url(r'^$', complaint_search.views.search, name="search"),
 ]
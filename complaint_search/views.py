@@ -1,86 +1,45 @@
 from rest_framework import status
 from rest_framework.decorators import (
-    api_view, renderer_classes, throttle_classes
+    api_view, permission_classes, renderer_classes, throttle_classes
 )
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from rest_framework.response import Response
+from django.core.urlresolvers import reverse
 from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from datetime import datetime
+import gzip
 from elasticsearch import TransportError
 import es_interface
 from complaint_search.defaults import (
     AGG_EXCLUDE_FIELDS,
     EXPORT_FORMATS,
-    FORMAT_CONTENT_TYPE_MAP
+    FORMAT_CONTENT_TYPE_MAP,
+    RESUMABLE_FORMATS,
 )
 from complaint_search.renderers import (
-    DefaultRenderer, CSVRenderer
+    DefaultRenderer, CSVRenderer, NDJSONRenderer, ParquetRenderer
 )
-from complaint_search.decorators import catch_es_error
+from complaint_search.decorators import (
+    accepts_encoding, catch_es_error, compress_response
+)
+from complaint_search import (
+    export_checkpoints, export_jobs, export_snapshots, metrics, response_cache
+)
+from complaint_search.permissions import IsStatusClient
+from complaint_search.stream_content import StreamBlockContent
 from complaint_search.serializer import (
-    SearchInputSerializer, SuggestInputSerializer, SuggestFilterInputSerializer
+    SearchInputSerializer, SuggestInputSerializer, SuggestFilterInputSerializer,
+    QPARAMS_VARS, fingerprint, parse_query_params, search_input
 )
 from complaint_search.throttling import (
     SearchAnonRateThrottle,
     ExportUIRateThrottle,
     ExportAnonRateThrottle,
     DocumentAnonRateThrottle,
+    StatusRateThrottle,
 )
 
-# -----------------------------------------------------------------------------
-# Query Parameters
-#
-# When you add a query parameter, make sure you add it to one of the
-# constant tuples below so it will be parse correctly
-
-QPARAMS_VARS = (
-    'company_received_max',
-    'company_received_min',
-    'date_received_max',
-    'date_received_min',
-    'field',
-    'frm',
-    'no_aggs',
-    'no_highlight',
-    'search_term',
-    'size',
-    'sort'
-)
-
-
-QPARAMS_LISTS = (
-    'company',
-    'company_public_response',
-    'company_response',
-    'consumer_consent_provided',
-    'consumer_disputed',
-    'has_narrative',
-    'issue',
-    'product',
-    'state',
-    'submitted_via',
-    'tags',
-    'timely',
-    'zip_code'
-)
-
-
-def _parse_query_params(query_params, validVars=None):
-    if not validVars:
-        validVars = list(QPARAMS_VARS)
-
-    data = {}
-    for param in query_params:
-        if param in validVars:
-            data[param] = query_params.get(param)
-        elif param in QPARAMS_LISTS:
-            data[param] = query_params.getlist(param)
-          # TODO: else: Error if extra parameters? Or ignore?
-
-    return data
-
-
 # -----------------------------------------------------------------------------
 # Header methods
 
@@ -99,11 +58,14 @@ def _buildHeaders():
 # -----------------------------------------------------------------------------
 # Request Handlers
 
+@compress_response
 @api_view(['GET'])
 @renderer_classes((
     DefaultRenderer,
     JSONRenderer,
     CSVRenderer,
+    NDJSONRenderer,
+    ParquetRenderer,
     BrowsableAPIRenderer,
 ))
 @throttle_classes([
@@ -114,42 +76,72 @@ def _buildHeaders():
 @catch_es_error
 def search(request):
 
-    fixed_qparam = request.query_params
-    data = _parse_query_params(request.query_params)
-
-    # Add format to data
     format = request.accepted_renderer.format
-    if format and format in EXPORT_FORMATS:
-        data['format'] = format
-    else:
-        data['format'] = 'default'
-
-    serializer = SearchInputSerializer(data=data)
-
+    serializer = search_input(request, format)
     if not serializer.is_valid():
         return Response(
             serializer.errors, status=status.HTTP_400_BAD_REQUEST
         )
 
-    results = es_interface.search(
-        agg_exclude=AGG_EXCLUDE_FIELDS, **serializer.validated_data)
-    headers = _buildHeaders()
-
+    # Native csv and ndjson exports record checkpoints to resume from
+    export_id = None
+    if format in RESUMABLE_FORMATS and es_interface.exports_are_resumable():
+        export_id = export_checkpoints.new_id()
+
+    def run_search():
+        if export_id:
+            return es_interface.search(
+                agg_exclude=AGG_EXCLUDE_FIELDS, export_id=export_id,
+                **serializer.validated_data)
+        return es_interface.search(
+            agg_exclude=AGG_EXCLUDE_FIELDS, **serializer.validated_data)
+
+    # Unfiltered exports are the whole index, which is prebuilt on disk
+    if format in EXPORT_FORMATS and \
+        export_snapshots.is_unfiltered(serializer.validated_data) and \
+        accepts_encoding(request, 'gzip'):
+        snapshot = export_snapshots.get_snapshot(format)
+        if snapshot:
+            response = export_snapshots.snapshot_response(
+                request, snapshot, FORMAT_CONTENT_TYPE_MAP[format])
+            return _attachment(response, format)
+
+    # Exports are streamed and cursor pages walk a scroll, neither can be
+    # replayed from the cache
+    if format in EXPORT_FORMATS or 'search_after' in serializer.validated_data:
+        results = run_search()
+    else:
+        # Keyed by the index the results were read from as well, so a
+        # reindex isn't hidden by the responses cached before it
+        results = response_cache.cached('{}:{}'.format(
+            fingerprint(serializer.validated_data),
+            es_interface.last_indexed()), run_search)
     if format not in EXPORT_FORMATS:
+        headers = _buildHeaders()
+        if isinstance(results, dict) and results.get('_stale'):
+            headers['Warning'] = '110 - "Response is Stale"'
         return Response(results, headers=headers)
 
     # If format is in export formats, update its attachment response
     # with a filename
 
     response = StreamingHttpResponse(
-        streaming_content=results,
+        streaming_content=StreamBlockContent(results),
         content_type=FORMAT_CONTENT_TYPE_MAP[format]
     )
+    if export_id:
+        response['Export-Checkpoint'] = request.build_absolute_uri(reverse(
+            'complaint_search:export_checkpoint', args=(export_id,)))
+    return _attachment(response, format)
+
+
+def _attachment(response, format):
     filename = 'complaints-{}.{}'.format(
         datetime.now().strftime('%Y-%m-%d_%H_%M'), format
     )
     headerTemplate = 'attachment; filename="{}"'
     response['Content-Disposition'] = headerTemplate.format(filename)
+    headers = _buildHeaders()
     for header in headers:
         response[header] = headers[header]
 
@@ -159,7 +151,7 @@ def search(request):
 @api_view(['GET'])
 @catch_es_error
 def suggest(request):
-    data = _parse_query_params(request.query_params, ['text', 'size'])
+    data = parse_query_params(request.query_params, ['text', 'size'])
 
     serializer = SuggestInputSerializer(data=data)
     if serializer.is_valid():
@@ -186,7 +178,7 @@ def suggest_zip(request):
     validVars = list(QPARAMS_VARS)
     validVars.append('text')
 
-    data = _parse_query_params(request.query_params, validVars)
+    data = parse_query_params(request.query_params, validVars)
     if data.get('text'):
         data['text'] = data['text'].upper()
     return _suggest_field(data, 'zip_code')
@@ -205,7 +197,7 @@ def suggest_company(request):
     validVars = list(QPARAMS_VARS)
     validVars.append('text')
 
-    data = _parse_query_params(request.query_params, validVars)
+    data = parse_query_params(request.query_params, validVars)
     
     # Company filters should not be applied to their own aggregation filter
     if 'company' in data:
@@ -223,3 +215,114 @@ def suggest_company(request):
 def document(request, id):
     results = es_interface.document(id)
     return Response(results, headers=_buildHeaders())
+
+
+@api_view(['GET'])
+@permission_classes([IsStatusClient, ])
+@throttle_classes([StatusRateThrottle, ])
+def status_metrics(request):
+    return Response(metrics.get_metrics(), headers=_buildHeaders())
+
+
+# -----------------------------------------------------------------------------
+# Export Jobs
+
+def _job_status(request, job):
+    result = dict(job)
+    if job["status"] == export_jobs.DONE:
+        result["download"] = request.build_absolute_uri(reverse(
+            'complaint_search:export_job_download', args=(job["id"],)))
+    return result
+
+
+@api_view(['POST'])
+@throttle_classes([
+    ExportUIRateThrottle,
+    ExportAnonRateThrottle,
+])
+def export_job_submit(request, export_format):
+    data = parse_query_params(request.query_params)
+    data['format'] = export_format
+
+    serializer = SearchInputSerializer(data=data)
+    if not serializer.is_valid():
+        return Response(
+            serializer.errors, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        job = export_jobs.submit(serializer.validated_data)
+    except export_jobs.QueueFull:
+        headers = _buildHeaders()
+        headers['Retry-After'] = '60'
+        return Response({"error": "Too many export jobs, try again later"},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers=headers)
+
+    return Response(_job_status(request, job),
+                    status=status.HTTP_202_ACCEPTED, headers=_buildHeaders())
+
+
+@api_view(['GET'])
+def export_checkpoint(request, export_id):
+    """
+    Where an interrupted download continues: given the bytes received, the
+    offset to truncate the download to and the resume_from to append from
+    """
+    try:
+        received = int(request.query_params.get('received', ''))
+    except ValueError:
+        return Response({"received": ["A valid integer is required."]},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    checkpoint = export_checkpoints.find(export_id, received)
+    if checkpoint is None:
+        return Response({"error": "No checkpoint to resume from"},
+                        status=status.HTTP_404_NOT_FOUND)
+    return Response(checkpoint, headers=_buildHeaders())
+
+
+@api_view(['GET'])
+def export_job_status(request, job_id):
+    job = export_jobs.get_job(job_id)
+    if job is None:
+        return Response({"error": "No such export job"},
+                        status=status.HTTP_404_NOT_FOUND)
+    return Response(_job_status(request, job), headers=_buildHeaders())
+
+
+def _gunzip(path):
+    with gzip.open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            yield block
+
+
+@api_view(['GET'])
+@renderer_classes((
+    DefaultRenderer,
+    JSONRenderer,
+    CSVRenderer,
+    NDJSONRenderer,
+    ParquetRenderer,
+    BrowsableAPIRenderer,
+))
+@throttle_classes([
+    ExportUIRateThrottle,
+    ExportAnonRateThrottle,
+])
+def export_job_download(request, job_id):
+    job = export_jobs.get_job(job_id)
+    if job is None:
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+    if job["status"] != export_jobs.DONE:
+        return HttpResponse(status=status.HTTP_409_CONFLICT)
+
+    path = export_jobs.data_path(job_id)
+    content_type = FORMAT_CONTENT_TYPE_MAP[job["format"]]
+    if accepts_encoding(request, 'gzip'):
+        response = export_snapshots.file_response(
+            request, path, job["sha256"], content_type)
+    else:
+        response = StreamingHttpResponse(_gunzip(path),
+                                         content_type=content_type)
+    return _attachment(response, job["format"])
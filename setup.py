@@ -53,4 +53,7 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     setup_requires=['setuptools-git-version==1.0.3'],
     install_requires=install_requires,
+    extras_require={
+        'parquet': ['pyarrow>=0.9,<0.17'],
+    },
 )